@@ -1,35 +1,101 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify, send_file, stream_with_context
 from flask_cors import CORS
 import sqlite3
 import os
-from datetime import datetime, date
-from typing import Optional, Dict, Any
+import time
+import metrics
+import tracing
+from db import pool, generation, USERS_DB, TRANSACTIONS_DB, DAILY_SCORES_DB
+from migrations import migrate, USERS_MIGRATIONS, TRANSACTIONS_MIGRATIONS, DAILY_SCORES_MIGRATIONS
+from response_cache import response_cache, data_etag
+from leaderboard_index import leaderboard
+from leaderboard_stream import broadcaster, DEFAULT_TOP, MAX_TOP
+from daily_rankings import (daily_rankings, is_final, winners_between, PRIZE_AMOUNT, DEFAULT_TOP as DAILY_DEFAULT_TOP,
+                            MAX_TOP as DAILY_MAX_TOP)
+from writer import create_writer
+from seasons import CURRENT_SEASON, SEASON_AMOUNT, has_stale_amounts
+from snapshots import snapshot_store, MAX_TOP as SNAPSHOT_MAX_TOP
+from profiling import ProfilingMiddleware, profile_store, PROFILE_ENABLED, SORT_KEYS as PROFILE_SORT_KEYS
+from sql_profiler import profiler as sql_profiler, ORDERS as SQL_PROFILE_ORDERS
+from wallet_ids import parse_walletid, wallet_id, wallet_key
+from store import format_number, row_to_user, row_to_transaction, USER_COLUMNS, USER_FIELDS, TRANSACTION_COLUMNS
+from pagination import KeysetQuery, PAGE_SIZE, MAX_PAGE_SIZE, decode_cursor, json_chunks, ndjson_chunks, csv_chunks
+from units import format_units, from_units, to_units
+from datetime import date
+from typing import Optional, Dict, Any, List, Callable, Hashable
 
 app = Flask(__name__)
 # Configure CORS to allow specific origins
+CORS_ORIGINS = [
+    "https://frontend.qxmr.quest",
+    "https://www.qxmr.quest",
+    "https://admin.qxmr.quest",
+    "http://localhost:5173",  # For local development
+    "http://localhost:5174"
+]
 CORS(app, resources={
     r"/*": {
-        "origins": [
-            "https://frontend.qxmr.quest",
-            "https://www.qxmr.quest",
-            "https://admin.qxmr.quest",
-            "http://localhost:5173",  # For local development
-            "http://localhost:5174"
-        ],
+        "origins": CORS_ORIGINS,
         "methods": ["GET", "POST", "OPTIONS"],
         "allow_headers": ["Content-Type", "Authorization"],
         "supports_credentials": False
     }
 })
 
-# Database file paths
-USERS_DB = 'users.db'
-TRANSACTIONS_DB = 'transactions.db'
+# Spans and Server-Timing per request (see tracing.py)
+if tracing.TRACING_ENABLED:
+    app.json = tracing.TracedJSONProvider(app)
+
+# cProfile of single requests on demand (see profiling.py)
+if PROFILE_ENABLED:
+    app.wsgi_app = ProfilingMiddleware(app.wsgi_app)
+
+# All mutations go through the single writer (sidecar under gunicorn, thread otherwise)
+writer = create_writer()
+
+@app.teardown_request
+def release_connections(exc=None):
+    """Never leave a pooled connection inside an open transaction"""
+    pool.release()
+
+def request_route() -> str:
+    """Route pattern of this request, so /user/<walletid> is one label, not one per wallet"""
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+    tracing.begin(f'{request.method} {request.path}')
+
+@app.after_request
+def record_request(response):
+    """Count and time every response (streamed bodies: until the first byte)"""
+    start = g.get('request_start')
+    if start is not None:
+        route = request_route()
+        metrics.http_latency.observe(time.perf_counter() - start, route, request.method)
+        metrics.http_requests.inc(route, request.method, response.status_code)
+    trace = tracing.current()
+    if trace is not None:
+        trace.status = response.status_code
+        response.headers['Server-Timing'] = trace.server_timing()
+        # Let the frontends' devtools and Resource Timing see it cross-origin
+        if request.origin in CORS_ORIGINS:
+            response.headers['Timing-Allow-Origin'] = request.origin
+    return response
+
+@app.teardown_request
+def record_exception(exc=None):
+    if exc is not None:
+        metrics.http_exceptions.inc(request_route())
+    tracing.finish(route=request_route(), method=request.method, error=repr(exc) if exc is not None else None)
 
 def init_databases():
     """Initialize both databases with their tables"""
     # Initialize users database
     conn_users = sqlite3.connect(USERS_DB)
+    # WAL lets the endpoints keep reading while the writer commits
+    conn_users.execute('PRAGMA journal_mode=WAL')
     cursor_users = conn_users.cursor()
     cursor_users.execute('''
         CREATE TABLE IF NOT EXISTS users (
@@ -51,9 +117,11 @@ def init_databases():
         pass  # Column already exists
     conn_users.commit()
     conn_users.close()
+    migrate(USERS_DB, USERS_MIGRATIONS)
     
     # Initialize transactions database
     conn_trans = sqlite3.connect(TRANSACTIONS_DB)
+    conn_trans.execute('PRAGMA journal_mode=WAL')
     cursor_trans = conn_trans.cursor()
     cursor_trans.execute('''
         CREATE TABLE IF NOT EXISTS transactions (
@@ -67,9 +135,11 @@ def init_databases():
     ''')
     conn_trans.commit()
     conn_trans.close()
+    migrate(TRANSACTIONS_DB, TRANSACTIONS_MIGRATIONS)
     
     # Initialize daily_scores database for tracking daily leaderboard and prizes
-    conn_daily = sqlite3.connect('daily_scores.db')
+    conn_daily = sqlite3.connect(DAILY_SCORES_DB)
+    conn_daily.execute('PRAGMA journal_mode=WAL')
     cursor_daily = conn_daily.cursor()
     cursor_daily.execute('''
         CREATE TABLE IF NOT EXISTS daily_scores (
@@ -86,92 +156,110 @@ def init_databases():
     ''')
     conn_daily.commit()
     conn_daily.close()
+    migrate(DAILY_SCORES_DB, DAILY_SCORES_MIGRATIONS)
+
+def warm_up():
+    """Build per-worker in-memory state (called once at worker start)"""
+    leaderboard.sync(pool.get(USERS_DB))
+
+def users_version() -> Hashable:
+    """Data version of responses embedding user rows (gameleft depends on the date)"""
+    return (generation(pool.get(USERS_DB), 'users'), date.today().isoformat())
+
+def not_modified(etag: str):
+    """304 for a conditional request that already holds `etag`, else None"""
+    if request.method not in ('GET', 'HEAD') or not request.if_none_match.contains_weak(etag):
+        return None
+    response = app.response_class(status=304)
+    return tag_response(response, etag)
+
+def tag_response(response, etag: str):
+    response.set_etag(etag)
+    # Let browsers keep the body but revalidate on every poll
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def versioned_json(key: Hashable, version: Callable[[], Hashable], build: Callable[[], Dict[str, Any]]):
+    """JSON response for `key` at the current `version()`, with a strong ETag.
+
+    A client that already holds the ETag gets 304 before anything is
+    loaded; otherwise the body comes from the response cache or `build`.
+    The version is read again after building: a body that raced a write is
+    sent as is, but neither cached nor tagged.
+    """
+    current = version()
+    etag = data_etag(key, current)
+    response = not_modified(etag)
+    if response is not None:
+        return response
+    body = response_cache.get(key, current)
+    if body is not None:
+        return tag_response(app.response_class(body, mimetype='application/json'), etag)
+    response = jsonify(build())
+    if version() != current:
+        return response
+    response_cache.put(key, current, response.get_data())
+    return tag_response(response, etag)
+
+def walletid_error(walletid: Any):
+    """400 response if `walletid` is not a valid Qubic identity (see wallet_ids.py), else None"""
+    try:
+        parse_walletid(walletid)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return None
+
+def whole_number(name: str, value: Any) -> Any:
+    """`value` if it is a whole number (amounts and scores, see units.py); ValueError otherwise"""
+    try:
+        to_units(value)
+    except ValueError:
+        raise ValueError(f'{name} must be a whole number') from None
+    return value
+
+def whole_number_error(name: str, value: Any):
+    """400 response if `value` is not a whole number, else None"""
+    try:
+        whole_number(name, value)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return None
 
 def get_user(walletid: str) -> Optional[Dict[str, Any]]:
     """Get user by walletid"""
-    conn = sqlite3.connect(USERS_DB)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM users WHERE walletid = ?', (walletid,))
-    row = cursor.fetchone()
-    conn.close()
+    conn = pool.get(USERS_DB)
+    row = conn.execute(f'SELECT {USER_COLUMNS} FROM users WHERE walletid = ?', (wallet_key(walletid),)).fetchone()
     
     if row:
-        return dict(row)
+        return row_to_user(row)
     return None
 
+def get_users(walletids: List[str]) -> Dict[str, Dict[str, Any]]:
+    """Get several users by walletid in one query"""
+    if not walletids:
+        return {}
+    conn = pool.get(USERS_DB)
+    keys = {wallet_key(walletid): walletid for walletid in walletids}
+    placeholders = ', '.join('?' * len(keys))
+    rows = conn.execute(f'SELECT {USER_COLUMNS} FROM users WHERE walletid IN ({placeholders})', list(keys))
+    return {keys[row['walletid']]: row_to_user(row) for row in rows}
+
 def create_user(walletid: str) -> Dict[str, Any]:
     """Create a new user with default values (free play enabled, no leaderboard access)"""
-    conn = sqlite3.connect(USERS_DB)
-    cursor = conn.cursor()
-    # Check if leaderboard_access column exists
-    try:
-        cursor.execute('''
-            INSERT INTO users (walletid, amount, gameleft, lastplayed, paid, highest, col1, col2, col3, leaderboard_access)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (walletid, '0', '0', '', '0', '0', '', '', '', '0'))
-    except sqlite3.OperationalError:
-        # Fallback if column doesn't exist yet
-        cursor.execute('''
-            INSERT INTO users (walletid, amount, gameleft, lastplayed, paid, highest, col1, col2, col3)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (walletid, '0', '0', '', '0', '0', '', '', ''))
-    conn.commit()
-    conn.close()
-    return get_user(walletid)
-
-def check_and_reset_daily_games(user: Dict[str, Any]) -> Dict[str, Any]:
-    """Check if it's a new day and reset games if needed"""
-    lastplayed_str = user.get('lastplayed', '')
-    if not lastplayed_str:
-        # First time playing, set to 3 games
-        return update_user(user['walletid'], {'gameleft': '3'})
-    
-    try:
-        # Parse lastplayed date
-        lastplayed_date = datetime.fromisoformat(lastplayed_str).date()
-        today = date.today()
-        
-        # If different date, reset games to 3
-        if lastplayed_date != today:
-            current_gameleft = int(user.get('gameleft', '0') or '0')
-            new_gameleft = 3  # Reset to 3 free games
-            return update_user(user['walletid'], {'gameleft': str(new_gameleft)})
-    except (ValueError, AttributeError):
-        # If parsing fails, assume new day and reset
-        return update_user(user['walletid'], {'gameleft': '3'})
-    
-    return user
+    return writer.submit('create_user', walletid)
 
 def update_user(walletid: str, data: Dict[str, Any]) -> Dict[str, Any]:
     """Update user data"""
-    conn = sqlite3.connect(USERS_DB)
-    cursor = conn.cursor()
-    
-    # Build update query dynamically based on provided fields
-    update_fields = []
-    values = []
-    
-    allowed_fields = ['amount', 'gameleft', 'lastplayed', 'paid', 'highest', 'col1', 'col2', 'col3', 'leaderboard_access']
-    for field in allowed_fields:
-        if field in data:
-            update_fields.append(f'{field} = ?')
-            values.append(str(data[field]))
-    
-    if not update_fields:
-        conn.close()
-        return get_user(walletid)
-    
-    values.append(walletid)
-    query = f'UPDATE users SET {", ".join(update_fields)} WHERE walletid = ?'
-    cursor.execute(query, values)
-    conn.commit()
-    conn.close()
-    return get_user(walletid)
+    user = writer.submit('update_user', walletid, data)
+    if user and ('amount' in data or 'leaderboard_access' in data):
+        leaderboard.apply(walletid, to_units(user['amount']), user['leaderboard_access'])
+        broadcaster.notify()
+    return user
 
 @app.route('/get_user', methods=['GET', 'POST'])
 def get_user_endpoint():
-    """Get user info or create new user if doesn't exist. Automatically checks and resets daily games."""
+    """Get user info or create new user if doesn't exist. Read-only for existing users:
+    the daily free games are derived from games_day (see store.games_left)."""
     try:
         if request.method == 'POST':
             data = request.get_json()
@@ -181,16 +269,25 @@ def get_user_endpoint():
         
         if not walletid:
             return jsonify({'error': 'walletid is required'}), 400
+        error = walletid_error(walletid)
+        if error:
+            return error
+        
+        current = users_version()
+        etag = data_etag(('get_user', walletid), current)
+        response = not_modified(etag)
+        if response is not None:
+            return response
         
         user = get_user(walletid)
         if not user:
             user = create_user(walletid)
             return jsonify({'user': user, 'created': True}), 200
         
-        # Check and reset daily games if needed
-        user = check_and_reset_daily_games(user)
-        
-        return jsonify({'user': user, 'created': False}), 200
+        response = jsonify({'user': user, 'created': False})
+        if users_version() == current:
+            tag_response(response, etag)
+        return response
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -205,9 +302,16 @@ def update_user_endpoint():
         walletid = data.get('walletid')
         if not walletid:
             return jsonify({'error': 'walletid is required'}), 400
+        error = walletid_error(walletid)
+        if error:
+            return error
         
         # Remove walletid from update data
         update_data = {k: v for k, v in data.items() if k != 'walletid'}
+        for field in ('amount', 'paid'):
+            error = field in update_data and whole_number_error(field, update_data[field])
+            if error:
+                return error
         
         user = update_user(walletid, update_data)
         if not user:
@@ -217,6 +321,49 @@ def update_user_endpoint():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def build_leaderboard(walletid: Optional[str]) -> Dict[str, Any]:
+    """Top 100 users with leaderboard access, their total and the ranking of `walletid`"""
+    conn = pool.get(USERS_DB)
+    # Catch up with score changes made by other workers
+    leaderboard.sync(conn)
+    
+    # Get total users count (only those with leaderboard access)
+    total_users = len(leaderboard)
+    
+    # Get top 100 users sorted by amount (descending) - only those with leaderboard access
+    top_ids = [walletid for walletid, _ in leaderboard.top(100)]
+    top_rows = get_users(top_ids)
+    top_users = [top_rows[walletid] for walletid in top_ids if walletid in top_rows]
+    
+    # Get user ranking if walletid provided (only among paid users)
+    user_ranking = None
+    if walletid:
+        user = get_user(walletid)
+        if user and user.get('leaderboard_access', '0') == '1':
+            user_ranking = leaderboard.rank(walletid)
+            if user_ranking is None:
+                # Access granted after our last sync
+                # Only current-season amounts can beat it (a past season's count as 0)
+                rank_result = conn.execute(f'''
+                    SELECT COUNT(*) + 1 as rank
+                    FROM users
+                    WHERE leaderboard_access = '1' AND amount_season = {CURRENT_SEASON}
+                      AND amount > (SELECT {SEASON_AMOUNT} FROM users WHERE walletid = ?)
+                ''', (wallet_key(walletid),)).fetchone()
+                if rank_result:
+                    user_ranking = rank_result['rank']
+            
+            user_ranking = {
+                'rank': user_ranking or 1,
+                'user': user
+            }
+    
+    return {
+        'top_users': top_users,
+        'total_users': total_users,
+        'user_ranking': user_ranking
+    }
+
 @app.route('/leaderboard', methods=['GET', 'POST'])
 def leaderboard_endpoint():
     """Get leaderboard with top 100 users who have paid for access, total users, and user ranking"""
@@ -227,50 +374,105 @@ def leaderboard_endpoint():
             walletid = data.get('walletid') if data else None
         else:
             walletid = request.args.get('walletid')
-        
-        conn = sqlite3.connect(USERS_DB)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        
-        # Get total users count (only those with leaderboard access)
-        cursor.execute('SELECT COUNT(*) as total FROM users WHERE leaderboard_access = "1"')
-        total_users = cursor.fetchone()['total']
-        
-        # Get top 100 users sorted by amount (descending) - only those with leaderboard access
-        cursor.execute('''
-            SELECT walletid, amount, gameleft, lastplayed, paid, highest, col1, col2, col3, leaderboard_access
-            FROM users
-            WHERE leaderboard_access = "1"
-            ORDER BY CAST(amount AS REAL) DESC
-            LIMIT 100
-        ''')
-        top_users = [dict(row) for row in cursor.fetchall()]
-        
-        # Get user ranking if walletid provided (only among paid users)
-        user_ranking = None
         if walletid:
-            user = get_user(walletid)
-            if user and user.get('leaderboard_access', '0') == '1':
-                cursor.execute('''
-                    SELECT COUNT(*) + 1 as rank
-                    FROM users
-                    WHERE leaderboard_access = "1" AND CAST(amount AS REAL) > (SELECT CAST(amount AS REAL) FROM users WHERE walletid = ?)
-                ''', (walletid,))
-                rank_result = cursor.fetchone()
-                if rank_result:
-                    user_ranking = rank_result['rank']
-                
-                user_ranking = {
-                    'rank': user_ranking or 1,
-                    'user': user
-                }
-        
-        conn.close()
+            error = walletid_error(walletid)
+            if error:
+                return error
         
+        return versioned_json(('leaderboard', walletid), users_version, lambda: build_leaderboard(walletid))
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/leaderboard/stream', methods=['GET'])
+def leaderboard_stream_endpoint():
+    """Server-Sent Events: a snapshot of the top N, then `top` diffs and `rank` changes"""
+    try:
+        top = int(request.args.get('top', DEFAULT_TOP))
+    except ValueError:
+        return jsonify({'error': 'top must be an integer'}), 400
+    top = max(1, min(top, MAX_TOP))
+    walletid = request.args.get('walletid')
+    if walletid:
+        error = walletid_error(walletid)
+        if error:
+            return error
+    
+    subscription = broadcaster.subscribe(walletid, top)
+    
+    def events():
+        try:
+            # Tell EventSource how long to wait before reconnecting
+            yield 'retry: 3000\n\n'
+            while not subscription.closed:
+                message = subscription.next()
+                yield message if message is not None else ': keepalive\n\n'
+        finally:
+            broadcaster.unsubscribe(subscription)
+    
+    return Response(stream_with_context(events()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        # Stop nginx from buffering the stream
+        'X-Accel-Buffering': 'no',
+    })
+
+@app.route('/leaderboard/snapshots', methods=['GET'])
+def snapshots_endpoint():
+    """List the leaderboard snapshots (season ends and periodic), oldest first"""
+    try:
+        snapshots = [snapshot_store.get(name).meta for name in snapshot_store.names()]
         return jsonify({
-            'top_users': top_users,
-            'total_users': total_users,
-            'user_ranking': user_ranking
+            'success': True,
+            'snapshots': sorted(snapshots, key=lambda meta: meta['created'])
+        }), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/leaderboard/snapshots/<name>', methods=['GET'])
+def snapshot_top_endpoint(name: str):
+    """Top N of a leaderboard snapshot"""
+    try:
+        limit = int(request.args.get('limit', 100))
+    except ValueError:
+        return jsonify({'error': 'limit must be an integer'}), 400
+    limit = max(1, min(limit, SNAPSHOT_MAX_TOP))
+    try:
+        snapshot = snapshot_store.get(name)
+        if snapshot is None:
+            return jsonify({'error': 'Snapshot not found'}), 404
+        top_users = []
+        for position, (walletid, amount) in enumerate(snapshot.top(limit)):
+            if position == 0 or amount != top_users[-1]['units']:
+                rank = position + 1
+            top_users.append({'rank': rank, 'walletid': walletid, 'units': amount})
+        for entry in top_users:
+            entry['amount'] = format_number(from_units(entry.pop('units')))
+        return jsonify({'success': True, 'snapshot': snapshot.meta, 'top_users': top_users}), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/leaderboard/snapshots/<name>/rank', methods=['GET'])
+def snapshot_rank_endpoint(name: str):
+    """A wallet's rank and amount in a leaderboard snapshot"""
+    walletid = request.args.get('walletid')
+    if not walletid:
+        return jsonify({'error': 'walletid is required'}), 400
+    error = walletid_error(walletid)
+    if error:
+        return error
+    try:
+        snapshot = snapshot_store.get(name)
+        if snapshot is None:
+            return jsonify({'error': 'Snapshot not found'}), 404
+        found = snapshot.rank(walletid)
+        if found is None:
+            return jsonify({'error': 'Wallet not in snapshot'}), 404
+        rank, amount = found
+        return jsonify({
+            'success': True,
+            'snapshot': snapshot.meta,
+            'walletid': walletid,
+            'rank': rank,
+            'amount': format_number(from_units(amount))
         }), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -291,69 +493,77 @@ def transaction_endpoint():
         
         if not walletid or not tx_hash or paid_amount is None:
             return jsonify({'error': 'walletid, hash, and paid are required'}), 400
+        error = walletid_error(walletid) or whole_number_error('paid', paid_amount)
+        if error:
+            return error
         
         # Convert paid_amount to string for storage
         paid_amount_str = str(paid_amount)
-        paid_amount_float = float(paid_amount)
         
-        # Save transaction
-        conn_trans = sqlite3.connect(TRANSACTIONS_DB)
-        cursor_trans = conn_trans.cursor()
-        cursor_trans.execute('''
-            INSERT INTO transactions (walletid, hash, paid, col1, col2)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (walletid, tx_hash, paid_amount_str, col1, col2))
-        conn_trans.commit()
-        conn_trans.close()
-        
-        # Get or create user
-        user = get_user(walletid)
-        if not user:
-            user = create_user(walletid)
-        
-        # Check transaction type
-        LEADERBOARD_PRICE = 10000  # 10000 QXMR for leaderboard access
-        GAME_PRICE = 500000  # Old game purchase price (deprecated but kept for compatibility)
-        
-        update_data = {}
-        leaderboard_access_granted = False
-        
-        # Check if this is a leaderboard payment
-        if col1 == 'leaderboard_payment' and paid_amount_float >= LEADERBOARD_PRICE:
-            # Grant leaderboard access
-            update_data['leaderboard_access'] = '1'
-            leaderboard_access_granted = True
-            # Increment paid amount
-            current_paid = float(user.get('paid', '0') or '0')
-            new_paid = current_paid + paid_amount_float
-            update_data['paid'] = str(new_paid)
-        # Legacy: Check if this is a game purchase (deprecated - games are now free)
-        elif col1 == 'game_purchase' and paid_amount_float >= GAME_PRICE:
-            games_purchased = int(paid_amount_float / GAME_PRICE)
-            current_gameleft = int(user.get('gameleft', '0') or '0')
-            new_gameleft = current_gameleft + games_purchased
-            update_data['gameleft'] = str(new_gameleft)
-            current_paid = float(user.get('paid', '0') or '0')
-            new_paid = current_paid + paid_amount_float
-            update_data['paid'] = str(new_paid)
-        else:
-            # Generic payment - just increment paid amount
-            current_paid = float(user.get('paid', '0') or '0')
-            new_paid = current_paid + paid_amount_float
-            update_data['paid'] = str(new_paid)
-        
-        if update_data:
-            update_user(walletid, update_data)
+        # Save transaction and credit the user in one writer command
+        result = writer.submit('save_transaction', walletid, tx_hash, paid_amount_str, col1, col2)
+        if result.get('conflict'):
+            return jsonify({'error': 'Transaction hash already recorded for another wallet'}), 409
+        if not result['duplicate']:
+            user = result['user']
+            leaderboard.apply(walletid, to_units(user['amount']), user['leaderboard_access'])
+            broadcaster.notify()
         
         return jsonify({
             'success': True,
-            'transaction_saved': True,
-            'leaderboard_access_granted': leaderboard_access_granted,
-            'user_paid_updated': update_data.get('paid', user.get('paid', '0'))
+            'transaction_saved': not result['duplicate'],
+            'duplicate': result['duplicate'],
+            'leaderboard_access_granted': result['leaderboard_access_granted'],
+            'user_paid_updated': result['user_paid_updated']
         }), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# A wallet's transactions, newest first, from idx_transactions_walletid
+TRANSACTIONS_OF_WALLET = KeysetQuery('transactions', TRANSACTION_COLUMNS, ('id',), where='walletid = ?')
+
+@app.route('/transaction/<tx_hash>', methods=['GET'])
+def transaction_by_hash_endpoint(tx_hash: str):
+    """Look up one transaction by hash (idx_transactions_hash)"""
+    try:
+        row = pool.get(TRANSACTIONS_DB).execute(
+            f'SELECT {TRANSACTION_COLUMNS} FROM transactions WHERE hash = ?', (tx_hash,)
+        ).fetchone()
+        if row is None:
+            return jsonify({'error': 'Transaction not found'}), 404
+        return jsonify({'success': True, 'transaction': row_to_transaction(row)}), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/transactions', methods=['GET'])
+def wallet_transactions_endpoint():
+    """A wallet's transactions, newest first, a page at a time (?limit=&cursor=)"""
+    walletid = request.args.get('walletid')
+    if not walletid:
+        return jsonify({'error': 'walletid is required'}), 400
+    error = walletid_error(walletid)
+    if error:
+        return error
+    try:
+        limit = int(request.args.get('limit', PAGE_SIZE))
+    except ValueError:
+        return jsonify({'error': 'limit must be an integer'}), 400
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        return jsonify({'error': f'limit must be between 1 and {MAX_PAGE_SIZE}'}), 400
+    try:
+        rows, next_cursor = TRANSACTIONS_OF_WALLET.page(pool.get(TRANSACTIONS_DB), request.args.get('cursor') or None,
+                                                        limit, (wallet_key(walletid),))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    return jsonify({
+        'success': True,
+        'walletid': walletid,
+        'transactions': [row_to_transaction(row) for row in rows],
+        'next_cursor': next_cursor
+    }), 200
+
 @app.route('/start_game', methods=['POST'])
 def start_game_endpoint():
     """Allow free play - no gameleft check needed"""
@@ -365,6 +575,9 @@ def start_game_endpoint():
         walletid = data.get('walletid')
         if not walletid:
             return jsonify({'error': 'walletid is required'}), 400
+        error = walletid_error(walletid)
+        if error:
+            return error
         
         # Get or create user
         user = get_user(walletid)
@@ -393,72 +606,66 @@ def update_game_score_endpoint():
         
         if not walletid or score is None:
             return jsonify({'error': 'walletid and score are required'}), 400
+        error = walletid_error(walletid) or whole_number_error('score', score)
+        if error:
+            return error
         
-        # Get current user
-        user = get_user(walletid)
-        if not user:
-            user = create_user(walletid)
+        result = writer.submit('update_game_score', walletid, float(score))
+        updated_user = result['user']
+        leaderboard.apply(walletid, to_units(updated_user['amount']), updated_user['leaderboard_access'])
+        # Push the new standings to /leaderboard/stream subscribers now
+        broadcaster.notify()
         
-        # Check if user has leaderboard access
-        leaderboard_access = user.get('leaderboard_access', '0') or '0'
-        has_access = leaderboard_access == '1'
-        
-        # Always update highest score locally
-        current_highest = float(user.get('highest', '0') or '0')
-        new_highest = max(current_highest, float(score))
-
-        #Always get gameleft
-        current_gameleft = int(user.get('gameleft', '0') or '0')
-        
-        update_data = {
-            'highest': str(new_highest)
-        }
-        
-        # Only update amount (leaderboard score) if user has paid for access
-        if has_access and current_gameleft:
+        return jsonify({
+            'success': True,
+            'user': updated_user,
+            'leaderboard_updated': result['leaderboard_updated']
+        }), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
 
-            # Update lastplayed timestamp
-            lastplayed = datetime.now().isoformat()
-            update_data['lastplayed'] = lastplayed
+# Largest number of scores accepted by /update_game_scores
+MAX_SCORE_BATCH = 1000
 
-            current_amount = float(user.get('amount', '0') or '0')
-            new_amount = max(current_amount, float(score))
-            update_data['amount'] = str(new_amount)
-            
-            new_gameleft = current_gameleft - 1
-            update_data['gameleft'] = str(new_gameleft)
-
-            # Also save to daily_scores for daily prize calculation
-            # We track each game score separately, then sum them for daily totals
-            today = date.today().isoformat()
-            conn_daily = sqlite3.connect('daily_scores.db')
-            cursor_daily = conn_daily.cursor()
-            # Insert a new row for this game score (we'll sum them when querying)
-            cursor_daily.execute(
-                '''
-                INSERT INTO daily_scores (walletid, score_date, score)
-                VALUES (?, ?, ?)
-                ON CONFLICT(walletid, score_date)
-                DO UPDATE SET score = CASE
-                    WHEN excluded.score > daily_scores.score THEN excluded.score
-                    ELSE daily_scores.score
-                END
-                ''',
-                (walletid, today, float(score)),
-            )
-            conn_daily.commit()
-            conn_daily.close()
-        else:
-            # User played for free but doesn't have leaderboard access
-            # Still update highest for their personal record
-            pass
-        
-        updated_user = update_user(walletid, update_data)
+@app.route('/update_game_scores', methods=['POST'])
+def update_game_scores_endpoint():
+    """Update many scores at once: {"scores": [{"walletid": ..., "score": ...}, ...]}.
+    Same rules as /update_game_score, applied in order in one transaction."""
+    try:
+        data = request.get_json()
+        items = data.get('scores') if isinstance(data, dict) else data
+        if not isinstance(items, list):
+            return jsonify({'error': 'scores must be an array of {walletid, score}'}), 400
+        if len(items) > MAX_SCORE_BATCH:
+            return jsonify({'error': f'At most {MAX_SCORE_BATCH} scores per request'}), 400
+        
+        results: List[Optional[Dict[str, Any]]] = [None] * len(items)
+        valid = []
+        for index, item in enumerate(items):
+            walletid = item.get('walletid') if isinstance(item, dict) else None
+            score = item.get('score') if isinstance(item, dict) else None
+            try:
+                if not walletid or score is None:
+                    raise ValueError('walletid and score are required')
+                valid.append((index, parse_walletid(walletid), float(whole_number('score', score))))
+            except (TypeError, ValueError) as e:
+                results[index] = {'index': index, 'success': False, 'error': str(e)}
+        
+        if valid:
+            applied = writer.submit('update_game_scores', [(walletid, score) for _, walletid, score in valid])
+            final = {}
+            for (index, _, _), result in zip(valid, applied):
+                results[index] = dict(result, index=index, success=True)
+                final[result['walletid']] = result['user']
+            for walletid, user in final.items():
+                leaderboard.apply(walletid, to_units(user['amount']), user['leaderboard_access'])
+            broadcaster.notify()
         
         return jsonify({
             'success': True,
-            'user': updated_user,
-            'leaderboard_updated': has_access
+            'applied': len(valid),
+            'failed': len(items) - len(valid),
+            'results': results
         }), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -477,82 +684,129 @@ def buy_games_endpoint():
         
         if not walletid:
             return jsonify({'error': 'walletid is required'}), 400
+        error = walletid_error(walletid) or whole_number_error('paid', paid_amount)
+        if error:
+            return error
         
         # Calculate total paid amount
         total_paid = float(paid_amount) * int(games_to_buy)
         
-        # Get current user
-        user = get_user(walletid)
-        if not user:
-            user = create_user(walletid)
-        
-        # Increment gameleft
-        current_gameleft = int(user.get('gameleft', '0') or '0')
-        new_gameleft = current_gameleft + int(games_to_buy)
-        
-        # Increment paid amount
-        current_paid = float(user.get('paid', '0') or '0')
-        new_paid = current_paid + total_paid
-        
-        # Update user
-        updated_user = update_user(walletid, {
-            'gameleft': str(new_gameleft),
-            'paid': str(new_paid)
-        })
+        result = writer.submit('buy_games', walletid, int(games_to_buy), total_paid)
         
         return jsonify({
             'success': True,
             'games_added': int(games_to_buy),
             'total_paid': total_paid,
-            'games_remaining': new_gameleft,
-            'user': updated_user
+            'games_remaining': result['games_remaining'],
+            'user': result['user']
         }), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
+def daily_version(target_date: str) -> Hashable:
+    """Data version of a per-date response: only the embedded users once the date is final"""
+    if is_final(target_date):
+        return users_version()
+    return (generation(pool.get(DAILY_SCORES_DB), 'daily_scores'), users_version())
+
+def build_daily_winner(target_date: str) -> Dict[str, Any]:
+    """The daily winner (highest score of the day) for `target_date`"""
+    winner = daily_rankings.winner(pool.get(DAILY_SCORES_DB), target_date)
+    
+    if winner:
+        walletid, score = winner
+        return {
+            'success': True,
+            'winner': {
+                'walletid': walletid,
+                'score': score,
+                'user': get_user(walletid)
+            },
+            'date': target_date,
+            'prize_amount': PRIZE_AMOUNT
+        }
+    else:
+        return {
+            'success': True,
+            'winner': None,
+            'date': target_date,
+            'prize_amount': PRIZE_AMOUNT
+        }
+
+def build_daily_top(target_date: str, limit: int) -> Dict[str, Any]:
+    """The `limit` best scores of `target_date` with their users"""
+    ranking = daily_rankings.top(pool.get(DAILY_SCORES_DB), target_date, limit)
+    users = get_users([walletid for walletid, _ in ranking])
+    return {
+        'success': True,
+        'date': target_date,
+        'top': [
+            {'rank': rank, 'walletid': walletid, 'score': score, 'user': users.get(walletid)}
+            for rank, (walletid, score) in enumerate(ranking, 1)
+        ],
+        'prize_amount': PRIZE_AMOUNT
+    }
+
 @app.route('/daily_winner', methods=['GET'])
 def daily_winner_endpoint():
     """Get the daily winner (highest score of the day)"""
     try:
         target_date = request.args.get('date', date.today().isoformat())
-        
-        conn_daily = sqlite3.connect('daily_scores.db')
-        conn_daily.row_factory = sqlite3.Row
-        cursor_daily = conn_daily.cursor()
-        
-        # Get highest score for the date (sum of all scores for each user on that day)
-        cursor_daily.execute('''
-            SELECT walletid, SUM(score) as total_score
-            FROM daily_scores
-            WHERE score_date = ?
-            GROUP BY walletid
-            ORDER BY total_score DESC
-            LIMIT 1
-        ''', (target_date,))
-        
-        winner = cursor_daily.fetchone()
-        conn_daily.close()
-        
-        if winner:
-            user = get_user(winner['walletid'])
-            return jsonify({
-                'success': True,
-                'winner': {
-                    'walletid': winner['walletid'],
-                    'score': winner['total_score'],
-                    'user': user
-                },
-                'date': target_date,
-                'prize_amount': 1000000  # 1,000,000 Qubic
-            }), 200
+        return versioned_json(('daily_winner', target_date), lambda: daily_version(target_date),
+                              lambda: build_daily_winner(target_date))
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/daily_top', methods=['GET'])
+def daily_top_endpoint():
+    """Get the best scores of a day"""
+    try:
+        target_date = request.args.get('date', date.today().isoformat())
+        try:
+            limit = int(request.args.get('limit', DAILY_DEFAULT_TOP))
+        except ValueError:
+            return jsonify({'error': 'limit must be an integer'}), 400
+        limit = max(1, min(limit, DAILY_MAX_TOP))
+        return versioned_json(('daily_top', target_date, limit), lambda: daily_version(target_date),
+                              lambda: build_daily_top(target_date, limit))
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+def winner_pages(first: str, last: str):
+    """Pages of daily winners from `first` to `last`, each page's users loaded in one query"""
+    for rows in winners_between(pool.get(DAILY_SCORES_DB), first, last):
+        walletids = [wallet_id(row['walletid']) for row in rows]
+        users = get_users(walletids)
+        yield [{
+            'date': row['score_date'],
+            'walletid': walletid,
+            'score': row['score'],
+            'user': users.get(walletid)
+        } for row, walletid in zip(rows, walletids)]
+
+@app.route('/daily_winners', methods=['GET'])
+def daily_winners_endpoint():
+    """Get the winner of every day from `from` to `to` (inclusive), streamed"""
+    try:
+        last = request.args.get('to', date.today().isoformat())
+        first = request.args.get('from', last)
+        export = request.args.get('format')
+        try:
+            if date.fromisoformat(first) > date.fromisoformat(last):
+                return jsonify({'error': 'from must not be after to'}), 400
+        except ValueError:
+            return jsonify({'error': 'from and to must be dates (YYYY-MM-DD)'}), 400
+        if export not in (None, 'json', 'ndjson'):
+            return jsonify({'error': 'format must be json or ndjson'}), 400
+        
+        pages = winner_pages(first, last)
+        if export == 'ndjson':
+            chunks, mimetype = ndjson_chunks(pages, dict, app.json.dumps), 'application/x-ndjson'
         else:
-            return jsonify({
-                'success': True,
-                'winner': None,
-                'date': target_date,
-                'prize_amount': 1000000
-            }), 200
+            head = {'success': True, 'from': first, 'to': last, 'prize_amount': PRIZE_AMOUNT}
+            chunks, mimetype = json_chunks('winners', pages, dict, app.json.dumps, head), 'application/json'
+        return Response(stream_with_context(chunks), mimetype=mimetype)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -561,49 +815,194 @@ def health_check():
     """Health check endpoint"""
     return jsonify({'status': 'ok'}), 200
 
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Prometheus metrics of every worker (see metrics.py)"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/admin/db-stats', methods=['GET'])
+def db_stats():
+    """Connection pool counters for the worker that served this request"""
+    return jsonify(pool.stats()), 200
+
+@app.route('/admin/sql-profile', methods=['GET'])
+def sql_profile():
+    """Heaviest SQLite statements and the slow log of the worker that served this request
+    (QXMR_SQL_PROFILE=1, see sql_profiler.py); ?explain=1 adds their query plans"""
+    order = request.args.get('order', 'seconds')
+    if order not in SQL_PROFILE_ORDERS:
+        return jsonify({'error': f"order must be one of {', '.join(SQL_PROFILE_ORDERS)}"}), 400
+    try:
+        top = int(request.args.get('top', 20))
+    except ValueError:
+        return jsonify({'error': 'top must be an integer'}), 400
+    if not 1 <= top <= 100:
+        return jsonify({'error': 'top must be between 1 and 100'}), 400
+    return jsonify(sql_profiler.report(top, order, request.args.get('explain') == '1')), 200
+
+@app.route('/admin/profiles', methods=['GET'])
+def list_profiles():
+    """Request profiles captured by any worker, newest first (see profiling.py)"""
+    return jsonify({'enabled': PROFILE_ENABLED, 'profiles': profile_store.list()}), 200
+
+@app.route('/admin/profiles/<name>', methods=['GET'])
+def get_profile(name):
+    """A captured profile as a pstats file, or with ?format=text as a report
+    (?sort=cumulative|tottime|calls|ncalls, ?limit= functions)"""
+    if profile_store.meta(name) is None:
+        return jsonify({'error': 'Profile not found'}), 404
+    if request.args.get('format') != 'text':
+        return send_file(os.path.abspath(profile_store.path(name)), mimetype='application/octet-stream',
+                         as_attachment=True, download_name=name + '.pstats')
+    sort = request.args.get('sort', 'cumulative')
+    if sort not in PROFILE_SORT_KEYS:
+        return jsonify({'error': f"sort must be one of {', '.join(PROFILE_SORT_KEYS)}"}), 400
+    try:
+        limit = int(request.args.get('limit', 50))
+    except ValueError:
+        return jsonify({'error': 'limit must be an integer'}), 400
+    return Response(profile_store.report(name, sort, limit), mimetype='text/plain')
+
+@app.route('/admin/cache-stats', methods=['GET'])
+def cache_stats():
+    """Response cache counters for the worker that served this request"""
+    return jsonify(dict(response_cache.stats(), daily_rankings=daily_rankings.stats())), 200
+
+@app.route('/admin/stream-stats', methods=['GET'])
+def stream_stats():
+    """Open /leaderboard/stream subscribers and events sent by this worker"""
+    return jsonify(broadcaster.stats()), 200
+
+@app.route('/admin/writer-stats', methods=['GET'])
+def writer_stats():
+    """Group commit counters: batches, batch sizes and queue depth"""
+    try:
+        return jsonify(writer.stats()), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 # Admin endpoints
+USERS_BY_AMOUNT = KeysetQuery('users', USER_COLUMNS, ('amount', 'walletid'))
+# While past-season amounts are not all cleared: the same order by the amount that counts
+# (a sort instead of idx_users_amount, with the same cursors)
+USERS_BY_SEASON_AMOUNT = KeysetQuery(
+    'users', USER_COLUMNS.replace('amount,', f'{SEASON_AMOUNT} AS amount,', 1), ('amount', 'walletid'),
+    key_sql=(SEASON_AMOUNT, 'walletid'),
+)
+TRANSACTIONS_BY_ID = KeysetQuery('transactions', TRANSACTION_COLUMNS, ('id',))
+
+def admin_listing(name: str, path: str, query: KeysetQuery, convert: Callable, fields: List[str]):
+    """Serve a table page by page (?limit=&cursor=), as an export (?format=ndjson|csv)
+    or, without parameters, as the original {"<name>": [...]} body, streamed"""
+    cursor = request.args.get('cursor') or None
+    export = request.args.get('format')
+    try:
+        limit = int(request.args.get('limit', PAGE_SIZE))
+    except ValueError:
+        return jsonify({'error': 'limit must be an integer'}), 400
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        return jsonify({'error': f'limit must be between 1 and {MAX_PAGE_SIZE}'}), 400
+    if export not in (None, 'json', 'ndjson', 'csv'):
+        return jsonify({'error': 'format must be json, ndjson or csv'}), 400
+    
+    conn = pool.get(path)
+    try:
+        if export is None and ('limit' in request.args or cursor):
+            rows, next_cursor = query.page(conn, cursor, limit)
+            return jsonify({name: [convert(row) for row in rows], 'next_cursor': next_cursor}), 200
+        if cursor:
+            # Check it now: errors cannot be reported once streaming started
+            decode_cursor(cursor, len(query.key))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    pages = query.pages(conn, cursor)
+    if export == 'ndjson':
+        chunks, mimetype = ndjson_chunks(pages, convert, app.json.dumps), 'application/x-ndjson'
+    elif export == 'csv':
+        chunks, mimetype = csv_chunks(fields, pages, convert), 'text/csv'
+    else:
+        chunks, mimetype = json_chunks(name, pages, convert, app.json.dumps), 'application/json'
+    response = Response(stream_with_context(chunks), mimetype=mimetype)
+    if export in ('ndjson', 'csv'):
+        response.headers['Content-Disposition'] = f'attachment; filename={name}.{export}'
+    return response
+
 @app.route('/admin/users', methods=['GET'])
 def get_all_users():
-    """Get all users from the database"""
-    try:
-        conn = sqlite3.connect(USERS_DB)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM users ORDER BY CAST(amount AS REAL) DESC')
-        users = [dict(row) for row in cursor.fetchall()]
-        conn.close()
-        return jsonify({'users': users}), 200
+    """Get users from the database, highest amount first (see admin_listing)"""
+    try:
+        query = USERS_BY_SEASON_AMOUNT if has_stale_amounts(pool.get(USERS_DB)) else USERS_BY_AMOUNT
+        return admin_listing('users', USERS_DB, query, row_to_user, USER_FIELDS)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @app.route('/admin/transactions', methods=['GET'])
 def get_all_transactions():
-    """Get all transactions from the database"""
-    try:
-        conn = sqlite3.connect(TRANSACTIONS_DB)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM transactions ORDER BY id DESC')
-        transactions = [dict(row) for row in cursor.fetchall()]
-        conn.close()
-        return jsonify({'transactions': transactions}), 200
+    """Get transactions from the database, newest first (see admin_listing)"""
+    try:
+        return admin_listing('transactions', TRANSACTIONS_DB, TRANSACTIONS_BY_ID, row_to_transaction,
+                             TRANSACTION_COLUMNS.split(', '))
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# Wallets credited more than once for a transaction hash before the unique index
+DUPLICATE_CREDITS = '''
+    SELECT walletid, COUNT(*) AS duplicates, SUM(paid) AS extra_paid,
+           SUM(col1 = 'leaderboard_payment') AS leaderboard_payments,
+           SUM(col1 = 'game_purchase') AS game_purchases, GROUP_CONCAT(hash) AS hashes
+    FROM transactions_duplicates
+    GROUP BY walletid
+    ORDER BY extra_paid DESC, walletid
+'''
+
+@app.route('/admin/duplicate-credits', methods=['GET'])
+def duplicate_credits():
+    """Wallets whose paid (and games or access) still include transactions credited twice,
+    moved to transactions_duplicates by the unique hash migration, to correct with /update_user"""
+    try:
+        rows = pool.get(TRANSACTIONS_DB).execute(DUPLICATE_CREDITS).fetchall()
+        walletids = [wallet_id(row['walletid']) for row in rows]
+        users = get_users(walletids)
+        return jsonify({'wallets': [{
+            'walletid': walletid,
+            'duplicates': row['duplicates'],
+            'extra_paid': format_units(row['extra_paid']),
+            'leaderboard_payments': row['leaderboard_payments'],
+            'game_purchases': row['game_purchases'],
+            'hashes': sorted(set(row['hashes'].split(','))),
+            'user_paid': users[walletid]['paid'] if walletid in users else None,
+        } for row, walletid in zip(rows, walletids)]}), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/admin/settle-prizes', methods=['POST'])
+def settle_prizes_endpoint():
+    """Pay out every pending daily prize and write the payout manifest (see settlement.py)"""
+    try:
+        data = request.get_json(silent=True) or {}
+        through = data.get('through')
+        if through is not None:
+            try:
+                date.fromisoformat(through)
+            except (TypeError, ValueError):
+                return jsonify({'error': 'through must be a date (YYYY-MM-DD)'}), 400
+        result = writer.submit('settle_prizes', through, bool(data.get('dry_run', False)))
+        return jsonify(result), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @app.route('/admin/reset-balances', methods=['POST'])
 def reset_all_balances():
-    """Reset all users' balances to 0"""
-    try:
-        conn = sqlite3.connect(USERS_DB)
-        cursor = conn.cursor()
-        cursor.execute('UPDATE users SET amount = ?', ('0',))
-        conn.commit()
-        affected_rows = cursor.rowcount
-        conn.close()
+    """Reset all users' balances to 0 by starting a new season"""
+    try:
+        result = writer.submit('reset_balances')
+        leaderboard.sync(pool.get(USERS_DB))
+        broadcaster.notify()
         return jsonify({
             'success': True,
-            'message': f'Reset {affected_rows} users\' balances to 0',
-            'affected_rows': affected_rows
+            'message': f"Started season {result['season']}: all balances are now 0",
+            'season': result['season']
         }), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -612,6 +1011,7 @@ if __name__ == '__main__':
     # Initialize databases on startup
     init_databases()
     print("Databases initialized successfully!")
+    warm_up()
     print("Starting Flask server on http://localhost:5000")
     app.run(debug=True, port=5000)
 
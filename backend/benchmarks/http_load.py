@@ -0,0 +1,315 @@
+"""
+HTTP load test: throughput and tail latency per endpoint under a mixed load.
+
+Starts gunicorn with gunicorn_config.py on throwaway databases, registers
+--wallets players (leaderboard payment plus a first score), then runs
+--clients concurrent keep-alive clients for --duration seconds. Each
+request is drawn from --mix: /get_user polling, /update_game_score,
+/leaderboard, /transaction and the paged admin listings. Requests made
+during the first --warmup seconds are not counted. Reports requests per
+second, errors and p50/p95/p99/max latency per endpoint.
+
+    python benchmarks/http_load.py --workers 4 --clients 64 --duration 30 --output run.json
+    python benchmarks/http_load.py --baseline run.json
+
+--output saves the result as a JSON baseline. With --baseline, each
+endpoint's p95 and throughput are compared with that file, and any that
+got worse by more than --tolerance percent is reported. The exit status
+is then 1. The load generator is a single asyncio process, so keep it
+on a different core from the workers when comparing runs.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from typing import Callable, Dict, List, Optional, Tuple
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONFIG = os.path.join(BACKEND, 'gunicorn_config.py')
+
+sys.path.insert(0, BACKEND)
+
+from wallet_ids import wallet_id  # noqa: E402
+
+DEFAULT_MIX = 'get_user=40,update_game_score=25,leaderboard=20,transaction=10,admin_users=3,admin_transactions=2'
+
+
+def post(base: str, path: str, data: Dict) -> Dict:
+    request = urllib.request.Request(base + path, data=json.dumps(data).encode(),
+                                     headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request, timeout=30) as response:
+        return json.load(response)
+
+
+def get(base: str, path: str) -> Dict:
+    with urllib.request.urlopen(base + path, timeout=30) as response:
+        return json.load(response)
+
+
+def start_server(tmp: str, port: int, workers: int, sidecar: bool) -> subprocess.Popen:
+    env = dict(os.environ)
+    env['QXMR_WRITER_SOCKET'] = os.path.join(tmp, 'writer.sock') if sidecar else ''
+    process = subprocess.Popen([
+        sys.executable, '-m', 'gunicorn', '-c', CONFIG,
+        '--chdir', tmp, '--pythonpath', BACKEND,
+        '-w', str(workers),
+        '-b', f'127.0.0.1:{port}', '--pid', os.path.join(tmp, 'gunicorn.pid'),
+        '--access-logfile', '/dev/null', '--error-logfile', os.path.join(tmp, 'error.log'),
+        'wsgi:application',
+    ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=env, cwd=tmp)
+    base = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            get(base, '/health')
+            return process
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError('gunicorn did not start, see error.log in ' + tmp)
+
+
+class Connection:
+    """Minimal HTTP/1.1 keep-alive client (Content-Length and chunked bodies)"""
+
+    def __init__(self, port: int):
+        self.port = port
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+
+    async def request(self, method: str, path: str, body: Optional[Dict] = None) -> int:
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection('127.0.0.1', self.port)
+        data = json.dumps(body).encode() if body is not None else b''
+        head = f'{method} {path} HTTP/1.1\r\nHost: 127.0.0.1\r\nContent-Length: {len(data)}\r\n'
+        if body is not None:
+            head += 'Content-Type: application/json\r\n'
+        self.writer.write(head.encode() + b'\r\n' + data)
+        await self.writer.drain()
+        try:
+            return await self._response()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            self.close()
+            raise
+
+    async def _response(self) -> int:
+        status = int((await self.reader.readline()).split()[1])
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        if headers.get('transfer-encoding') == 'chunked':
+            while True:
+                size = int((await self.reader.readline()).split(b';')[0], 16)
+                await self.reader.readexactly(size + 2)
+                if size == 0:
+                    break
+        elif 'content-length' in headers:
+            await self.reader.readexactly(int(headers['content-length']))
+        else:
+            await self.reader.read()
+            self.close()
+        if headers.get('connection') == 'close':
+            self.close()
+        return status
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+
+# Endpoint -> fn(rng, wallets, counter) returning (method, path, body)
+Request = Tuple[str, str, Optional[Dict]]
+ENDPOINTS: Dict[str, Callable[[random.Random, List[str], List[int]], Request]] = {
+    'get_user': lambda rng, wallets, n: ('GET', f'/get_user?walletid={rng.choice(wallets)}', None),
+    'update_game_score': lambda rng, wallets, n: (
+        'POST', '/update_game_score', {'walletid': rng.choice(wallets), 'score': rng.randint(1, 5000)}),
+    'leaderboard': lambda rng, wallets, n: ('GET', f'/leaderboard?walletid={rng.choice(wallets)}', None),
+    'transaction': lambda rng, wallets, n: (
+        'POST', '/transaction', {'walletid': rng.choice(wallets), 'hash': f'load-{os.getpid()}-{n[0]}',
+                                 'paid': 10000, 'col1': 'buy_games'}),
+    'admin_users': lambda rng, wallets, n: ('GET', '/admin/users?limit=100', None),
+    'admin_transactions': lambda rng, wallets, n: ('GET', '/admin/transactions?limit=100', None),
+}
+
+
+def parse_mix(mix: str) -> Dict[str, int]:
+    weights = {}
+    for part in mix.split(','):
+        name, _, weight = part.partition('=')
+        if name not in ENDPOINTS:
+            raise SystemExit(f'unknown endpoint {name!r} in --mix (known: {", ".join(ENDPOINTS)})')
+        weights[name] = int(weight)
+    return weights
+
+
+def percentile(values: List[float], q: float) -> float:
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+
+async def client(port: int, rng: random.Random, wallets: List[str], names: List[str], weights: List[int],
+                 counter: List[int], measure_from: float, stop_at: float,
+                 latencies: Dict[str, List[float]], errors: Dict[str, int]):
+    conn = Connection(port)
+    while time.perf_counter() < stop_at:
+        name = rng.choices(names, weights)[0]
+        counter[0] += 1
+        method, path, body = ENDPOINTS[name](rng, wallets, counter)
+        start = time.perf_counter()
+        try:
+            status = await conn.request(method, path, body)
+        except (OSError, asyncio.IncompleteReadError, ValueError, IndexError):
+            status = 0
+        end = time.perf_counter()
+        if start < measure_from:
+            continue
+        if status != 200:
+            errors[name] = errors.get(name, 0) + 1
+        else:
+            latencies.setdefault(name, []).append((end - start) * 1000)
+    conn.close()
+
+
+async def run_load(port: int, wallets: List[str], mix: Dict[str, int], clients: int, duration: float,
+                   warmup: float, seed: int) -> Dict:
+    names, weights = list(mix), list(mix.values())
+    latencies: Dict[str, List[float]] = {}
+    errors: Dict[str, int] = {}
+    counter = [0]
+    start = time.perf_counter()
+    measure_from = start + warmup
+    stop_at = measure_from + duration
+    await asyncio.gather(*(
+        client(port, random.Random(seed * 100003 + i), wallets, names, weights, counter, measure_from, stop_at,
+               latencies, errors)
+        for i in range(clients)
+    ))
+    elapsed = time.perf_counter() - measure_from
+    endpoints = {}
+    for name in names:
+        values = sorted(latencies.get(name, []))
+        endpoints[name] = {
+            'requests': len(values),
+            'errors': errors.get(name, 0),
+            'rps': round(len(values) / elapsed, 1),
+            'p50_ms': round(percentile(values, 0.50), 2),
+            'p95_ms': round(percentile(values, 0.95), 2),
+            'p99_ms': round(percentile(values, 0.99), 2),
+            'max_ms': round(values[-1], 2) if values else 0.0,
+        }
+    everything = sorted(value for values in latencies.values() for value in values)
+    return {
+        'seconds': round(elapsed, 2),
+        'total': {
+            'requests': len(everything),
+            'errors': sum(errors.values()),
+            'rps': round(len(everything) / elapsed, 1),
+            'p50_ms': round(percentile(everything, 0.50), 2),
+            'p95_ms': round(percentile(everything, 0.95), 2),
+            'p99_ms': round(percentile(everything, 0.99), 2),
+        },
+        'endpoints': endpoints,
+    }
+
+
+def compare(result: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    """Endpoints whose p95 rose or throughput fell by more than `tolerance` percent"""
+    regressions = []
+    sections = dict(result['endpoints'], total=result['total'])
+    before = dict(baseline['endpoints'], total=baseline['total'])
+    for name, now in sections.items():
+        old = before.get(name)
+        if not old or not old['requests']:
+            continue
+        if now['p95_ms'] > old['p95_ms'] * (1 + tolerance / 100):
+            regressions.append(f"{name}: p95 {old['p95_ms']} ms -> {now['p95_ms']} ms")
+        if now['rps'] < old['rps'] * (1 - tolerance / 100):
+            regressions.append(f"{name}: {old['rps']} -> {now['rps']} requests/s")
+        if now['errors'] > old['errors']:
+            regressions.append(f"{name}: {old['errors']} -> {now['errors']} errors")
+    return regressions
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BACKEND, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, help='gunicorn workers (default 4, 1 with --writer-thread)')
+    parser.add_argument('--writer-thread', action='store_true',
+                        help='an in-process writer thread instead of the sidecar (QXMR_WRITER_SOCKET=), '
+                             'single worker only')
+    parser.add_argument('--clients', type=int, default=64, help='concurrent keep-alive connections')
+    parser.add_argument('--duration', type=float, default=30.0, help='seconds measured')
+    parser.add_argument('--warmup', type=float, default=5.0, help='seconds of load before measuring')
+    parser.add_argument('--wallets', type=int, default=1000)
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='endpoint=weight,...')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--port', type=int, default=5098)
+    parser.add_argument('--output', help='save the result as JSON')
+    parser.add_argument('--baseline', help='JSON result to compare with')
+    parser.add_argument('--tolerance', type=float, default=20.0, help='percent worse than the baseline allowed')
+    args = parser.parse_args()
+    if args.workers is None:
+        args.workers = 1 if args.writer_thread else 4
+    elif args.writer_thread and args.workers != 1:
+        parser.error('--writer-thread runs one writer per process: use it with --workers 1')
+
+    mix = parse_mix(args.mix)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    base = f'http://127.0.0.1:{args.port}'
+    wallets = [wallet_id(i.to_bytes(32, 'little')) for i in range(1, args.wallets + 1)]
+    with tempfile.TemporaryDirectory() as tmp:
+        process = start_server(tmp, args.port, args.workers, not args.writer_thread)
+        try:
+            rng = random.Random(args.seed)
+            for walletid in wallets:
+                post(base, '/transaction', {'walletid': walletid, 'hash': 'seed-' + walletid,
+                                            'paid': 10000, 'col1': 'leaderboard_payment'})
+                post(base, '/update_game_score', {'walletid': walletid, 'score': rng.randint(1, 5000)})
+            load = asyncio.run(run_load(args.port, wallets, mix, args.clients, args.duration, args.warmup,
+                                        args.seed))
+        finally:
+            process.terminate()
+            process.wait(30)
+
+    result = dict(load, config={
+        'workers': args.workers, 'sidecar': not args.writer_thread, 'clients': args.clients, 'duration': args.duration,
+        'warmup': args.warmup, 'wallets': args.wallets, 'mix': mix, 'seed': args.seed,
+    }, environment={
+        'commit': git_commit(), 'python': platform.python_version(), 'cpus': os.cpu_count(),
+        'machine': platform.machine(), 'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    })
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+    regressions = compare(result, baseline, args.tolerance) if baseline is not None else []
+    if baseline is not None:
+        result['regressions'] = regressions
+    print(json.dumps(result, indent=2))
+    if regressions:
+        print('\n'.join(['Regressions against ' + args.baseline + ':'] + regressions), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
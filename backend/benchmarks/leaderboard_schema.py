@@ -0,0 +1,139 @@
+"""
+Leaderboard query benchmark: TEXT columns vs. the numeric schema.
+
+Seeds a throwaway users.db with the original (version 0) schema, times the
+queries behind /leaderboard (count, top 100, rank of a wallet), applies the
+migrations and times the same lookups again.
+
+    python benchmarks/leaderboard_schema.py --wallets 1000000
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from migrations import migrate, USERS_MIGRATIONS  # noqa: E402
+from wallet_ids import wallet_id, wallet_key  # noqa: E402
+
+LEGACY_QUERIES = {
+    'count': ('SELECT COUNT(*) FROM users WHERE leaderboard_access = "1"', False),
+    'top100': ('''
+        SELECT * FROM users WHERE leaderboard_access = "1"
+        ORDER BY CAST(amount AS REAL) DESC LIMIT 100
+    ''', False),
+    'rank': ('''
+        SELECT COUNT(*) + 1 FROM users
+        WHERE leaderboard_access = "1" AND CAST(amount AS REAL) > (SELECT CAST(amount AS REAL) FROM users WHERE walletid = ?)
+    ''', True),
+}
+
+NUMERIC_QUERIES = {
+    'count': ("SELECT COUNT(*) FROM users WHERE leaderboard_access = '1'", False),
+    'top100': ('''
+        SELECT * FROM users WHERE leaderboard_access = '1'
+        ORDER BY amount DESC LIMIT 100
+    ''', False),
+    'rank': ('''
+        SELECT COUNT(*) + 1 FROM users
+        WHERE leaderboard_access = '1' AND amount > (SELECT amount FROM users WHERE walletid = ?)
+    ''', True),
+}
+
+
+def random_walletid(rng: random.Random) -> str:
+    return wallet_id(rng.getrandbits(256).to_bytes(32, 'little'))
+
+
+def seed(path: str, wallets: int, access_ratio: float, rng: random.Random):
+    conn = sqlite3.connect(path)
+    conn.execute('''
+        CREATE TABLE users (
+            walletid TEXT PRIMARY KEY,
+            amount TEXT DEFAULT '0',
+            gameleft TEXT DEFAULT '0',
+            lastplayed TEXT DEFAULT '',
+            paid TEXT DEFAULT '0',
+            highest TEXT DEFAULT '0',
+            col1 TEXT DEFAULT '',
+            col2 TEXT DEFAULT '',
+            col3 TEXT DEFAULT '',
+            leaderboard_access TEXT DEFAULT "0"
+        )
+    ''')
+    ids = []
+    batch = []
+    for _ in range(wallets):
+        walletid = random_walletid(rng)
+        ids.append(walletid)
+        amount = str(float(rng.randint(0, 200000)))
+        access = '1' if rng.random() < access_ratio else '0'
+        batch.append((walletid, amount, str(rng.randint(0, 3)), '', '0', amount, access))
+        if len(batch) >= 50000:
+            conn.executemany('INSERT OR IGNORE INTO users (walletid, amount, gameleft, lastplayed, paid, highest, leaderboard_access) VALUES (?, ?, ?, ?, ?, ?, ?)', batch)
+            batch = []
+    conn.executemany('INSERT OR IGNORE INTO users (walletid, amount, gameleft, lastplayed, paid, highest, leaderboard_access) VALUES (?, ?, ?, ?, ?, ?, ?)', batch)
+    conn.commit()
+    conn.close()
+    return ids
+
+
+def time_queries(path: str, queries, sample_ids, repeat: int):
+    conn = sqlite3.connect(path)
+    results = {}
+    for name, (sql, takes_wallet) in queries.items():
+        timings = []
+        for i in range(repeat):
+            params = (sample_ids[i % len(sample_ids)],) if takes_wallet else ()
+            start = time.perf_counter()
+            conn.execute(sql, params).fetchall()
+            timings.append((time.perf_counter() - start) * 1000)
+        timings.sort()
+        plan = [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, (sample_ids[0],) if takes_wallet else ())]
+        results[name] = {
+            'median_ms': round(timings[len(timings) // 2], 3),
+            'max_ms': round(timings[-1], 3),
+            'plan': plan,
+        }
+    conn.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--wallets', type=int, default=1000000)
+    parser.add_argument('--access-ratio', type=float, default=0.3, help='share of wallets with leaderboard access')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'users.db')
+        start = time.perf_counter()
+        ids = seed(path, args.wallets, args.access_ratio, rng)
+        seed_s = time.perf_counter() - start
+        sample_ids = rng.sample(ids, min(len(ids), 100))
+
+        before = time_queries(path, LEGACY_QUERIES, sample_ids, args.repeat)
+        start = time.perf_counter()
+        migrate(path, USERS_MIGRATIONS)
+        migrate_s = time.perf_counter() - start
+        after = time_queries(path, NUMERIC_QUERIES, [wallet_key(walletid) for walletid in sample_ids], args.repeat)
+
+    print(json.dumps({
+        'wallets': args.wallets,
+        'seed_seconds': round(seed_s, 2),
+        'migration_seconds': round(migrate_s, 2),
+        'before': before,
+        'after': after,
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
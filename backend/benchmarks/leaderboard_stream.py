@@ -0,0 +1,202 @@
+"""
+Load test for /leaderboard/stream: how many subscribers one worker holds.
+
+Starts gunicorn with gunicorn_config.py and a single worker on throwaway
+databases, then for each level opens that many concurrent SSE streams,
+records a score and measures how long the `top` event takes to reach
+every subscriber. Reports connect time, delivery latency percentiles,
+streams that missed the event and the worker's resident memory.
+
+    python benchmarks/leaderboard_stream.py --subscribers 1000,2000,4000
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from typing import Dict, List, Optional
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONFIG = os.path.join(BACKEND, 'gunicorn_config.py')
+
+sys.path.insert(0, BACKEND)
+
+from wallet_ids import wallet_id  # noqa: E402
+
+
+def post(base: str, path: str, data: Dict) -> Dict:
+    request = urllib.request.Request(base + path, data=json.dumps(data).encode(),
+                                     headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request, timeout=30) as response:
+        return json.load(response)
+
+
+def get(base: str, path: str) -> Dict:
+    with urllib.request.urlopen(base + path, timeout=30) as response:
+        return json.load(response)
+
+
+def start_server(tmp: str, port: int, worker_connections: int) -> subprocess.Popen:
+    process = subprocess.Popen([
+        sys.executable, '-m', 'gunicorn', '-c', CONFIG,
+        '--chdir', tmp, '--pythonpath', BACKEND,
+        '-w', '1', '--worker-connections', str(worker_connections),
+        '-b', f'127.0.0.1:{port}', '--pid', os.path.join(tmp, 'gunicorn.pid'),
+        '--access-logfile', '/dev/null', '--error-logfile', os.path.join(tmp, 'error.log'),
+        'wsgi:application',
+    ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            get(base, '/health')
+            return process
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError('gunicorn did not start, see error.log in ' + tmp)
+
+
+def worker_rss_mb(master_pid: int) -> Optional[float]:
+    try:
+        children = open(f'/proc/{master_pid}/task/{master_pid}/children').read().split()
+        for line in open(f'/proc/{children[0]}/status'):
+            if line.startswith('VmRSS:'):
+                return round(int(line.split()[1]) / 1024, 1)
+    except (OSError, IndexError):
+        pass
+    return None
+
+
+class Subscriber:
+    def __init__(self):
+        self.ready = asyncio.Event()
+        self.received: Optional[float] = None
+        self.expect_after: Optional[float] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+
+    async def run(self, port: int, walletid: str, opening: asyncio.Semaphore):
+        async with opening:
+            reader, self.writer = await asyncio.open_connection('127.0.0.1', port)
+            self.writer.write((
+                f'GET /leaderboard/stream?walletid={walletid}&top=10 HTTP/1.1\r\n'
+                f'Host: 127.0.0.1\r\nAccept: text/event-stream\r\n\r\n'
+            ).encode())
+            await self.writer.drain()
+            while not self.ready.is_set():
+                line = await reader.readline()
+                if not line:
+                    return
+                if line.startswith(b'event: snapshot'):
+                    self.ready.set()
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+            elif line.startswith(b'event: top') and self.expect_after is not None and self.received is None:
+                self.received = time.perf_counter()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+def percentile(values: List[float], q: float) -> float:
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+
+async def run_level(base: str, port: int, master_pid: int, count: int, wallets: List[str], score: float,
+                    timeout: float, connect_concurrency: int) -> Dict:
+    """Open `count` streams, record one score, time the resulting `top` events"""
+    subscribers = [Subscriber() for _ in range(count)]
+    start = time.perf_counter()
+    # Open streams a few at a time, like clients arriving, not one SYN flood
+    opening = asyncio.Semaphore(connect_concurrency)
+    tasks = [asyncio.ensure_future(s.run(port, wallets[i % len(wallets)], opening))
+             for i, s in enumerate(subscribers)]
+    try:
+        await asyncio.wait_for(asyncio.gather(*(s.ready.wait() for s in subscribers)), timeout)
+    except asyncio.TimeoutError:
+        pass
+    connected = sum(s.ready.is_set() for s in subscribers)
+    connect_s = time.perf_counter() - start
+
+    sent = time.perf_counter()
+    for s in subscribers:
+        s.expect_after = sent
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, post, base, '/update_game_score', {'walletid': wallets[0], 'score': score})
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline and any(s.received is None for s in subscribers if s.ready.is_set()):
+        await asyncio.sleep(0.05)
+    latencies = sorted((s.received - sent) * 1000 for s in subscribers if s.ready.is_set() and s.received is not None)
+
+    stats = await loop.run_in_executor(None, get, base, '/admin/stream-stats')
+    rss_mb = worker_rss_mb(master_pid)
+    for s in subscribers:
+        s.close()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return {
+        'subscribers': count,
+        'connected': connected,
+        'connect_seconds': round(connect_s, 2),
+        'delivered': len(latencies),
+        'missed': connected - len(latencies),
+        'p50_ms': round(percentile(latencies, 0.50), 1),
+        'p99_ms': round(percentile(latencies, 0.99), 1),
+        'max_ms': round(latencies[-1], 1) if latencies else 0.0,
+        'open_streams': stats.get('subscribers'),
+        'worker_rss_mb': rss_mb,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--subscribers', default='500,1000,2000,4000', help='comma-separated levels')
+    parser.add_argument('--worker-connections', type=int, default=5000)
+    parser.add_argument('--wallets', type=int, default=50, help='distinct wallets the streams follow')
+    parser.add_argument('--port', type=int, default=5099)
+    parser.add_argument('--connect-concurrency', type=int, default=100, help='streams being opened at once')
+    parser.add_argument('--timeout', type=float, default=60.0)
+    args = parser.parse_args()
+
+    levels = [int(level) for level in args.subscribers.split(',')]
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    if max(levels) + 100 > hard:
+        sys.exit(f'open file limit {hard} is too low for {max(levels)} subscribers')
+
+    base = f'http://127.0.0.1:{args.port}'
+    wallets = [wallet_id(i.to_bytes(32, 'little')) for i in range(1, args.wallets + 1)]
+    results = []
+    for count in levels:
+        # A fresh server per level: streams of the previous level would only
+        # be noticed as closed at their next heartbeat
+        with tempfile.TemporaryDirectory() as tmp:
+            process = start_server(tmp, args.port, args.worker_connections)
+            try:
+                for walletid in wallets:
+                    post(base, '/transaction', {'walletid': walletid, 'hash': 'bench-' + walletid,
+                                                'paid': 10000, 'col1': 'leaderboard_payment'})
+                result = asyncio.run(run_level(base, args.port, process.pid, count, wallets, 1000, args.timeout,
+                                               args.connect_concurrency))
+                results.append(result)
+                print(json.dumps(result), file=sys.stderr)
+            finally:
+                # Quick shutdown: a graceful one would wait for the open streams
+                process.send_signal(signal.SIGQUIT)
+                process.wait(30)
+
+    print(json.dumps({'worker_connections': args.worker_connections, 'levels': results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
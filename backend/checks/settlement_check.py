@@ -0,0 +1,140 @@
+"""
+Settlement check: a dry run and a real settlement against a seeded daily_scores.
+
+Creates a throwaway daily_scores.db with the original (version 0) schema,
+applies the migrations and seeds scores for a few final days and for
+today. It then runs settle() in a dry run and for real, the way the writer
+does, and settlement.py from the command line. Each step must pay exactly
+the expected winners, and a second run must find nothing left to settle.
+
+    python checks/settlement_check.py
+
+Prints one line per step and exits with status 1 on the first failure.
+"""
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+from datetime import date, timedelta
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND)
+
+from daily_rankings import last_final_day  # noqa: E402
+from migrations import migrate, DAILY_SCORES_MIGRATIONS  # noqa: E402
+from settlement import publish_manifest, settle  # noqa: E402
+from wallet_ids import wallet_id  # noqa: E402
+
+DAYS = 3
+WALLETS = 4
+
+
+def key(n: int) -> bytes:
+    return n.to_bytes(32, 'big')
+
+
+def seed(path: str) -> list:
+    """Scores for DAYS final days and today; returns the expected (date, walletid) winners"""
+    conn = sqlite3.connect(path)
+    conn.execute('''
+        CREATE TABLE daily_scores (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            walletid TEXT NOT NULL,
+            score_date TEXT NOT NULL,
+            score REAL NOT NULL,
+            prize_claimed TEXT DEFAULT '0',
+            UNIQUE(walletid, score_date)
+        )
+    ''')
+    conn.commit()
+    conn.close()
+    migrate(path, DAILY_SCORES_MIGRATIONS)
+    last = last_final_day()
+    days = [(last - timedelta(days=offset)).isoformat() for offset in range(DAYS - 1, -1, -1)]
+    conn = sqlite3.connect(path)
+    expected = []
+    for n, day in enumerate(days + [date.today().isoformat()]):
+        winner = n % WALLETS
+        for wallet in range(WALLETS):
+            score = 100.0 if wallet == winner else float(wallet)
+            conn.execute('INSERT INTO daily_scores (walletid, score_date, score) VALUES (?, ?, ?)',
+                         (key(wallet + 1), day, score))
+        if day in days:
+            expected.append((day, wallet_id(key(winner + 1))))
+    conn.commit()
+    conn.close()
+    return expected
+
+
+def claimed(path: str) -> list:
+    conn = sqlite3.connect(path)
+    try:
+        rows = conn.execute("SELECT score_date, walletid FROM daily_scores WHERE prize_claimed = '1' "
+                            "ORDER BY score_date").fetchall()
+    finally:
+        conn.close()
+    return [(day, wallet_id(walletid)) for day, walletid in rows]
+
+
+def run(path: str, payout_dir: str, dry_run: bool) -> dict:
+    """settle() in its own IMMEDIATE transaction, as the writer runs it"""
+    conn = sqlite3.connect(path, isolation_level=None)
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        result = settle(conn, dry_run=dry_run, payout_dir=payout_dir)
+        conn.execute('COMMIT')
+    finally:
+        conn.close()
+    if result['manifest']:
+        publish_manifest(result['manifest'])
+    return result
+
+
+def cli(directory: str, *args: str) -> dict:
+    output = subprocess.run([sys.executable, os.path.join(BACKEND, 'settlement.py'), *args],
+                            cwd=directory, check=True, capture_output=True, text=True).stdout
+    return json.loads(output)
+
+
+def check(name: str, ok: bool, detail: object = ''):
+    print(f"{'ok  ' if ok else 'FAIL'} {name}" + (f': {detail}' if detail and not ok else ''))
+    if not ok:
+        sys.exit(1)
+
+
+def paid(result: dict) -> list:
+    return [(payout['date'], payout['walletid']) for payout in result['payouts']]
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'daily_scores.db')
+        payouts = os.path.join(tmp, 'payouts')
+        expected = seed(path)
+
+        result = run(path, payouts, dry_run=True)
+        check('dry run lists every final day', paid(result) == expected, result['payouts'])
+        check('dry run claims nothing', not claimed(path) and result['manifest'] is None)
+
+        result = run(path, payouts, dry_run=False)
+        check('settlement pays every final day', paid(result) == expected, result['payouts'])
+        check('settlement marks the winners claimed', claimed(path) == expected, claimed(path))
+        with open(result['manifest']) as f:
+            manifest = json.load(f)
+        check('manifest lists the payouts', [(p['date'], p['walletid']) for p in manifest['payouts']] == expected)
+        check('second settlement finds nothing', run(path, payouts, dry_run=False)['days'] == 0)
+
+        cli_dir = os.path.join(tmp, 'cli')
+        os.makedirs(cli_dir)
+        expected = seed(os.path.join(cli_dir, 'daily_scores.db'))
+        result = cli(cli_dir, '--dry-run')
+        check('settlement.py --dry-run', paid(result) == expected and result['manifest'] is None, result)
+        result = cli(cli_dir)
+        check('settlement.py', paid(result) == expected and os.path.exists(os.path.join(cli_dir, result['manifest'])),
+              result)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+"""
+Per-day rankings read from daily_scores.
+
+daily_scores holds one row per wallet and day with the best score of that
+day (the upsert in store.py only ever raises it), so the row already is
+the per-day aggregate. idx_daily_scores_rank keeps the rows of each day
+ordered by score as every upsert (or write-behind flush) lands, and the
+winner or top N of a date are the first rows of that index instead of a
+GROUP BY and sort over the whole day. The winners of a range of days
+come from window queries over the same index, one per page of days.
+
+A day is final once it has been over for SETTLE_SECONDS, which leaves
+time for the last writer batch and a write-behind flush. Its ranking can
+no longer change, so each worker keeps it without a version and never
+invalidates it.
+"""
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from wallet_ids import wallet_id
+
+# Prize paid to each day's winner, in Qubic
+PRIZE_AMOUNT = 1000000
+# Rows kept per final day, and the most a top-N request may ask for
+MAX_TOP = 100
+# Rows returned by /daily_top without a limit
+DEFAULT_TOP = 10
+# Final days kept per worker
+MAX_DAYS = 400
+# Winners per fetch while streaming a range of days
+WINNERS_PAGE = 100
+# Seconds after midnight before the previous day is treated as final
+SETTLE_SECONDS = 300
+
+Ranking = List[Tuple[str, float]]
+
+TOP_FOR_DATE = '''
+    SELECT walletid, score FROM daily_scores
+    WHERE score_date = ?
+    ORDER BY score DESC, walletid
+    LIMIT ?
+'''
+
+# Last of the next (at most) N days with scores from `first` to `last`, after a day
+PAGE_END = '''
+    SELECT MAX(score_date) FROM (
+        SELECT DISTINCT score_date FROM daily_scores
+        WHERE score_date BETWEEN ? AND ? AND score_date > ?
+        ORDER BY score_date
+        LIMIT ?
+    )
+'''
+
+# Winners of one page of winners_between: days from `first` to the page's
+# last day, after the previous page's
+WINNERS_PAGE_IN_RANGE = '''
+    SELECT score_date, walletid, score FROM (
+        SELECT score_date, walletid, score,
+               ROW_NUMBER() OVER (PARTITION BY score_date ORDER BY score DESC, walletid) AS place
+        FROM daily_scores
+        WHERE score_date BETWEEN ? AND ? AND score_date > ?
+    )
+    WHERE place = 1
+    ORDER BY score_date
+'''
+
+
+def _ranking(rows: Iterable[sqlite3.Row]) -> Ranking:
+    return [(wallet_id(walletid), score) for walletid, score in rows]
+
+
+def winners_between(conn: sqlite3.Connection, first: str, last: str,
+                    page_size: int = WINNERS_PAGE) -> Iterator[List[sqlite3.Row]]:
+    """(score_date, stored walletid, score) of every day from `first` to `last` that has scores, in pages.
+
+    Each page covers the next `page_size` days with scores after the previous
+    page and is read in full, so no statement (and read snapshot) stays open
+    while the caller streams a page out.
+    """
+    after = ''
+    while True:
+        end = conn.execute(PAGE_END, (first, last, after, page_size)).fetchone()[0]
+        if end is None:
+            return
+        yield conn.execute(WINNERS_PAGE_IN_RANGE, (first, end, after)).fetchall()
+        after = end
+
+
+def is_final(score_date: str, now: Optional[datetime] = None) -> bool:
+    """True if no score can be recorded for `score_date` any more"""
+    try:
+        day = date.fromisoformat(score_date)
+    except ValueError:
+        return False
+    return day <= last_final_day(now)
+
+
+def last_final_day(now: Optional[datetime] = None) -> date:
+    """The most recent day that is final"""
+    settled = (now or datetime.now()) - timedelta(seconds=SETTLE_SECONDS)
+    return settled.date() - timedelta(days=1)
+
+
+class DailyRankings:
+    """Top scores per date, cached for good once the date is final"""
+
+    def __init__(self, max_days: int = MAX_DAYS):
+        self.max_days = max_days
+        self._lock = threading.Lock()
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _reset(self):
+        self._final: 'OrderedDict[str, Ranking]' = OrderedDict()
+        self._stats = {'final_hits': 0, 'final_loads': 0, 'live_queries': 0}
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        self._reset()
+
+    def top(self, conn: sqlite3.Connection, score_date: str, limit: int) -> Ranking:
+        """The `limit` (at most MAX_TOP) best (walletid, score) of `score_date`, best first"""
+        limit = min(limit, MAX_TOP)
+        if not is_final(score_date):
+            with self._lock:
+                self._stats['live_queries'] += 1
+            return _ranking(conn.execute(TOP_FOR_DATE, (score_date, limit)))
+        with self._lock:
+            ranking = self._final.get(score_date)
+            if ranking is not None:
+                self._final.move_to_end(score_date)
+                self._stats['final_hits'] += 1
+                return ranking[:limit]
+        ranking = _ranking(conn.execute(TOP_FOR_DATE, (score_date, MAX_TOP)))
+        with self._lock:
+            self._final[score_date] = ranking
+            self._final.move_to_end(score_date)
+            while len(self._final) > self.max_days:
+                self._final.popitem(last=False)
+            self._stats['final_loads'] += 1
+        return ranking[:limit]
+
+    def winner(self, conn: sqlite3.Connection, score_date: str) -> Optional[Tuple[str, float]]:
+        ranking = self.top(conn, score_date, 1)
+        return ranking[0] if ranking else None
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self._stats, final_days=len(self._final), pid=os.getpid())
+
+
+daily_rankings = DailyRankings()
@@ -0,0 +1,125 @@
+"""
+Long-lived SQLite connections for the backend.
+
+Every gunicorn worker keeps one connection per database file per thread and
+hands it out again on the next call instead of connecting and tearing down
+for every helper. Connections are dropped (never reused) in a forked child,
+so the pool is safe under gunicorn's pre-fork model even when the app is
+preloaded in the master.
+"""
+import os
+import sqlite3
+import threading
+from typing import Any, Dict, List
+
+import metrics
+import sql_profiler
+
+# Database file paths
+USERS_DB = 'users.db'
+TRANSACTIONS_DB = 'transactions.db'
+DAILY_SCORES_DB = 'daily_scores.db'
+
+try:
+    # Under gevent workers threading.local is per greenlet, i.e. per request.
+    # Keep connections per OS thread so they are still reused across requests.
+    from gevent.monkey import get_original
+    _thread_local = get_original('threading', 'local')
+except ImportError:
+    _thread_local = threading.local
+
+# Prepared statements kept per connection (sqlite3's default is 128)
+STATEMENT_CACHE_SIZE = 256
+# Seconds to wait on a locked database before raising "database is locked"
+BUSY_TIMEOUT = 10.0
+
+
+class ConnectionPool:
+    """Per-process, per-thread cache of SQLite connections keyed by file path"""
+
+    def __init__(self, cached_statements: int = STATEMENT_CACHE_SIZE, timeout: float = BUSY_TIMEOUT):
+        self.cached_statements = cached_statements
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._local = _thread_local()
+        self._stats: Dict[str, Dict[str, int]] = {}
+        # Connections inherited from the parent process. They are kept
+        # referenced so they are never closed (or used) from the child.
+        self._inherited: List[sqlite3.Connection] = getattr(self, '_inherited', [])
+
+    def _after_fork(self):
+        inherited = getattr(self._local, 'connections', {})
+        self._inherited.extend(inherited.values())
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _count(self, path: str, key: str):
+        with self._lock:
+            stats = self._stats.setdefault(path, {'connects': 0, 'reuses': 0})
+            stats[key] += 1
+
+    def get(self, path: str) -> sqlite3.Connection:
+        """Return this thread's connection to `path`, opening it on first use"""
+        if os.getpid() != self._pid:
+            # Fork without register_at_fork support
+            self._after_fork()
+        connections = getattr(self._local, 'connections', None)
+        if connections is None:
+            connections = self._local.connections = {}
+        conn = connections.get(path)
+        if conn is not None:
+            self._count(path, 'reuses')
+            metrics.sqlite_reuses.inc(os.path.basename(path))
+            return conn
+        conn = metrics.connect(path, os.path.basename(path), sql_profiler.CURSOR_CLASS, timeout=self.timeout,
+                               cached_statements=self.cached_statements)
+        conn.row_factory = sqlite3.Row
+        connections[path] = conn
+        self._count(path, 'connects')
+        metrics.sqlite_connects.inc(os.path.basename(path))
+        metrics.sqlite_connections.inc(os.path.basename(path))
+        return conn
+
+    def release(self):
+        """Roll back any transaction left open on this thread's connections"""
+        for conn in getattr(self._local, 'connections', {}).values():
+            if conn.in_transaction:
+                conn.rollback()
+
+    def close_all(self):
+        """Close this thread's connections (they are reopened on next use)"""
+        connections = getattr(self._local, 'connections', {})
+        for path, conn in connections.items():
+            conn.close()
+            metrics.sqlite_connections.dec(os.path.basename(path))
+        connections.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        """Connection counts for this worker: opened vs. handed out again"""
+        with self._lock:
+            return {
+                'pid': self._pid,
+                'databases': {
+                    os.path.basename(path): dict(counts)
+                    for path, counts in self._stats.items()
+                },
+            }
+
+
+def generation(conn: sqlite3.Connection, table: str) -> int:
+    """Write counter of `table`, bumped by triggers on every change (see migrations.py).
+
+    Unlike `PRAGMA data_version` it is stored in the database, so every
+    worker and thread reads the same value for the same state.
+    """
+    row = conn.execute('SELECT value FROM generations WHERE name = ?', (table,)).fetchone()
+    return row[0] if row else 0
+
+
+pool = ConnectionPool()
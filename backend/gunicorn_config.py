@@ -1,6 +1,10 @@
 # Gunicorn configuration file
+import glob
 import multiprocessing
 import os
+import subprocess
+import sys
+import time
 
 # Server socket
 bind = "127.0.0.1:5000"
@@ -8,8 +12,10 @@ backlog = 2048
 
 # Worker processes
 workers = multiprocessing.cpu_count() * 2 + 1
-worker_class = "sync"
-worker_connections = 1000
+# gevent: /leaderboard/stream keeps a connection open per subscriber, which
+# only costs a greenlet here but would pin a whole sync worker
+worker_class = "gevent"
+worker_connections = 5000  # Open connections (mostly idle streams) per worker
 timeout = 30
 keepalive = 2
 
@@ -34,3 +40,39 @@ tmp_upload_dir = None
 # keyfile = None
 # certfile = None
 
+
+# Single writer (see writer.py): one sidecar process applies the writes of
+# every worker, listening on QXMR_WRITER_SOCKET (default next to the pid
+# file). Writer threads in each worker would contend for the write lock, and
+# SQLite's busy wait blocks the whole gevent worker meanwhile. Set
+# QXMR_WRITER_SOCKET= (empty) for a writer thread per worker, with -w 1 only.
+# setdefault: the workers read the same variable (writer.WRITER_SOCKET).
+writer_socket = os.environ.setdefault('QXMR_WRITER_SOCKET', os.path.join(os.path.dirname(pidfile), 'writer.sock'))
+_writer_process = None
+
+def on_starting(server):
+    global _writer_process
+    # /metrics adds up the files of every process (metrics.py): drop the last run's
+    for path in glob.glob(os.path.join(os.environ.get('QXMR_METRICS_DIR', 'metrics'), '*.metrics')):
+        os.remove(path)
+    if not writer_socket:
+        return
+    os.makedirs(os.path.dirname(os.path.abspath(writer_socket)), exist_ok=True)
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'writer.py')
+    _writer_process = subprocess.Popen([sys.executable, script, '--socket', writer_socket])
+    deadline = time.monotonic() + 10
+    while not os.path.exists(writer_socket):
+        if _writer_process.poll() is not None or time.monotonic() > deadline:
+            raise RuntimeError('Writer sidecar failed to start')
+        time.sleep(0.05)
+
+def worker_exit(server, worker):
+    # Commit whatever this worker still has queued
+    app_module = sys.modules.get('app')
+    if app_module is not None:
+        app_module.writer.stop()
+
+def on_exit(server):
+    if _writer_process is not None:
+        _writer_process.terminate()
+        _writer_process.wait(10)
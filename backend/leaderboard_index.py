@@ -0,0 +1,255 @@
+"""
+In-memory leaderboard for wallets with leaderboard access.
+
+Entries are kept in an indexable skip list ordered by (amount DESC,
+walletid), so top-N, rank-of-wallet and the total count are answered from
+memory in O(log n) instead of scanning `users`. Every gunicorn worker holds
+its own copy: it is bulk-loaded on first use and caught up on each request
+from `users.leaderboard_seq`, which a trigger bumps whenever a row's amount
+or leaderboard access changes (see migrations.py). A new season (see
+seasons.py) changes every amount without touching the rows, so it
+rebuilds the index instead.
+
+Wallets are kept in their stored form (the 32-byte key, see
+wallet_ids.py), so loading and catching up never compute an identity;
+the public methods take and return identities.
+"""
+import os
+import random
+import sqlite3
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from seasons import current_season
+from wallet_ids import wallet_id, wallet_key
+
+MAX_LEVEL = 32
+# Catching up on more changes than this rebuilds the index instead
+REBUILD_THRESHOLD = 10000
+
+Key = Tuple[float, bytes]
+
+
+class _Node:
+    __slots__ = ('key', 'next', 'width')
+
+    def __init__(self, key: Optional[Key], level: int):
+        self.key = key
+        self.next: List[Optional['_Node']] = [None] * level
+        # width[i] is the number of level-0 steps from this node to next[i]
+        self.width = [1] * level
+
+
+def _random_level() -> int:
+    bits = random.getrandbits(MAX_LEVEL - 1)
+    level = 1
+    while bits & 1:
+        level += 1
+        bits >>= 1
+    return level
+
+
+class IndexableSkipList:
+    """Sorted keys with O(log n) insert, remove and position lookups"""
+
+    def __init__(self, keys: Iterable[Key] = ()):
+        self._load(sorted(keys))
+
+    def _load(self, keys: List[Key]):
+        self.head = _Node(None, MAX_LEVEL)
+        self.size = len(keys)
+        last = [self.head] * MAX_LEVEL
+        last_pos = [0] * MAX_LEVEL
+        for pos, key in enumerate(keys, 1):
+            node = _Node(key, _random_level())
+            for i in range(len(node.next)):
+                last[i].next[i] = node
+                last[i].width[i] = pos - last_pos[i]
+                last[i] = node
+                last_pos[i] = pos
+
+    def __len__(self) -> int:
+        return self.size
+
+    def _find(self, key: Key):
+        """Predecessors of `key` on every level and their positions"""
+        update = [self.head] * MAX_LEVEL
+        positions = [0] * MAX_LEVEL
+        node, pos = self.head, 0
+        for i in reversed(range(MAX_LEVEL)):
+            while node.next[i] is not None and node.next[i].key < key:
+                pos += node.width[i]
+                node = node.next[i]
+            update[i] = node
+            positions[i] = pos
+        return update, positions
+
+    def count_less(self, key: Key) -> int:
+        """Number of keys strictly smaller than `key`"""
+        return self._find(key)[1][0]
+
+    def insert(self, key: Key):
+        update, positions = self._find(key)
+        node = _Node(key, _random_level())
+        new_pos = positions[0] + 1
+        for i in range(MAX_LEVEL):
+            prev = update[i]
+            if i < len(node.next):
+                node.next[i] = prev.next[i]
+                if node.next[i] is not None:
+                    node.width[i] = prev.width[i] - (new_pos - positions[i]) + 1
+                prev.next[i] = node
+                prev.width[i] = new_pos - positions[i]
+            elif prev.next[i] is not None:
+                prev.width[i] += 1
+        self.size += 1
+
+    def remove(self, key: Key):
+        update, _ = self._find(key)
+        node = update[0].next[0]
+        if node is None or node.key != key:
+            raise KeyError(key)
+        for i in range(MAX_LEVEL):
+            prev = update[i]
+            if prev.next[i] is node:
+                prev.next[i] = node.next[i]
+                if node.next[i] is not None:
+                    prev.width[i] += node.width[i] - 1
+            elif prev.next[i] is not None:
+                prev.width[i] -= 1
+        self.size -= 1
+
+    def first(self, n: int) -> List[Key]:
+        keys = []
+        node = self.head.next[0]
+        while node is not None and len(keys) < n:
+            keys.append(node.key)
+            node = node.next[0]
+        return keys
+
+
+class LeaderboardIndex:
+    """Order-statistic view of `users` restricted to leaderboard_access = '1'"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._amounts: Dict[bytes, float] = {}
+        self._entries = IndexableSkipList()
+        self.loaded = False
+        self.seq = 0
+        self.season = None
+        # Bumped on every change to the contents (see leaderboard_stream.py)
+        self.version = 0
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(stored: bytes, amount: float) -> Key:
+        return (-amount, stored)
+
+    def load(self, entries: Iterable[Tuple[bytes, float]], seq: int = 0):
+        """Replace the contents with (stored walletid, amount) pairs"""
+        amounts = {stored: float(amount or 0) for stored, amount in entries}
+        entries = IndexableSkipList(self._key(w, a) for w, a in amounts.items())
+        with self._lock:
+            self._amounts = amounts
+            self._entries = entries
+            self.seq = seq
+            self.loaded = True
+            self.version += 1
+
+    def _set(self, stored: bytes, amount: float):
+        amount = float(amount or 0)
+        with self._lock:
+            current = self._amounts.get(stored)
+            if current == amount:
+                return
+            if current is not None:
+                self._entries.remove(self._key(stored, current))
+            self._entries.insert(self._key(stored, amount))
+            self._amounts[stored] = amount
+            self.version += 1
+
+    def _discard(self, stored: bytes):
+        with self._lock:
+            current = self._amounts.pop(stored, None)
+            if current is not None:
+                self._entries.remove(self._key(stored, current))
+                self.version += 1
+
+    def _apply(self, stored: bytes, amount: Any, leaderboard_access: Any):
+        if str(leaderboard_access) == '1':
+            self._set(stored, amount)
+        else:
+            self._discard(stored)
+
+    def set(self, walletid: str, amount: float):
+        """Add a wallet or move it to a new amount"""
+        self._set(wallet_key(walletid), amount)
+
+    def discard(self, walletid: str):
+        self._discard(wallet_key(walletid))
+
+    def apply(self, walletid: str, amount: Any, leaderboard_access: Any):
+        """Reflect one users row: on the leaderboard only with access '1'"""
+        self._apply(wallet_key(walletid), amount, leaderboard_access)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, walletid: str) -> bool:
+        return wallet_key(walletid) in self._amounts
+
+    def amount(self, walletid: str) -> Optional[float]:
+        return self._amounts.get(wallet_key(walletid))
+
+    def rank(self, walletid: str) -> Optional[int]:
+        """1 + number of wallets with a strictly higher amount (ties share a rank)"""
+        stored = wallet_key(walletid)
+        with self._lock:
+            amount = self._amounts.get(stored)
+            if amount is None:
+                return None
+            return self._entries.count_less((-amount, b'')) + 1
+
+    def top(self, n: int) -> List[Tuple[str, float]]:
+        with self._lock:
+            entries = self._entries.first(n)
+        return [(wallet_id(stored), -neg_amount) for neg_amount, stored in entries]
+
+    def sync(self, conn: sqlite3.Connection):
+        """Load on first use or in a new season, then apply rows changed since the last sync"""
+        season = current_season(conn)
+        if not self.loaded or season != self.season:
+            self.rebuild(conn, season)
+            return
+        changed = conn.execute('''
+            SELECT walletid, CASE WHEN amount_season = ? THEN amount ELSE 0 END AS amount,
+                   leaderboard_access, leaderboard_seq
+            FROM users WHERE leaderboard_seq > ?
+            ORDER BY leaderboard_seq
+            LIMIT ?
+        ''', (season, self.seq, REBUILD_THRESHOLD + 1)).fetchall()
+        if len(changed) > REBUILD_THRESHOLD:
+            self.rebuild(conn, season)
+            return
+        for row in changed:
+            self._apply(row['walletid'], row['amount'], row['leaderboard_access'])
+            self.seq = max(self.seq, row['leaderboard_seq'])
+
+    def rebuild(self, conn: sqlite3.Connection, season: int):
+        # Read the high-water mark first: rows changed meanwhile are applied
+        # again by the next sync, which is harmless.
+        seq = conn.execute('SELECT COALESCE(MAX(leaderboard_seq), 0) FROM users').fetchone()[0]
+        rows = conn.execute('''
+            SELECT walletid, CASE WHEN amount_season = ? THEN amount ELSE 0 END
+            FROM users WHERE leaderboard_access = '1'
+        ''', (season,))
+        self.load(((row[0], row[1]) for row in rows), seq)
+        self.season = season
+
+
+leaderboard = LeaderboardIndex()
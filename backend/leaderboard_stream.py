@@ -0,0 +1,212 @@
+"""
+Live leaderboard updates for /leaderboard/stream (Server-Sent Events).
+
+Each worker runs one broadcaster thread for all of its subscribers. It
+wakes up when this worker records a score (`notify`, called by the score
+and payment endpoints), or every POLL_INTERVAL seconds to pick up scores
+recorded by other workers through `users.leaderboard_seq`. It then compares
+the in-memory leaderboard (leaderboard_index.py) with what it sent last
+and queues for each subscriber:
+
+- `top`: the positions of its top N that changed, plus the new size and
+  total, so applying them to the snapshot gives the current top N
+- `rank`: its own rank, when it moved
+
+A subscriber is just a bounded queue, so with gevent workers (see
+gunicorn_config.py) an idle stream costs a greenlet and a socket. The
+leaderboard is read once per change, not once per subscriber.
+"""
+import json
+import os
+import queue
+import threading
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from db import pool, USERS_DB
+from leaderboard_index import LeaderboardIndex, leaderboard
+from store import format_number
+from units import from_units
+
+# Seconds between checks for scores recorded by other workers
+POLL_INTERVAL = 1.0
+# Shortest pause between two rounds of events, however often scores arrive
+MIN_INTERVAL = 0.1
+# Seconds of silence after which a comment is sent to keep proxies from closing the stream
+HEARTBEAT_INTERVAL = 15.0
+# Events a subscriber may fall behind before it is disconnected (EventSource reconnects)
+MAX_PENDING = 64
+DEFAULT_TOP = 10
+MAX_TOP = 100
+
+
+def format_event(event: str, data: Any) -> str:
+    return f'event: {event}\ndata: {json.dumps(data, separators=(",", ":"))}\n\n'
+
+
+def _entry(position: int, walletid: str, amount: float) -> Dict[str, Any]:
+    return {'position': position, 'walletid': walletid, 'amount': format_number(from_units(int(amount)))}
+
+
+class Subscription:
+    """One open stream: the top N it follows, its wallet and pending events"""
+
+    def __init__(self, walletid: Optional[str], top: int):
+        self.walletid = walletid
+        self.top = top
+        self.rank: Optional[int] = None
+        self.closed = False
+        self._queue: 'queue.Queue[str]' = queue.Queue(maxsize=MAX_PENDING)
+
+    def push(self, message: str) -> bool:
+        """Queue an event; a subscriber that is too far behind is closed instead"""
+        try:
+            self._queue.put_nowait(message)
+            return True
+        except queue.Full:
+            self.closed = True
+            return False
+
+    def next(self, timeout: float = HEARTBEAT_INTERVAL) -> Optional[str]:
+        """The next event, or None after `timeout` seconds without one"""
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class LeaderboardBroadcaster:
+    """Turns leaderboard changes into events for this worker's subscribers"""
+
+    def __init__(self, index: LeaderboardIndex = leaderboard, poll_interval: float = POLL_INTERVAL):
+        self.index = index
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._pid = None
+        self._reset()
+
+    def _reset(self):
+        self._subscribers: Set[Subscription] = set()
+        self._version: Optional[int] = None
+        self._top: List[Tuple[str, float]] = []
+        self._total = 0
+        self._stats = {'subscribed': 0, 'unsubscribed': 0, 'dropped': 0, 'rounds': 0, 'events': 0, 'errors': 0}
+
+    def start(self):
+        """Start the broadcaster thread for this process (again after a fork)"""
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._reset()
+            self._thread = threading.Thread(target=self._run, name='qxmr-leaderboard-stream', daemon=True)
+            self._thread.start()
+
+    def notify(self):
+        """A score was recorded: send events without waiting for the next poll"""
+        self._wakeup.set()
+
+    def subscribe(self, walletid: Optional[str], top: int = DEFAULT_TOP) -> Subscription:
+        """Register a stream; its first event is a `snapshot` of the current state"""
+        self.start()
+        subscription = Subscription(walletid, top)
+        with self._lock:
+            if not self._subscribers:
+                # Nobody holds older state: start diffing from now
+                self._version = self.index.version
+                self._top = self.index.top(MAX_TOP)
+                self._total = len(self.index)
+            entries = self.index.top(top)
+            snapshot = {
+                'top': [_entry(position, w, a) for position, (w, a) in enumerate(entries, 1)],
+                'total_users': len(self.index),
+                'rank': None,
+            }
+            if walletid:
+                subscription.rank = snapshot['rank'] = self.index.rank(walletid)
+            subscription.push(format_event('snapshot', snapshot))
+            self._subscribers.add(subscription)
+            self._stats['subscribed'] += 1
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            if subscription in self._subscribers:
+                self._subscribers.discard(subscription)
+                self._stats['unsubscribed'] += 1
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+            try:
+                self.broadcast()
+            except Exception:
+                with self._lock:
+                    self._stats['errors'] += 1
+            time.sleep(MIN_INTERVAL)
+
+    def broadcast(self):
+        """Catch up with the database and queue events for whatever changed"""
+        if not self._subscribers:
+            return
+        self.index.sync(pool.get(USERS_DB))
+        with self._lock:
+            if self.index.version == self._version:
+                return
+            self._version = self.index.version
+            top = self.index.top(MAX_TOP)
+            total = len(self.index)
+            changes = [
+                _entry(position, *entry)
+                for position, entry in enumerate(top, 1)
+                if position > len(self._top) or self._top[position - 1] != entry
+            ]
+            old_size = len(self._top)
+            total_changed = total != self._total
+            self._top, self._total = top, total
+            self._stats['rounds'] += 1
+
+            # Subscribers following the same N get the same encoded event
+            top_events: Dict[int, Optional[str]] = {}
+            for subscription in list(self._subscribers):
+                n = subscription.top
+                if n not in top_events:
+                    visible = [change for change in changes if change['position'] <= n]
+                    if visible or total_changed or min(n, old_size) != min(n, len(top)):
+                        top_events[n] = format_event('top', {
+                            'changes': visible,
+                            'size': min(n, len(top)),
+                            'total_users': total,
+                        })
+                    else:
+                        top_events[n] = None
+                events = [top_events[n]] if top_events[n] else []
+                if subscription.walletid:
+                    rank = self.index.rank(subscription.walletid)
+                    if rank != subscription.rank:
+                        subscription.rank = rank
+                        amount = self.index.amount(subscription.walletid)
+                        events.append(format_event('rank', {
+                            'walletid': subscription.walletid,
+                            'rank': rank,
+                            'amount': None if amount is None else format_number(from_units(int(amount))),
+                        }))
+                for event in events:
+                    if not subscription.push(event):
+                        self._subscribers.discard(subscription)
+                        self._stats['dropped'] += 1
+                        break
+                    self._stats['events'] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['subscribers'] = len(self._subscribers)
+        stats['pid'] = self._pid
+        return stats
+
+
+broadcaster = LeaderboardBroadcaster()
@@ -0,0 +1,388 @@
+"""
+Prometheus metrics shared by every gunicorn worker, served by /metrics.
+
+Each process records its samples in its own file, QXMR_METRICS_DIR/<pid>.metrics,
+through mmap: a sample is a fixed slot (key, float64) that is appended once
+and then updated in place, so recording costs a dict lookup and a
+struct.pack_into. Keys are encoded once per metric and label values. /metrics, served by whichever worker gets the request,
+reads the files of every process (workers and the writer sidecar) and adds
+them up: counters and histograms over all files, so a worker that exited
+keeps its counts, gauges only over the processes that are still running.
+gunicorn_config.py empties the directory when the server starts.
+
+SQLite time is measured by `TimedConnection` (see db.py and writer.py):
+execute/executemany and the fetch calls of their cursors, per database
+file. Rows read by iterating a cursor are not timed. BEGIN IMMEDIATE only
+waits for the write lock, so its duration is reported as lock wait.
+
+    QXMR_METRICS=0      records nothing and serves an empty /metrics
+"""
+import bisect
+import glob
+import json
+import mmap
+import os
+import sqlite3
+import struct
+import threading
+import time
+from collections import defaultdict
+from typing import Any, Dict, Iterator, List, Sequence, Tuple
+
+import tracing
+
+METRICS_DIR = os.environ.get('QXMR_METRICS_DIR', 'metrics')
+METRICS_ENABLED = os.environ.get('QXMR_METRICS', '1') == '1'
+SUFFIX = '.metrics'
+# Initial size of a process's file; doubled when it fills up
+INITIAL_SIZE = 64 * 1024
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SQLITE_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+# Entry: key length, key, padding to 8, float64 value. The header holds the
+# bytes in use, written after the entry so a reader never sees half of one.
+_USED = struct.Struct('<Q')
+_LENGTH = struct.Struct('<I')
+_VALUE = struct.Struct('<d')
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _entry_size(key: bytes) -> int:
+    return _LENGTH.size + len(key) + (-(_LENGTH.size + len(key)) % 8) + _VALUE.size
+
+
+class SampleFile:
+    """One process's samples, appended once per key and updated in place"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, 'a+b')
+        capacity = os.fstat(self._file.fileno()).st_size
+        if capacity == 0:
+            capacity = INITIAL_SIZE
+            self._file.truncate(capacity)
+        self._mmap = mmap.mmap(self._file.fileno(), capacity)
+        self._used = _USED.unpack_from(self._mmap, 0)[0] or _USED.size
+        self._offsets: Dict[str, int] = {key: offset for key, offset, _ in _entries(self._mmap, self._used)}
+
+    def _offset(self, key: str) -> int:
+        offset = self._offsets.get(key)
+        if offset is not None:
+            return offset
+        encoded = key.encode()
+        size = _entry_size(encoded)
+        if self._used + size > len(self._mmap):
+            capacity = len(self._mmap)
+            while self._used + size > capacity:
+                capacity *= 2
+            self._mmap.close()
+            self._file.truncate(capacity)
+            self._mmap = mmap.mmap(self._file.fileno(), capacity)
+        _LENGTH.pack_into(self._mmap, self._used, len(encoded))
+        self._mmap[self._used + _LENGTH.size:self._used + _LENGTH.size + len(encoded)] = encoded
+        offset = self._used + size - _VALUE.size
+        _VALUE.pack_into(self._mmap, offset, 0.0)
+        self._used += size
+        _USED.pack_into(self._mmap, 0, self._used)
+        self._offsets[key] = offset
+        return offset
+
+    def add(self, key: str, amount: float):
+        with self._lock:
+            offset = self._offset(key)
+            _VALUE.pack_into(self._mmap, offset, _VALUE.unpack_from(self._mmap, offset)[0] + amount)
+
+    def set(self, key: str, value: float):
+        with self._lock:
+            _VALUE.pack_into(self._mmap, self._offset(key), value)
+
+
+def _entries(data, used: int) -> Iterator[Tuple[str, int, float]]:
+    """(key, value offset, value) of every entry in the first `used` bytes"""
+    position = _USED.size
+    while position < used:
+        length = _LENGTH.unpack_from(data, position)[0]
+        key = bytes(data[position + _LENGTH.size:position + _LENGTH.size + length])
+        offset = position + _entry_size(key) - _VALUE.size
+        yield key.decode(), offset, _VALUE.unpack_from(data, offset)[0]
+        position = offset + _VALUE.size
+
+
+def read_samples(path: str) -> Iterator[Tuple[str, float]]:
+    with open(path, 'rb') as f:
+        data = f.read()
+    if len(data) < _USED.size:
+        return
+    used = min(_USED.unpack_from(data, 0)[0], len(data))
+    for key, _, value in _entries(data, used):
+        yield key, value
+
+
+class _Store:
+    """This process's SampleFile, opened on first use (again after a fork)"""
+
+    def __init__(self, directory: str = METRICS_DIR):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._pid = None
+        self._file = None
+
+    def get(self) -> SampleFile:
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    os.makedirs(self.directory, exist_ok=True)
+                    self._file = SampleFile(os.path.join(self.directory, f'{os.getpid()}{SUFFIX}'))
+                    self._pid = os.getpid()
+        return self._file
+
+
+_store = _Store()
+# name -> metric, for HELP and TYPE lines
+REGISTRY: Dict[str, '_Metric'] = {}
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        # Encoded sample keys by label values, so recording does not serialize them
+        self._keys: Dict[Tuple[Any, ...], str] = {}
+        REGISTRY[name] = self
+
+    def _encode(self, suffix: str, labels: Sequence[Any], extra: Sequence[Tuple[str, str]] = ()) -> str:
+        pairs = [[name, str(value)] for name, value in zip(self.labelnames, labels)] + [list(pair) for pair in extra]
+        return json.dumps([self.kind, self.name, suffix, pairs], separators=(',', ':'))
+
+    def _key(self, labels: Tuple[Any, ...]) -> str:
+        key = self._keys.get(labels)
+        if key is None:
+            key = self._keys[labels] = self._encode('', labels)
+        return key
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, *labels: Any, amount: float = 1.0):
+        if METRICS_ENABLED:
+            _store.get().add(self._key(labels), amount)
+
+
+class Gauge(_Metric):
+    """Per-process value; /metrics shows the sum over running processes"""
+    kind = 'gauge'
+
+    def inc(self, *labels: Any, amount: float = 1.0):
+        if METRICS_ENABLED:
+            _store.get().add(self._key(labels), amount)
+
+    def dec(self, *labels: Any, amount: float = 1.0):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(_Metric):
+    """Buckets are stored per bucket (not cumulative) and added up by `render`"""
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        self._bounds = [repr(float(bound)) for bound in self.buckets] + ['+Inf']
+        # Label values -> (key of each bucket, key of the sum)
+        self._children: Dict[Tuple[Any, ...], Tuple[List[str], str]] = {}
+
+    def _child(self, labels: Tuple[Any, ...]) -> Tuple[List[str], str]:
+        child = self._children.get(labels)
+        if child is None:
+            child = self._children[labels] = (
+                [self._encode('_bucket', labels, [('le', le)]) for le in self._bounds],
+                self._encode('_sum', labels),
+            )
+        return child
+
+    def observe(self, value: float, *labels: Any):
+        if not METRICS_ENABLED:
+            return
+        samples = _store.get()
+        buckets, total = self._child(labels)
+        samples.add(buckets[bisect.bisect_left(self.buckets, value)], 1.0)
+        samples.add(total, value)
+
+
+def _labels(pairs: List[List[str]]) -> str:
+    if not pairs:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _le(bound: str) -> float:
+    return float('inf') if bound == '+Inf' else float(bound)
+
+
+def collect(directory: str = METRICS_DIR) -> Dict[str, Any]:
+    """Samples of every process added up: family -> (kind, {(suffix, labels): value})"""
+    families: Dict[str, Tuple[str, Dict[Tuple[str, str], float]]] = {}
+    for path in glob.glob(os.path.join(directory, '*' + SUFFIX)):
+        try:
+            pid = int(os.path.basename(path)[:-len(SUFFIX)])
+            alive = pid == os.getpid() or _pid_alive(pid)
+            samples = list(read_samples(path))
+        except (ValueError, OSError):
+            continue  # Not ours, or removed meanwhile
+        for key, value in samples:
+            kind, name, suffix, pairs = json.loads(key)
+            if kind == 'gauge' and not alive:
+                continue
+            values = families.setdefault(name, (kind, defaultdict(float)))[1]
+            values[(suffix, json.dumps(pairs))] += value
+    return families
+
+
+def render(directory: str = METRICS_DIR) -> str:
+    """Prometheus text exposition format (0.0.4) of `collect`"""
+    lines = []
+    for name, (kind, values) in sorted(collect(directory).items()):
+        metric = REGISTRY.get(name)
+        if metric is not None:
+            lines.append(f'# HELP {name} {metric.documentation}')
+        lines.append(f'# TYPE {name} {kind}')
+        if kind != 'histogram':
+            for (_, pairs), value in sorted(values.items()):
+                lines.append(f'{name}{_labels(json.loads(pairs))} {value!r}')
+            continue
+        buckets: Dict[str, List[Tuple[float, str, float]]] = defaultdict(list)
+        sums: Dict[str, float] = {}
+        for (suffix, pairs), value in values.items():
+            if suffix == '_sum':
+                sums[pairs] = value
+            else:
+                pairs = json.loads(pairs)
+                bound = pairs.pop()[1]
+                buckets[json.dumps(pairs)].append((_le(bound), bound, value))
+        for pairs in sorted(set(buckets) | set(sums)):
+            labels = json.loads(pairs)
+            total = 0.0
+            bounds = {bound for _, bound, _ in buckets[pairs]} | {'+Inf'}
+            if isinstance(metric, Histogram):
+                bounds.update(metric._bounds)
+            counts = {bound: value for _, bound, value in buckets[pairs]}
+            for bound in sorted(bounds, key=_le):
+                total += counts.get(bound, 0.0)
+                lines.append(f'{name}_bucket{_labels(labels + [["le", bound]])} {total!r}')
+            lines.append(f'{name}_sum{_labels(labels)} {sums.get(pairs, 0.0)!r}')
+            lines.append(f'{name}_count{_labels(labels)} {total!r}')
+    return '\n'.join(lines) + '\n'
+
+
+http_requests = Counter('qxmr_http_requests_total', 'HTTP requests by route, method and status',
+                        ('route', 'method', 'status'))
+http_latency = Histogram('qxmr_http_request_duration_seconds', 'Time to produce a response, per route',
+                         ('route', 'method'))
+http_exceptions = Counter('qxmr_http_exceptions_total', 'Requests that ended with an unhandled exception',
+                          ('route',))
+sqlite_seconds = Histogram('qxmr_sqlite_statement_duration_seconds',
+                           'Time inside SQLite per statement (execute and fetch calls)', ('database',),
+                           SQLITE_BUCKETS)
+sqlite_lock_wait = Histogram('qxmr_sqlite_lock_wait_seconds', 'Time BEGIN IMMEDIATE waited for the write lock',
+                             ('database',), SQLITE_BUCKETS)
+sqlite_locked = Counter('qxmr_sqlite_locked_total', '"database is locked" errors (busy timeout expired)',
+                        ('database',))
+sqlite_errors = Counter('qxmr_sqlite_errors_total', 'Other SQLite errors', ('database',))
+sqlite_connections = Gauge('qxmr_sqlite_connections', 'Open pooled connections', ('database',))
+sqlite_connects = Counter('qxmr_sqlite_connects_total', 'Pooled connections opened', ('database',))
+sqlite_reuses = Counter('qxmr_sqlite_connection_reuses_total', 'Pooled connections handed out again',
+                        ('database',))
+
+
+def _record(label: str, start: float, error: BaseException = None):
+    end = time.perf_counter()
+    sqlite_seconds.observe(end - start, label)
+    if tracing.TRACING_ENABLED:
+        tracing.add('sql.' + label, start, end)
+    if error is None:
+        return
+    if isinstance(error, sqlite3.OperationalError) and 'locked' in str(error):
+        sqlite_locked.inc(label)
+    else:
+        sqlite_errors.inc(label)
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor recording its execute and fetch time in the metrics"""
+
+    def _timed(self, method, *args):
+        start = time.perf_counter()
+        try:
+            result = method(*args)
+        except sqlite3.Error as e:
+            _record(self.connection.label, start, e)
+            raise
+        _record(self.connection.label, start)
+        return result
+
+    def execute(self, sql: str, parameters: Any = ()):
+        if sql.startswith('BEGIN IMMEDIATE'):
+            start = time.perf_counter()
+            result = self._timed(super().execute, sql, parameters)
+            sqlite_lock_wait.observe(time.perf_counter() - start, self.connection.label)
+            return result
+        return self._timed(super().execute, sql, parameters)
+
+    def executemany(self, sql: str, parameters: Any):
+        return self._timed(super().executemany, sql, parameters)
+
+    def fetchone(self):
+        return self._timed(super().fetchone)
+
+    def fetchmany(self, *args):
+        return self._timed(super().fetchmany, *args)
+
+    def fetchall(self):
+        return self._timed(super().fetchall)
+
+
+class TimedConnection(sqlite3.Connection):
+    """sqlite3.connect(factory=...) for connections whose statements are timed under `label`"""
+    label = ''
+    path = ''
+    # ATTACH statements run on it, as (sql, parameters)
+    attached = ()
+    cursor_class = TimedCursor
+
+    def cursor(self, factory=None):
+        return super().cursor(factory or self.cursor_class)
+
+    def execute(self, sql: str, parameters: Any = ()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql: str, parameters: Any):
+        return self.cursor().executemany(sql, parameters)
+
+
+def connect(path: str, label: str, cursor_class: type = TimedCursor, **kwargs: Any) -> sqlite3.Connection:
+    """sqlite3.connect, timed under `label` unless metrics are off; `cursor_class`
+    may be a TimedCursor subclass doing more (sql_profiler.py)"""
+    if not METRICS_ENABLED and cursor_class is TimedCursor:
+        return sqlite3.connect(path, **kwargs)
+    conn = sqlite3.connect(path, factory=TimedConnection, **kwargs)
+    conn.label = label
+    conn.path = path
+    conn.cursor_class = cursor_class
+    return conn
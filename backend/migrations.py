@@ -0,0 +1,389 @@
+"""
+Versioned schema migrations for the backend databases.
+
+Each database tracks the last applied migration in `PRAGMA user_version`.
+`init_databases` creates the original (version 0) tables and then calls
+`migrate`, which applies every newer step in its own IMMEDIATE transaction,
+so several gunicorn workers starting at once cannot apply a step twice.
+"""
+import sqlite3
+from datetime import datetime
+from typing import Any, Callable, List, Tuple
+
+from units import UNITS_PER_QXMR
+from wallet_ids import parse_walletid, wallet_key
+
+Migration = Tuple[int, str, Callable[[sqlite3.Connection], None]]
+
+
+def _users_numeric_columns(conn: sqlite3.Connection):
+    """Store amount/paid/highest as REAL and gameleft as INTEGER, index the leaderboard"""
+    conn.execute('''
+        CREATE TABLE users_new (
+            walletid TEXT PRIMARY KEY,
+            amount REAL NOT NULL DEFAULT 0,
+            gameleft INTEGER NOT NULL DEFAULT 0,
+            lastplayed TEXT DEFAULT '',
+            paid REAL NOT NULL DEFAULT 0,
+            highest REAL NOT NULL DEFAULT 0,
+            col1 TEXT DEFAULT '',
+            col2 TEXT DEFAULT '',
+            col3 TEXT DEFAULT '',
+            leaderboard_access TEXT DEFAULT '0'
+        )
+    ''')
+    conn.execute('''
+        INSERT INTO users_new (walletid, amount, gameleft, lastplayed, paid, highest,
+                               col1, col2, col3, leaderboard_access)
+        SELECT walletid,
+               CAST(COALESCE(NULLIF(amount, ''), '0') AS REAL),
+               CAST(CAST(COALESCE(NULLIF(gameleft, ''), '0') AS REAL) AS INTEGER),
+               COALESCE(lastplayed, ''),
+               CAST(COALESCE(NULLIF(paid, ''), '0') AS REAL),
+               CAST(COALESCE(NULLIF(highest, ''), '0') AS REAL),
+               col1, col2, col3,
+               COALESCE(leaderboard_access, '0')
+        FROM users
+    ''')
+    conn.execute('DROP TABLE users')
+    conn.execute('ALTER TABLE users_new RENAME TO users')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_users_leaderboard
+        ON users(leaderboard_access, amount DESC)
+    ''')
+
+
+def _users_leaderboard_seq(conn: sqlite3.Connection):
+    """Stamp leaderboard changes with an increasing sequence so workers can catch up"""
+    conn.execute('ALTER TABLE users ADD COLUMN leaderboard_seq INTEGER NOT NULL DEFAULT 0')
+    _create_leaderboard_seq_triggers(conn)
+
+
+def _create_leaderboard_seq_triggers(conn: sqlite3.Connection):
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_users_leaderboard_seq ON users(leaderboard_seq)')
+    bump = '''
+        UPDATE users SET leaderboard_seq = (SELECT MAX(leaderboard_seq) FROM users) + 1
+        WHERE walletid = NEW.walletid;
+    '''
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS users_leaderboard_insert
+        AFTER INSERT ON users WHEN NEW.leaderboard_access = '1'
+        BEGIN {bump} END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS users_leaderboard_update
+        AFTER UPDATE OF amount, leaderboard_access ON users
+        WHEN OLD.amount IS NOT NEW.amount OR OLD.leaderboard_access IS NOT NEW.leaderboard_access
+        BEGIN {bump} END
+    ''')
+
+
+def _users_fixed_point(conn: sqlite3.Connection):
+    """Store amount and paid as INTEGER base units (see units.py)"""
+    conn.execute('''
+        CREATE TABLE users_new (
+            walletid TEXT PRIMARY KEY,
+            amount INTEGER NOT NULL DEFAULT 0,
+            gameleft INTEGER NOT NULL DEFAULT 0,
+            lastplayed TEXT DEFAULT '',
+            paid INTEGER NOT NULL DEFAULT 0,
+            highest REAL NOT NULL DEFAULT 0,
+            col1 TEXT DEFAULT '',
+            col2 TEXT DEFAULT '',
+            col3 TEXT DEFAULT '',
+            leaderboard_access TEXT DEFAULT '0',
+            leaderboard_seq INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    conn.execute(f'''
+        INSERT INTO users_new (walletid, amount, gameleft, lastplayed, paid, highest,
+                               col1, col2, col3, leaderboard_access, leaderboard_seq)
+        SELECT walletid,
+               CAST(ROUND(amount * {UNITS_PER_QXMR}) AS INTEGER),
+               gameleft, lastplayed,
+               CAST(ROUND(paid * {UNITS_PER_QXMR}) AS INTEGER),
+               highest, col1, col2, col3, leaderboard_access, leaderboard_seq
+        FROM users
+    ''')
+    conn.execute('DROP TABLE users')
+    conn.execute('ALTER TABLE users_new RENAME TO users')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_users_leaderboard
+        ON users(leaderboard_access, amount DESC)
+    ''')
+    _create_leaderboard_seq_triggers(conn)
+
+
+def _transactions_fixed_point(conn: sqlite3.Connection):
+    """Store transactions.paid as INTEGER base units instead of TEXT"""
+    conn.execute('''
+        CREATE TABLE transactions_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            walletid TEXT NOT NULL,
+            hash TEXT NOT NULL,
+            paid INTEGER NOT NULL,
+            col1 TEXT DEFAULT '',
+            col2 TEXT DEFAULT ''
+        )
+    ''')
+    conn.execute(f'''
+        INSERT INTO transactions_new (id, walletid, hash, paid, col1, col2)
+        SELECT id, walletid, hash,
+               CAST(ROUND(CAST(COALESCE(NULLIF(paid, ''), '0') AS REAL) * {UNITS_PER_QXMR}) AS INTEGER),
+               col1, col2
+        FROM transactions
+    ''')
+    conn.execute('DROP TABLE transactions')
+    conn.execute('ALTER TABLE transactions_new RENAME TO transactions')
+
+
+def _users_games_day(conn: sqlite3.Connection):
+    """Record which day gameleft belongs to, so the daily reset happens at read time"""
+    conn.execute("ALTER TABLE users ADD COLUMN games_day TEXT NOT NULL DEFAULT ''")
+    conn.execute("UPDATE users SET games_day = substr(lastplayed, 1, 10) WHERE lastplayed != ''")
+
+
+def _create_generation_counter(conn: sqlite3.Connection, table: str):
+    """Count every write to `table` in `generations` (see db.generation)"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS generations (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    conn.execute('INSERT OR IGNORE INTO generations (name, value) VALUES (?, 0)', (table,))
+    for event in ('INSERT', 'UPDATE', 'DELETE'):
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_generation_{event.lower()}
+            AFTER {event} ON {table}
+            BEGIN UPDATE generations SET value = value + 1 WHERE name = '{table}'; END
+        ''')
+
+
+def _users_generation(conn: sqlite3.Connection):
+    _create_generation_counter(conn, 'users')
+
+
+def _daily_scores_generation(conn: sqlite3.Connection):
+    _create_generation_counter(conn, 'daily_scores')
+
+
+def _users_amount_index(conn: sqlite3.Connection):
+    """Index the (amount, walletid) order /admin/users pages through"""
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_users_amount ON users(amount, walletid)')
+
+
+def _users_seasons(conn: sqlite3.Connection):
+    """Stamp amounts with their season, so a balance reset is one INSERT (see seasons.py)"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS seasons (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            started TEXT NOT NULL,
+            ended TEXT
+        )
+    ''')
+    conn.execute('INSERT INTO seasons (id, started) VALUES (1, ?)', (datetime.now().isoformat(),))
+    conn.execute('ALTER TABLE users ADD COLUMN amount_season INTEGER NOT NULL DEFAULT 1')
+    # Only non-zero amounts can be stale, and only they need clearing
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_users_stale ON users(amount_season) WHERE amount != 0')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS season_standings (
+            season INTEGER NOT NULL,
+            amount INTEGER NOT NULL,
+            walletid TEXT NOT NULL,
+            PRIMARY KEY (season, amount DESC, walletid)
+        ) WITHOUT ROWID
+    ''')
+
+
+def _daily_scores_rank_index(conn: sqlite3.Connection):
+    """Order each day's rows by score, so a date's winner and top N are index reads"""
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_daily_scores_rank
+        ON daily_scores(score_date, score DESC, walletid)
+    ''')
+
+
+def _daily_scores_claimed_index(conn: sqlite3.Connection):
+    """Index only the paid winners, so the last settled day is one index read"""
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_daily_scores_claimed
+        ON daily_scores(score_date) WHERE prize_claimed = '1'
+    ''')
+
+
+def _stored_walletid(walletid: Any) -> Any:
+    """Key of a valid identity, the UTF-8 text of anything else (see wallet_ids.py)"""
+    if not isinstance(walletid, str):
+        return walletid
+    try:
+        return wallet_key(parse_walletid(walletid))
+    except ValueError:
+        return walletid.encode()
+
+
+def _register_stored_walletid(conn: sqlite3.Connection):
+    conn.create_function('stored_walletid', 1, _stored_walletid, deterministic=True)
+
+
+def _users_binary_walletid(conn: sqlite3.Connection):
+    """Store users and season_standings wallet ids as 32-byte keys"""
+    _register_stored_walletid(conn)
+    conn.execute('''
+        CREATE TABLE users_new (
+            walletid BLOB PRIMARY KEY,
+            amount INTEGER NOT NULL DEFAULT 0,
+            gameleft INTEGER NOT NULL DEFAULT 0,
+            lastplayed TEXT DEFAULT '',
+            paid INTEGER NOT NULL DEFAULT 0,
+            highest REAL NOT NULL DEFAULT 0,
+            col1 TEXT DEFAULT '',
+            col2 TEXT DEFAULT '',
+            col3 TEXT DEFAULT '',
+            leaderboard_access TEXT DEFAULT '0',
+            leaderboard_seq INTEGER NOT NULL DEFAULT 0,
+            games_day TEXT NOT NULL DEFAULT '',
+            amount_season INTEGER NOT NULL DEFAULT 1
+        )
+    ''')
+    conn.execute('''
+        INSERT INTO users_new (walletid, amount, gameleft, lastplayed, paid, highest, col1, col2, col3,
+                               leaderboard_access, leaderboard_seq, games_day, amount_season)
+        SELECT stored_walletid(walletid), amount, gameleft, lastplayed, paid, highest, col1, col2, col3,
+               leaderboard_access, leaderboard_seq, games_day, amount_season
+        FROM users
+    ''')
+    conn.execute('DROP TABLE users')
+    conn.execute('ALTER TABLE users_new RENAME TO users')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_users_leaderboard ON users(leaderboard_access, amount DESC)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_users_amount ON users(amount, walletid)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_users_stale ON users(amount_season) WHERE amount != 0')
+    _create_leaderboard_seq_triggers(conn)
+    _create_generation_counter(conn, 'users')
+
+    conn.execute('''
+        CREATE TABLE season_standings_new (
+            season INTEGER NOT NULL,
+            amount INTEGER NOT NULL,
+            walletid BLOB NOT NULL,
+            PRIMARY KEY (season, amount DESC, walletid)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('''
+        INSERT INTO season_standings_new (season, amount, walletid)
+        SELECT season, amount, stored_walletid(walletid) FROM season_standings
+    ''')
+    conn.execute('DROP TABLE season_standings')
+    conn.execute('ALTER TABLE season_standings_new RENAME TO season_standings')
+
+
+def _transactions_binary_walletid(conn: sqlite3.Connection):
+    """Store transactions.walletid as a 32-byte key"""
+    _register_stored_walletid(conn)
+    conn.execute('''
+        CREATE TABLE transactions_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            walletid BLOB NOT NULL,
+            hash TEXT NOT NULL,
+            paid INTEGER NOT NULL,
+            col1 TEXT DEFAULT '',
+            col2 TEXT DEFAULT ''
+        )
+    ''')
+    conn.execute('''
+        INSERT INTO transactions_new (id, walletid, hash, paid, col1, col2)
+        SELECT id, stored_walletid(walletid), hash, paid, col1, col2
+        FROM transactions
+    ''')
+    conn.execute('DROP TABLE transactions')
+    conn.execute('ALTER TABLE transactions_new RENAME TO transactions')
+
+
+def _transactions_indexes(conn: sqlite3.Connection):
+    """Make hash unique (one credit per transaction) and index each wallet's transactions.
+
+    Rows repeating an earlier hash were credited twice; they move to
+    transactions_duplicates so the unique index can be built.
+    """
+    conn.execute('CREATE TABLE IF NOT EXISTS transactions_duplicates AS SELECT * FROM transactions WHERE 0')
+    duplicates = 'id NOT IN (SELECT MIN(id) FROM transactions GROUP BY hash)'
+    conn.execute(f'INSERT INTO transactions_duplicates SELECT * FROM transactions WHERE {duplicates}')
+    conn.execute(f'DELETE FROM transactions WHERE {duplicates}')
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_transactions_hash ON transactions(hash)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_transactions_walletid ON transactions(walletid, id)')
+
+
+def _daily_scores_binary_walletid(conn: sqlite3.Connection):
+    """Store daily_scores.walletid as a 32-byte key"""
+    _register_stored_walletid(conn)
+    conn.execute('''
+        CREATE TABLE daily_scores_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            walletid BLOB NOT NULL,
+            score_date TEXT NOT NULL,
+            score REAL NOT NULL,
+            prize_claimed TEXT DEFAULT '0',
+            UNIQUE(walletid, score_date)
+        )
+    ''')
+    conn.execute('''
+        INSERT INTO daily_scores_new (id, walletid, score_date, score, prize_claimed)
+        SELECT id, stored_walletid(walletid), score_date, score, prize_claimed
+        FROM daily_scores
+    ''')
+    conn.execute('DROP TABLE daily_scores')
+    conn.execute('ALTER TABLE daily_scores_new RENAME TO daily_scores')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_daily_scores_date ON daily_scores(score_date)')
+    _daily_scores_rank_index(conn)
+    _daily_scores_claimed_index(conn)
+    _create_generation_counter(conn, 'daily_scores')
+
+
+USERS_MIGRATIONS: List[Migration] = [
+    (1, 'numeric user columns and leaderboard index', _users_numeric_columns),
+    (2, 'leaderboard change sequence', _users_leaderboard_seq),
+    (3, 'fixed-point amount and paid', _users_fixed_point),
+    (4, 'games_day for the daily free games', _users_games_day),
+    (5, 'users generation counter', _users_generation),
+    (6, 'amount index for admin pagination', _users_amount_index),
+    (7, 'seasons and season standings', _users_seasons),
+    (8, 'wallet ids as 32-byte keys', _users_binary_walletid),
+]
+
+TRANSACTIONS_MIGRATIONS: List[Migration] = [
+    (1, 'fixed-point paid', _transactions_fixed_point),
+    (2, 'wallet ids as 32-byte keys', _transactions_binary_walletid),
+    (3, 'unique hash and per-wallet index', _transactions_indexes),
+]
+
+DAILY_SCORES_MIGRATIONS: List[Migration] = [
+    (1, 'daily_scores generation counter', _daily_scores_generation),
+    (2, 'per-day rank index', _daily_scores_rank_index),
+    (3, 'claimed prizes index for settlement', _daily_scores_claimed_index),
+    (4, 'wallet ids as 32-byte keys', _daily_scores_binary_walletid),
+]
+
+
+def migrate(path: str, migrations: List[Migration]) -> int:
+    """Apply pending migrations to the database at `path`, return its version"""
+    conn = sqlite3.connect(path, isolation_level=None, timeout=30)
+    try:
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        for target, description, step in migrations:
+            if target <= version:
+                continue
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                # Another worker may have migrated while we waited for the lock
+                version = conn.execute('PRAGMA user_version').fetchone()[0]
+                if target > version:
+                    step(conn)
+                    conn.execute(f'PRAGMA user_version = {int(target)}')
+                    version = target
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        return version
+    finally:
+        conn.close()
@@ -0,0 +1,125 @@
+"""
+Keyset pagination and streamed exports for the admin listings.
+
+Pages are read with `WHERE (key) < (last key seen) ORDER BY key DESC LIMIT n`
+on an index, so fetching page 1000 costs the same as page 1 and no
+request ever holds more than one page of rows. Exports walk the same
+pages and yield each one as soon as it is encoded, which keeps memory
+flat however large the table is.
+"""
+import base64
+import csv
+import io
+import json
+import sqlite3
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+# Rows per page when the client does not ask for a size, and at most
+PAGE_SIZE = 500
+MAX_PAGE_SIZE = 5000
+# Rows per query while streaming an export
+EXPORT_PAGE_SIZE = 1000
+
+
+def encode_cursor(values: Sequence[Any]) -> str:
+    # BLOB keys (wallet ids, see wallet_ids.py) travel as {"b": hex}
+    values = [{'b': value.hex()} if isinstance(value, bytes) else value for value in values]
+    return base64.urlsafe_b64encode(json.dumps(values, separators=(',', ':')).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str, size: int) -> List[Any]:
+    """Key values from `encode_cursor`; ValueError if the cursor is malformed"""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (ValueError, TypeError) as e:
+        raise ValueError(f'Invalid cursor: {e}')
+    if not isinstance(values, list) or len(values) != size:
+        raise ValueError('Invalid cursor')
+    try:
+        return [bytes.fromhex(value['b']) if isinstance(value, dict) else value for value in values]
+    except (KeyError, TypeError, ValueError):
+        raise ValueError('Invalid cursor')
+
+
+class KeysetQuery:
+    """Rows of `table` in descending `key` order, read a page at a time.
+
+    `where` restricts the rows with a condition whose parameters are passed
+    to `page`/`pages`; the index should start with its equality columns
+    followed by `key`. `key_sql` orders by expressions instead of the `key`
+    columns; `columns` must then select each expression under its key name.
+    """
+
+    def __init__(self, table: str, columns: str, key: Tuple[str, ...], where: Optional[str] = None,
+                 key_sql: Optional[Tuple[str, ...]] = None):
+        self.table = table
+        self.columns = columns
+        self.key = key
+        key_sql = key_sql or key
+        order = ', '.join(f'{column} DESC' for column in key_sql)
+        after = f'({", ".join(key_sql)}) < ({", ".join("?" * len(key))})'
+        self._first = f'SELECT {columns} FROM {table} {f"WHERE {where} " if where else ""}ORDER BY {order} LIMIT ?'
+        self._after = (
+            f'SELECT {columns} FROM {table} '
+            f'WHERE {f"{where} AND " if where else ""}{after} '
+            f'ORDER BY {order} LIMIT ?'
+        )
+
+    def cursor_of(self, row: sqlite3.Row) -> str:
+        return encode_cursor([row[column] for column in self.key])
+
+    def page(self, conn: sqlite3.Connection, cursor: Optional[str], limit: int,
+             params: Sequence[Any] = ()) -> Tuple[List[sqlite3.Row], Optional[str]]:
+        """Up to `limit` rows after `cursor`, and the cursor of the next page (None at the end)"""
+        if cursor:
+            rows = conn.execute(self._after, [*params, *decode_cursor(cursor, len(self.key)), limit]).fetchall()
+        else:
+            rows = conn.execute(self._first, [*params, limit]).fetchall()
+        next_cursor = self.cursor_of(rows[-1]) if len(rows) == limit else None
+        return rows, next_cursor
+
+    def pages(self, conn: sqlite3.Connection, cursor: Optional[str] = None,
+              page_size: int = EXPORT_PAGE_SIZE, params: Sequence[Any] = ()) -> Iterator[List[sqlite3.Row]]:
+        """Every page from `cursor` to the end of the table"""
+        while True:
+            rows, cursor = self.page(conn, cursor, page_size, params)
+            if rows:
+                yield rows
+            if cursor is None:
+                return
+
+
+Convert = Callable[[sqlite3.Row], Dict[str, Any]]
+Dumps = Callable[[Any], str]
+
+
+def json_chunks(name: str, pages: Iterable[List[sqlite3.Row]], convert: Convert, dumps: Dumps,
+                head: Optional[Dict[str, Any]] = None) -> Iterator[str]:
+    """`{...head, "<name>": [...]}`, one page of array items per chunk"""
+    fields = ''.join(f'{dumps(key)}:{dumps(value)},' for key, value in (head or {}).items())
+    yield f'{{{fields}{dumps(name)}:['
+    separator = ''
+    for rows in pages:
+        yield separator + ','.join(dumps(convert(row)) for row in rows)
+        separator = ','
+    yield ']}'
+
+
+def ndjson_chunks(pages: Iterable[List[sqlite3.Row]], convert: Convert, dumps: Dumps) -> Iterator[str]:
+    """One JSON object per line"""
+    for rows in pages:
+        yield ''.join(dumps(convert(row)) + '\n' for row in rows)
+
+
+def csv_chunks(fields: Sequence[str], pages: Iterable[List[sqlite3.Row]], convert: Convert) -> Iterator[str]:
+    """A header line, then one line per row"""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fields, extrasaction='ignore')
+    writer.writeheader()
+    for rows in pages:
+        writer.writerows(convert(row) for row in rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
@@ -0,0 +1,181 @@
+"""
+On-demand cProfile of single requests.
+
+A request is profiled when it carries `X-Profile-Token: <QXMR_PROFILE_TOKEN>`,
+or at random with probability QXMR_PROFILE_SAMPLE_RATE. Without a token or
+a rate the middleware is not installed, so it costs nothing. The profile
+covers the view and, for streamed responses, producing the body; under
+gevent it also includes whatever other greenlets run on the worker in the
+meantime.
+
+Each profile is a pstats file, QXMR_PROFILE_DIR/<name>.pstats, with a
+<name>.json of the request it came from; the newest PROFILE_KEEP are kept.
+The response names it in an X-Profile header, and /admin/profiles lists
+and serves them (raw, for `python -m pstats` or snakeviz, or as a text
+report).
+"""
+import cProfile
+import hmac
+import io
+import json
+import os
+import pstats
+import random
+import re
+import threading
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+PROFILE_DIR = os.environ.get('QXMR_PROFILE_DIR', 'profiles')
+PROFILE_TOKEN = os.environ.get('QXMR_PROFILE_TOKEN', '')
+PROFILE_SAMPLE_RATE = float(os.environ.get('QXMR_PROFILE_SAMPLE_RATE', '0'))
+PROFILE_KEEP = int(os.environ.get('QXMR_PROFILE_KEEP', '100'))
+PROFILE_ENABLED = bool(PROFILE_TOKEN) or PROFILE_SAMPLE_RATE > 0
+
+HEADER = 'HTTP_X_PROFILE_TOKEN'
+SUFFIX = '.pstats'
+NAME = re.compile(r'^\d{8}T\d{12}-\d+$')
+SORT_KEYS = ('cumulative', 'tottime', 'calls', 'ncalls')
+
+
+class _Capture:
+    """One profiled request: the profiler and what to write next to it"""
+
+    def __init__(self, store: 'ProfileStore', environ: Dict[str, Any], reason: str):
+        self.store = store
+        self.profile = cProfile.Profile()
+        self.name = f'{datetime.now():%Y%m%dT%H%M%S%f}-{os.getpid()}'
+        self.meta = {
+            'name': self.name, 'method': environ.get('REQUEST_METHOD'), 'path': environ.get('PATH_INFO'),
+            'query': environ.get('QUERY_STRING', ''), 'reason': reason, 'pid': os.getpid(),
+            'created': datetime.now().isoformat(), 'status': None,
+        }
+        self.seconds = 0.0
+
+    def run(self, fn: Callable, *args):
+        start = time.perf_counter()
+        self.profile.enable()
+        try:
+            return fn(*args)
+        finally:
+            self.profile.disable()
+            self.seconds += time.perf_counter() - start
+
+    def save(self):
+        self.store.save(self.name, self.profile, dict(self.meta, ms=round(self.seconds * 1000, 3)))
+
+
+class _ProfiledBody:
+    """Response body whose iteration and close() are profiled; saved on close()"""
+
+    def __init__(self, body: Iterable[bytes], capture: _Capture):
+        self._body = body
+        self._iterator = None
+        self._capture = capture
+
+    def __iter__(self):
+        self._iterator = iter(self._body)
+        return self
+
+    def __next__(self) -> bytes:
+        return self._capture.run(next, self._iterator)
+
+    def close(self):
+        try:
+            close = getattr(self._body, 'close', None)
+            if close is not None:
+                self._capture.run(close)
+        finally:
+            self._capture.save()
+
+
+class ProfileStore:
+    """The profile files in `directory`"""
+
+    def __init__(self, directory: str = PROFILE_DIR, keep: int = PROFILE_KEEP):
+        self.directory = directory
+        self.keep = keep
+        self._lock = threading.Lock()
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.directory, name + SUFFIX)
+
+    def names(self) -> List[str]:
+        try:
+            files = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return sorted(name[:-len(SUFFIX)] for name in files if name.endswith(SUFFIX))
+
+    def save(self, name: str, profile: cProfile.Profile, meta: Dict[str, Any]):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, name + '.json'), 'w') as f:
+            json.dump(meta, f)
+        profile.dump_stats(self.path(name))
+        with self._lock:
+            for old in self.names()[:-self.keep or None]:
+                for path in (self.path(old), os.path.join(self.directory, old + '.json')):
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+
+    def meta(self, name: str) -> Optional[Dict[str, Any]]:
+        if not NAME.match(name):
+            return None
+        try:
+            with open(os.path.join(self.directory, name + '.json')) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def list(self) -> List[Dict[str, Any]]:
+        """Metadata of every profile, newest first"""
+        return [meta for meta in map(self.meta, reversed(self.names())) if meta is not None]
+
+    def report(self, name: str, sort: str = 'cumulative', limit: int = 50) -> str:
+        """pstats text report of a profile"""
+        out = io.StringIO()
+        stats = pstats.Stats(self.path(name), stream=out)
+        stats.strip_dirs().sort_stats(sort).print_stats(limit)
+        return out.getvalue()
+
+
+profile_store = ProfileStore()
+
+
+class ProfilingMiddleware:
+    """WSGI middleware profiling the requests picked by the token header or the sample rate"""
+
+    def __init__(self, app: Callable, store: ProfileStore = profile_store, token: str = PROFILE_TOKEN,
+                 sample_rate: float = PROFILE_SAMPLE_RATE):
+        self.app = app
+        self.store = store
+        self.token = token
+        self.sample_rate = sample_rate
+
+    def _reason(self, environ: Dict[str, Any]) -> Optional[str]:
+        given = environ.get(HEADER)
+        if given is not None and self.token and hmac.compare_digest(given.encode(), self.token.encode()):
+            return 'token'
+        if self.sample_rate and random.random() < self.sample_rate:
+            return 'sample'
+        return None
+
+    def __call__(self, environ: Dict[str, Any], start_response: Callable):
+        reason = self._reason(environ)
+        if reason is None:
+            return self.app(environ, start_response)
+        capture = _Capture(self.store, environ, reason)
+
+        def start(status: str, headers: List, exc_info=None):
+            capture.meta['status'] = int(status.split(' ', 1)[0])
+            return start_response(status, headers + [('X-Profile', capture.name)], exc_info)
+
+        try:
+            body = capture.run(self.app, environ, start)
+        except Exception:
+            capture.save()
+            raise
+        return _ProfiledBody(body, capture)
@@ -0,0 +1,81 @@
+"""
+Cache of serialized responses for the polled read endpoints.
+
+Entries are keyed by endpoint and query parameters and remember the data
+version they were built from: the generation counters of the tables the
+response reads (see db.generation) plus anything else it depends on, such
+as today's date. A lookup with a different version is a miss, so a page
+is never served after a write that could change it, whichever worker or
+the sidecar writer made that write.
+
+The same (key, version) pair also names the response for HTTP caching:
+`data_etag` turns it into a strong ETag that every worker computes alike.
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+
+# Entries kept per worker, least recently used dropped first
+MAX_ENTRIES = 1024
+
+
+def data_etag(key: Hashable, version: Hashable) -> str:
+    """Strong ETag for the response to `key` built at `version`"""
+    return hashlib.blake2b(repr((key, version)).encode(), digest_size=12).hexdigest()
+
+
+class ResponseCache:
+    """Bounded LRU of response bodies, each valid for one data version"""
+
+    def __init__(self, max_entries: int = MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries: 'OrderedDict[Hashable, tuple]' = OrderedDict()
+        self._reset_stats()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self._stats = {'hits': 0, 'misses': 0, 'invalidations': 0, 'evictions': 0}
+
+    def get(self, key: Hashable, version: Hashable) -> Optional[bytes]:
+        """The cached body for `key` if it was built at `version`"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+            if entry[0] != version:
+                del self._entries[key]
+                self._stats['invalidations'] += 1
+                self._stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+            return entry[1]
+
+    def put(self, key: Hashable, version: Hashable, body: bytes):
+        with self._lock:
+            self._entries[key] = (version, body)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = round(stats['hits'] / lookups, 4) if lookups else 0
+        stats['pid'] = os.getpid()
+        return stats
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,134 @@
+"""
+Seasons: /admin/reset-balances starts a new one instead of rewriting users.
+
+users.amount only counts in the season stamped in users.amount_season; in
+any later season the player's amount is 0. Starting a season is one
+INSERT into `seasons`, and readers and commands treat older amounts as 0
+from then on (USER_COLUMNS in store.py and leaderboard_index.py compare
+the stamp with CURRENT_SEASON).
+
+The writer clears them between batches, CLEANUP_CHUNK rows per
+transaction and at most CLEANUP_BUDGET seconds per run. The amount of
+every row with leaderboard access is first archived in
+`season_standings`, the final standings of its season. A command that
+overwrites an older amount before the cleanup reaches it archives it
+the same way (UserRecord.flush).
+"""
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, Iterable, Tuple
+
+# Scalar subquery for the current season, usable in any users.db statement
+CURRENT_SEASON = '(SELECT MAX(id) FROM seasons)'
+# A users row's amount as it counts now: 0 if it is stamped with a past season
+SEASON_AMOUNT = f'CASE WHEN amount_season = {CURRENT_SEASON} THEN amount ELSE 0 END'
+# Rows archived and cleared per transaction
+CLEANUP_CHUNK = 500
+# Seconds of cleanup per background run, so commands are not held up
+CLEANUP_BUDGET = 0.05
+
+ARCHIVE = 'INSERT OR IGNORE INTO season_standings (season, amount, walletid) VALUES (?, ?, ?)'
+
+
+def current_season(conn: sqlite3.Connection) -> int:
+    return conn.execute(f'SELECT {CURRENT_SEASON}').fetchone()[0]
+
+
+def start_season(conn: sqlite3.Connection) -> int:
+    """End the current season and start the next, return its id.
+
+    Nothing is counted here: the rows to clear are only found by the cleanup,
+    whose stats report them (SeasonCleanup.stats).
+    """
+    previous = current_season(conn)
+    now = datetime.now().isoformat()
+    conn.execute('UPDATE seasons SET ended = ? WHERE id = ?', (now, previous))
+    season = conn.execute('INSERT INTO seasons (started) VALUES (?)', (now,)).lastrowid
+    # Every amount changed without touching users: invalidate cached responses
+    conn.execute("UPDATE generations SET value = value + 1 WHERE name = 'users'")
+    return season
+
+
+def has_stale_amounts(conn: sqlite3.Connection) -> bool:
+    """True until the cleanup has cleared every past-season amount (read from idx_users_stale).
+
+    Until then `amount` and SEASON_AMOUNT differ for some rows, and a query
+    ordering or comparing amounts has to use SEASON_AMOUNT.
+    """
+    return conn.execute(
+        f'SELECT 1 FROM users WHERE amount != 0 AND amount_season < {CURRENT_SEASON} LIMIT 1'
+    ).fetchone() is not None
+
+
+def archive(conn: sqlite3.Connection, rows: Iterable[Tuple[int, int, str]]):
+    """Record (season, amount, walletid) in that season's final standings"""
+    conn.executemany(ARCHIVE, rows)
+
+
+class SeasonCleanup:
+    """Writer background task archiving and zeroing amounts of past seasons"""
+
+    def __init__(self, chunk: int = CLEANUP_CHUNK, budget: float = CLEANUP_BUDGET):
+        self.chunk = chunk
+        self.budget = budget
+        self._lock = threading.Lock()
+        # Season whose cleanup is known to be complete
+        self._clean_season = None
+        self._stats = {'rows_cleared': 0, 'rows_archived': 0, 'chunks': 0, 'seasons_cleaned': 0}
+        # Progress of the latest season's cleanup: rows it reset and archived so far
+        self._season = {'season': None, 'rows_cleared': 0, 'rows_archived': 0, 'done': False}
+
+    def clean_chunk(self, conn: sqlite3.Connection, season: int) -> int:
+        """Archive and clear up to `chunk` older amounts in one transaction, return how many"""
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            rows = conn.execute('''
+                SELECT walletid, amount, amount_season, leaderboard_access FROM users
+                WHERE amount != 0 AND amount_season < ?
+                LIMIT ?
+            ''', (season, self.chunk)).fetchall()
+            archived = [(row[2], row[1], row[0]) for row in rows if row[3] == '1']
+            archive(conn, archived)
+            conn.executemany('UPDATE users SET amount = 0, amount_season = ? WHERE walletid = ?',
+                             [(season, row[0]) for row in rows])
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        with self._lock:
+            self._stats['rows_cleared'] += len(rows)
+            self._stats['rows_archived'] += len(archived)
+            self._stats['chunks'] += 1
+            if self._season['season'] != season:
+                self._season = {'season': season, 'rows_cleared': 0, 'rows_archived': 0, 'done': False}
+            self._season['rows_cleared'] += len(rows)
+            self._season['rows_archived'] += len(archived)
+        return len(rows)
+
+    def run(self, conn: sqlite3.Connection, phase: str):
+        """Writer background hook: clean for up to `budget` seconds (not on stop)"""
+        if phase == 'stop':
+            return
+        try:
+            season = current_season(conn)
+        except sqlite3.OperationalError:
+            return  # Not migrated yet: a sidecar writer starts before the workers
+        if season == self._clean_season:
+            return
+        deadline = time.monotonic() + self.budget
+        while time.monotonic() < deadline:
+            if self.clean_chunk(conn, season) < self.chunk:
+                self._clean_season = season
+                with self._lock:
+                    self._stats['seasons_cleaned'] += 1
+                    self._season['done'] = True
+                return
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self._stats, clean_season=self._clean_season, current=dict(self._season))
+
+
+season_cleanup = SeasonCleanup()
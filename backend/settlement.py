@@ -0,0 +1,143 @@
+"""
+Daily prize settlement.
+
+Every final day (see daily_rankings.py) after the last settled one gets
+one payout: PRIZE_AMOUNT to the day's winner. A run finds the winners of
+all pending days with one window query, marks their rows
+prize_claimed = '1' with one executemany and writes the payout manifest,
+all before the transaction commits. The manifest is written to
+`<name>.json.tmp` and only renamed to `<name>.json` once the commit went
+through, so a manifest in QXMR_PAYOUT_DIR always lists prizes that are
+recorded as claimed.
+
+The last settled day is MAX(score_date) over the claimed rows, read from
+the partial index idx_daily_scores_claimed, so finding pending days costs
+the same however long the history is.
+
+    python settlement.py [--through YYYY-MM-DD] [--dry-run]
+
+runs it against daily_scores.db in the working directory; POST
+/admin/settle-prizes runs the same job in the writer.
+"""
+import argparse
+import json
+import os
+import sqlite3
+import sys
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from daily_rankings import PRIZE_AMOUNT, last_final_day
+from wallet_ids import wallet_id
+
+PAYOUT_DIR = os.environ.get('QXMR_PAYOUT_DIR', 'payouts')
+
+# Each day's best score from the first to the last pending day, over idx_daily_scores_rank
+PENDING_WINNERS = '''
+    SELECT score_date, walletid, score FROM (
+        SELECT score_date, walletid, score,
+               ROW_NUMBER() OVER (PARTITION BY score_date ORDER BY score DESC, walletid) AS place
+        FROM daily_scores
+        WHERE score_date BETWEEN ? AND ?
+    )
+    WHERE place = 1
+    ORDER BY score_date
+'''
+LAST_SETTLED_DAY = "SELECT MAX(score_date) FROM daily_scores WHERE prize_claimed = '1'"
+MARK_CLAIMED = "UPDATE daily_scores SET prize_claimed = '1' WHERE walletid = ? AND score_date = ?"
+
+
+def pending_days(conn: sqlite3.Connection, through: Optional[str] = None) -> Optional[List[str]]:
+    """[first, last] pending day up to `through` (default the last final day), None if none is"""
+    last = last_final_day()
+    if through is not None:
+        last = min(last, date.fromisoformat(through))
+    settled = conn.execute(LAST_SETTLED_DAY).fetchone()[0]
+    first = (date.fromisoformat(settled) + timedelta(days=1)).isoformat() if settled else ''
+    if first > last.isoformat():
+        return None
+    return [first, last.isoformat()]
+
+
+def settle(conn: sqlite3.Connection, through: Optional[str] = None, dry_run: bool = False,
+           payout_dir: str = PAYOUT_DIR) -> Dict[str, Any]:
+    """Mark the winners of every pending day as paid and write their manifest (as .tmp).
+
+    Runs inside the caller's transaction; once it commits, call
+    `publish_manifest(result['manifest'])`.
+    """
+    days = pending_days(conn, through)
+    winners = conn.execute(PENDING_WINNERS, days).fetchall() if days is not None else []
+    payouts = [{
+        'date': row[0],
+        'walletid': wallet_id(row[1]),
+        'score': row[2],
+        'amount': PRIZE_AMOUNT,
+    } for row in winners]
+    result = {
+        'success': True,
+        'dry_run': dry_run,
+        'days': len(payouts),
+        'from': payouts[0]['date'] if payouts else None,
+        'to': payouts[-1]['date'] if payouts else None,
+        'total': PRIZE_AMOUNT * len(payouts),
+        'manifest': None,
+        'payouts': payouts,
+    }
+    if dry_run or not payouts:
+        return result
+
+    conn.executemany(MARK_CLAIMED, [(row[1], row[0]) for row in winners])
+    os.makedirs(payout_dir, exist_ok=True)
+    path = os.path.join(payout_dir, f"payouts-{result['from']}-{result['to']}.json")
+    manifest = {key: result[key] for key in ('from', 'to', 'days', 'total', 'payouts')}
+    manifest['prize_amount'] = PRIZE_AMOUNT
+    manifest['created'] = datetime.now().isoformat()
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    result['manifest'] = path
+    return result
+
+
+def publish_manifest(path: str):
+    """Move a committed settlement's manifest into place"""
+    os.replace(path + '.tmp', path)
+
+
+def main():
+    from db import BUSY_TIMEOUT, DAILY_SCORES_DB
+    from migrations import migrate, DAILY_SCORES_MIGRATIONS
+
+    parser = argparse.ArgumentParser(description='Settle daily prizes and write the payout manifest')
+    parser.add_argument('--through', help='last day to settle (default: the last final day)')
+    parser.add_argument('--dry-run', action='store_true', help='list the payouts without marking them')
+    parser.add_argument('--payout-dir', default=PAYOUT_DIR)
+    parser.add_argument('--database', default=DAILY_SCORES_DB)
+    args = parser.parse_args()
+    if args.through is not None:
+        try:
+            date.fromisoformat(args.through)
+        except ValueError:
+            sys.exit('--through must be a date (YYYY-MM-DD)')
+
+    migrate(args.database, DAILY_SCORES_MIGRATIONS)
+    conn = sqlite3.connect(args.database, isolation_level=None, timeout=BUSY_TIMEOUT)
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            result = settle(conn, args.through, args.dry_run, args.payout_dir)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+    finally:
+        conn.close()
+    if result['manifest']:
+        publish_manifest(result['manifest'])
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,314 @@
+"""
+Leaderboard snapshots: the ranked leaderboard frozen in a compact file.
+
+A snapshot is written for every season that has ended (its final
+standings, from the past-season rows still in users plus
+season_standings, see seasons.py) and every SNAPSHOT_INTERVAL seconds for
+the live leaderboard. Files are immutable and laid out for mmap, so the
+history endpoints read them without touching SQLite:
+
+    header     magic, version, id width W, metadata length M, count N
+    metadata   M bytes of JSON (name, kind, season, created), padded to 8
+    amounts    N little-endian int64 base units, best first
+    ids        N wallet ids as 32-byte keys (W = 32), in the same order
+    by_id      N uint32 positions into the arrays, sorted by wallet id
+
+Top N is the first N entries; a wallet's rank is a binary search of
+by_id and then of amounts (ties share a rank, as on /leaderboard).
+Rows whose stored id is not a key (legacy ids, see wallet_ids.py) are
+left out. Version 1 files, with text ids NUL-padded to W bytes, are
+still read.
+
+The writer checks every CHECK_INTERVAL seconds whether a snapshot is
+missing and writes it on a separate thread with its own connection.
+Names are derived from the season or the interval, so a writer that
+restarts, or the writer thread of another worker, finds the file
+already there.
+"""
+import json
+import mmap
+import os
+import re
+import sqlite3
+import struct
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from db import USERS_DB
+from wallet_ids import KEY_SIZE, wallet_id, wallet_key
+
+SNAPSHOT_DIR = os.environ.get('QXMR_SNAPSHOT_DIR', 'snapshots')
+# Seconds between snapshots of the live leaderboard (0: only at season ends)
+SNAPSHOT_INTERVAL = int(os.environ.get('QXMR_SNAPSHOT_INTERVAL', '86400'))
+# Seconds between checks for a missing snapshot
+CHECK_INTERVAL = 5.0
+# A .tmp file older than this was left by a writer that died
+STALE_TMP_SECONDS = 600
+# Snapshots kept open per worker
+MAX_OPEN = 32
+# Most entries a history top-N request may ask for
+MAX_TOP = 1000
+
+MAGIC = b'QXLB'
+VERSION = 2
+HEADER = struct.Struct('<4sHHIQ')
+SUFFIX = '.snap'
+NAME = re.compile(r'^(season-\d+|live-\d{8}T\d{6})$')
+
+SEASON_STANDINGS = '''
+    SELECT walletid, amount FROM users
+    WHERE amount_season = ? AND amount != 0 AND leaderboard_access = '1'
+    UNION ALL
+    SELECT walletid, amount FROM season_standings WHERE season = ?
+    ORDER BY amount DESC, walletid
+'''
+LIVE_STANDINGS = '''
+    SELECT walletid, CASE WHEN amount_season = ? THEN amount ELSE 0 END AS amount
+    FROM users WHERE leaderboard_access = '1'
+    ORDER BY amount DESC, walletid
+'''
+
+
+def _pad(size: int) -> int:
+    return -size % 8
+
+
+def write_snapshot(path: str, rows, meta: Dict[str, Any]) -> int:
+    """Write (stored walletid, amount) rows, best first, to `path`; return the count"""
+    amounts = array('q')
+    ids: List[bytes] = []
+    for stored, amount in rows:
+        if len(stored) == KEY_SIZE:
+            amounts.append(int(amount))
+            ids.append(bytes(stored))
+    count = len(ids)
+    by_id = array('I', sorted(range(count), key=ids.__getitem__))
+    if struct.pack('=I', 1) != struct.pack('<I', 1):
+        amounts.byteswap()
+        by_id.byteswap()
+    meta = json.dumps(dict(meta, count=count), separators=(',', ':')).encode()
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, KEY_SIZE, len(meta), count))
+        f.write(meta + b'\0' * _pad(HEADER.size + len(meta)))
+        f.write(amounts.tobytes())
+        f.write(b''.join(ids))
+        f.write(by_id.tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+    return count
+
+
+class Snapshot:
+    """Read-only view of a snapshot file through mmap"""
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.width, meta_len, self.count = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or version not in (1, VERSION):
+            raise ValueError(f'{path} is not a leaderboard snapshot')
+        self._text_ids = version == 1
+        self.meta = json.loads(self._mmap[HEADER.size:HEADER.size + meta_len])
+        self._amounts = HEADER.size + meta_len + _pad(HEADER.size + meta_len)
+        self._ids = self._amounts + 8 * self.count
+        self._by_id = self._ids + self.width * self.count
+
+    def amount(self, position: int) -> int:
+        return struct.unpack_from('<q', self._mmap, self._amounts + 8 * position)[0]
+
+    def _stored(self, position: int) -> bytes:
+        start = self._ids + self.width * position
+        stored = self._mmap[start:start + self.width]
+        return stored.rstrip(b'\0') if self._text_ids else stored
+
+    def walletid(self, position: int) -> str:
+        stored = self._stored(position)
+        return stored.decode() if self._text_ids else wallet_id(stored)
+
+    def top(self, n: int) -> List[Tuple[str, int]]:
+        return [(self.walletid(i), self.amount(i)) for i in range(min(n, self.count))]
+
+    def _find(self, walletid: str) -> Optional[int]:
+        key = walletid.encode() if self._text_ids else wallet_key(walletid)
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            position = struct.unpack_from('<I', self._mmap, self._by_id + 4 * middle)[0]
+            current = self._stored(position)
+            if current == key:
+                return position
+            if current < key:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+    def rank(self, walletid: str) -> Optional[Tuple[int, int]]:
+        """(rank, amount) of `walletid`, None if it is not in the snapshot"""
+        position = self._find(walletid)
+        if position is None:
+            return None
+        amount = self.amount(position)
+        # First position holding this amount: 1 + wallets strictly ahead
+        low, high = 0, position
+        while low < high:
+            middle = (low + high) // 2
+            if self.amount(middle) > amount:
+                low = middle + 1
+            else:
+                high = middle
+        return low + 1, amount
+
+
+class SnapshotStore:
+    """Snapshots in `directory`, opened once per worker"""
+
+    def __init__(self, directory: str = SNAPSHOT_DIR, max_open: int = MAX_OPEN):
+        self.directory = directory
+        self.max_open = max_open
+        self._lock = threading.Lock()
+        self._open: 'OrderedDict[str, Snapshot]' = OrderedDict()
+        # names() as of a directory mtime
+        self._names: Tuple[Optional[int], List[str]] = (None, [])
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.directory, name + SUFFIX)
+
+    def names(self) -> List[str]:
+        """Names of the snapshots, listed again only when the directory changed"""
+        try:
+            mtime = os.stat(self.directory).st_mtime_ns
+        except FileNotFoundError:
+            return []
+        cached_mtime, names = self._names
+        if mtime == cached_mtime:
+            return names
+        names = sorted(name[:-len(SUFFIX)] for name in os.listdir(self.directory)
+                       if name.endswith(SUFFIX) and NAME.match(name[:-len(SUFFIX)]))
+        # A change in the same clock tick as the listing would keep the mtime: trust it once it is older
+        if time.time_ns() - mtime > 1_000_000_000:
+            self._names = (mtime, names)
+        return names
+
+    def get(self, name: str) -> Optional[Snapshot]:
+        with self._lock:
+            snapshot = self._open.get(name)
+            if snapshot is not None:
+                self._open.move_to_end(name)
+                return snapshot
+        if not NAME.match(name):
+            return None
+        try:
+            # Files are only ever added (os.replace), so an open snapshot stays valid
+            snapshot = Snapshot(self.path(name))
+        except FileNotFoundError:
+            return None
+        with self._lock:
+            snapshot = self._open.setdefault(name, snapshot)
+            self._open.move_to_end(name)
+            while len(self._open) > self.max_open:
+                # Not closed here: a request may still be reading it
+                self._open.popitem(last=False)
+            return snapshot
+
+
+def live_name(now: float, interval: int) -> str:
+    start = datetime.fromtimestamp(now - now % interval)
+    return f'live-{start:%Y%m%dT%H%M%S}'
+
+
+class SnapshotScheduler:
+    """Writer background task writing missing snapshots on a side thread"""
+
+    def __init__(self, store: SnapshotStore, interval: int = SNAPSHOT_INTERVAL,
+                 database: str = USERS_DB, check_interval: float = CHECK_INTERVAL):
+        self.store = store
+        self.interval = interval
+        self.database = database
+        self.check_interval = check_interval
+        self._next_check = 0.0
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._stats = {'written': 0, 'failed': 0, 'last_name': None, 'last_count': 0, 'last_ms': 0.0}
+
+    def due(self, conn: sqlite3.Connection) -> List[Tuple[str, Dict[str, Any]]]:
+        """(name, meta) of the snapshots that should exist but do not"""
+        existing = set(self.store.names())
+        wanted = [
+            (f'season-{season}', {'kind': 'season', 'season': season})
+            for season, in conn.execute('SELECT id FROM seasons WHERE ended IS NOT NULL')
+        ]
+        if self.interval:
+            season = conn.execute('SELECT MAX(id) FROM seasons').fetchone()[0]
+            wanted.append((live_name(time.time(), self.interval), {'kind': 'live', 'season': season}))
+        return [(name, meta) for name, meta in wanted if name not in existing]
+
+    def run(self, conn: sqlite3.Connection, phase: str):
+        """Writer background hook: start a snapshot thread when one is missing"""
+        if phase == 'stop' or time.monotonic() < self._next_check:
+            return
+        self._next_check = time.monotonic() + self.check_interval
+        if self._thread is not None and self._thread.is_alive():
+            return
+        try:
+            due = self.due(conn)
+        except sqlite3.OperationalError:
+            return  # Not migrated yet: a sidecar writer starts before the workers
+        if due:
+            self._thread = threading.Thread(target=self.write_all, args=(due,), name='snapshots', daemon=True)
+            self._thread.start()
+
+    def write_all(self, due: List[Tuple[str, Dict[str, Any]]]):
+        conn = sqlite3.connect(self.database, isolation_level=None)
+        try:
+            for name, meta in due:
+                try:
+                    self.write(conn, name, meta)
+                except Exception:
+                    with self._lock:
+                        self._stats['failed'] += 1
+        finally:
+            conn.close()
+
+    def write(self, conn: sqlite3.Connection, name: str, meta: Dict[str, Any]):
+        os.makedirs(self.store.directory, exist_ok=True)
+        path = self.store.path(name)
+        tmp = path + '.tmp'
+        try:
+            # Claim the name, so the writer of another worker skips it
+            os.close(os.open(tmp, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            if time.time() - os.path.getmtime(tmp) < STALE_TMP_SECONDS:
+                return
+        start = time.perf_counter()
+        try:
+            # One read transaction: the rows of a season move from users to
+            # season_standings while the cleanup runs
+            conn.execute('BEGIN')
+            if meta['kind'] == 'season':
+                rows = conn.execute(SEASON_STANDINGS, (meta['season'], meta['season']))
+            else:
+                rows = conn.execute(LIVE_STANDINGS, (meta['season'],))
+            count = write_snapshot(tmp, rows, dict(meta, name=name, created=datetime.now().isoformat()))
+            conn.execute('COMMIT')
+            os.replace(tmp, path)
+        except Exception:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            os.remove(tmp)
+            raise
+        with self._lock:
+            self._stats.update(written=self._stats['written'] + 1, last_name=name, last_count=count,
+                               last_ms=round((time.perf_counter() - start) * 1000, 2))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self._stats)
+
+
+snapshot_store = SnapshotStore()
+snapshot_scheduler = SnapshotScheduler(snapshot_store)
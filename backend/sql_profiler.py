@@ -0,0 +1,265 @@
+"""
+Opt-in SQLite profiler: time and rows of every statement, by normalized SQL.
+
+With QXMR_SQL_PROFILE=1 the pooled connections (db.py) and the writer's
+connection use `ProfiledCursor`. A statement is measured from its execute
+until its rows are read to the end (or the cursor goes away or runs the
+next statement), counting the time spent in execute, fetch calls and
+iteration, and the rows returned. Statements are grouped by database and
+normalized SQL (whitespace collapsed, literals and IN lists replaced by
+placeholders).
+
+A statement slower than QXMR_SLOW_QUERY_MS is logged (logger qxmr.sql, one
+JSON line) and kept in a ring of the last SLOW_LOG_SIZE; every
+QXMR_SQL_REPORT_INTERVAL seconds the top REPORT_TOP statements by total
+time are logged as well. GET /admin/sql-profile returns both for the
+worker that served it, and with ?explain=1 the EXPLAIN QUERY PLAN of the
+top statements, run with the parameters of their slowest call.
+
+The writer's statements are profiled in the writer's process: they are
+reported by /admin/sql-profile in thread mode and under `sql_profile` in
+/admin/writer-stats with a sidecar.
+"""
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import deque
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from metrics import TimedCursor
+
+PROFILE_ENABLED = os.environ.get('QXMR_SQL_PROFILE', '0') == '1'
+SLOW_QUERY_MS = float(os.environ.get('QXMR_SLOW_QUERY_MS', '100'))
+# Seconds between top-N reports in the log (0: never)
+REPORT_INTERVAL = float(os.environ.get('QXMR_SQL_REPORT_INTERVAL', '300'))
+REPORT_TOP = 10
+SLOW_LOG_SIZE = 100
+# Distinct statements tracked per process; others are counted as dropped
+MAX_STATEMENTS = 1000
+
+logger = logging.getLogger('qxmr.sql')
+
+_SPACE = re.compile(r'\s+')
+_LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b|\bX'[0-9A-Fa-f]*'")
+_IN_LIST = re.compile(r'\bIN\s*\(\s*\?(?:\s*,\s*\?)+\s*\)', re.IGNORECASE)
+ORDERS = {
+    'seconds': lambda entry: entry['seconds'],
+    'calls': lambda entry: entry['calls'],
+    'max': lambda entry: entry['max_ms'],
+    'rows': lambda entry: entry['rows'],
+}
+
+
+@lru_cache(maxsize=4096)
+def normalize(sql: str) -> str:
+    """SQL text with literals as ? and IN lists as IN (...), so variants group together"""
+    return _IN_LIST.sub('IN (...)', _LITERAL.sub('?', _SPACE.sub(' ', sql).strip()))
+
+
+class _Statement:
+    """One execution being measured"""
+    __slots__ = ('sql', 'parameters', 'database', 'path', 'attached', 'seconds', 'rows')
+
+    def __init__(self, conn: sqlite3.Connection, sql: str, parameters: Any):
+        self.sql = sql
+        self.parameters = parameters
+        self.database = conn.label
+        self.path = conn.path
+        self.attached = conn.attached
+        self.seconds = 0.0
+        self.rows = 0
+
+
+class SqlProfiler:
+    """Statement counters of this process, the slow log and the periodic report"""
+
+    def __init__(self, slow_ms: float = SLOW_QUERY_MS, report_interval: float = REPORT_INTERVAL,
+                 max_statements: int = MAX_STATEMENTS):
+        self.slow_ms = slow_ms
+        self.report_interval = report_interval
+        self.max_statements = max_statements
+        self._lock = threading.Lock()
+        self._statements: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        self._slow: deque = deque(maxlen=SLOW_LOG_SIZE)
+        self._dropped = 0
+        self._next_report = time.monotonic() + report_interval
+
+    def record(self, statement: _Statement):
+        ms = statement.seconds * 1000
+        key = (statement.database, normalize(statement.sql))
+        slow = ms >= self.slow_ms
+        with self._lock:
+            entry = self._statements.get(key)
+            if entry is None:
+                if len(self._statements) >= self.max_statements:
+                    self._dropped += 1
+                    entry = None
+                else:
+                    entry = self._statements[key] = {
+                        'database': key[0], 'sql': key[1], 'calls': 0, 'seconds': 0.0, 'rows': 0, 'max_ms': 0.0,
+                        'slowest': None,
+                    }
+            if entry is not None:
+                entry['calls'] += 1
+                entry['seconds'] += statement.seconds
+                entry['rows'] += statement.rows
+                if ms >= entry['max_ms']:
+                    entry['max_ms'] = ms
+                    entry['slowest'] = statement
+            if slow:
+                self._slow.append({'database': key[0], 'sql': key[1], 'ms': round(ms, 3), 'rows': statement.rows,
+                                   'at': time.time()})
+            report = self.report_interval and time.monotonic() >= self._next_report
+            if report:
+                self._next_report = time.monotonic() + self.report_interval
+        if slow:
+            logger.warning(json.dumps({'slow_query_ms': round(ms, 3), 'database': key[0], 'sql': key[1],
+                                       'rows': statement.rows}))
+        if report:
+            logger.warning(json.dumps({'top_statements': self.top(REPORT_TOP)}))
+
+    def top(self, n: int, order: str = 'seconds') -> List[Dict[str, Any]]:
+        """The `n` statements first by `order` (a key of ORDERS), heaviest first"""
+        with self._lock:
+            entries = sorted(self._statements.values(), key=ORDERS[order], reverse=True)[:n]
+            return [self._public(entry) for entry in entries]
+
+    @staticmethod
+    def _public(entry: Dict[str, Any]) -> Dict[str, Any]:
+        public = {name: value for name, value in entry.items() if name != 'slowest'}
+        public['total_ms'] = round(public.pop('seconds') * 1000, 3)
+        public['avg_ms'] = round(public['total_ms'] / public['calls'], 3)
+        public['max_ms'] = round(public['max_ms'], 3)
+        return public
+
+    def explain(self, database: str, sql: str) -> List[str]:
+        """EXPLAIN QUERY PLAN of a tracked statement, with the parameters of its slowest
+        call, on a new read-only connection to its database"""
+        with self._lock:
+            entry = self._statements.get((database, sql))
+            statement = entry['slowest'] if entry is not None else None
+        if statement is None:
+            return []
+        parameters = statement.parameters
+        if parameters is None:  # executemany: the plan does not depend on the values
+            parameters = [None] * statement.sql.count('?')
+        conn = sqlite3.connect(f'file:{statement.path}?mode=ro', uri=True)
+        try:
+            for attach, attach_parameters in statement.attached:
+                conn.execute(attach, attach_parameters)
+            return [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + statement.sql, parameters)]
+        except sqlite3.Error as e:
+            return [f'error: {e}']
+        finally:
+            conn.close()
+
+    def report(self, n: int = REPORT_TOP, order: str = 'seconds', explain: bool = False) -> Dict[str, Any]:
+        top = self.top(n, order)
+        if explain:
+            for entry in top:
+                entry['plan'] = self.explain(entry['database'], entry['sql'])
+        with self._lock:
+            slow = list(self._slow)
+            dropped = self._dropped
+        return {'enabled': PROFILE_ENABLED, 'slow_query_ms': self.slow_ms, 'top': top,
+                'slow': slow[::-1], 'dropped': dropped}
+
+    def stats(self) -> Dict[str, Any]:
+        """Writer stats source: the top statements, without plans"""
+        return self.report()
+
+
+profiler = SqlProfiler()
+
+
+class ProfiledCursor(TimedCursor):
+    """TimedCursor also recording each statement in `profiler`"""
+    _statement: Optional[_Statement] = None
+
+    def _finish(self):
+        statement, self._statement = self._statement, None
+        if statement is not None:
+            profiler.record(statement)
+
+    def execute(self, sql: str, parameters: Any = ()):
+        self._finish()
+        if sql.lstrip()[:6].upper() == 'ATTACH':
+            # Replayed by SqlProfiler.explain for statements using the attached files
+            self.connection.attached = self.connection.attached + ((sql, parameters),)
+        self._statement = _Statement(self.connection, sql, parameters)
+        start = time.perf_counter()
+        try:
+            result = super().execute(sql, parameters)
+        finally:
+            if self._statement is not None:
+                self._statement.seconds += time.perf_counter() - start
+        if self.description is None:
+            self._finish()  # Nothing to read
+        return result
+
+    def executemany(self, sql: str, parameters: Any):
+        self._finish()
+        self._statement = _Statement(self.connection, sql, None)
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, parameters)
+        finally:
+            self._statement.seconds += time.perf_counter() - start
+            self._finish()
+
+    def _read(self, method: Callable, *args):
+        start = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            if self._statement is not None:
+                self._statement.seconds += time.perf_counter() - start
+
+    def fetchone(self):
+        row = self._read(super().fetchone)
+        if row is None:
+            self._finish()
+        elif self._statement is not None:
+            self._statement.rows += 1
+        return row
+
+    def fetchmany(self, *args):
+        rows = self._read(super().fetchmany, *args)
+        if self._statement is not None:
+            self._statement.rows += len(rows)
+            if len(rows) < (args[0] if args else self.arraysize):
+                self._finish()
+        return rows
+
+    def fetchall(self):
+        rows = self._read(super().fetchall)
+        if self._statement is not None:
+            self._statement.rows += len(rows)
+            self._finish()
+        return rows
+
+    def __next__(self):
+        try:
+            row = self._read(super().__next__)
+        except StopIteration:
+            self._finish()
+            raise
+        if self._statement is not None:
+            self._statement.rows += 1
+        return row
+
+    def close(self):
+        self._finish()
+        super().close()
+
+    def __del__(self):
+        self._finish()
+
+
+# Cursor class for metrics.connect()
+CURSOR_CLASS = ProfiledCursor if PROFILE_ENABLED else TimedCursor
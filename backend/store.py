@@ -0,0 +1,480 @@
+"""
+User, transaction and daily score mutations.
+
+Every function decorated with @command runs inside the writer (writer.py)
+on its connection, within the current batch transaction: it must not
+commit, and whatever it returns is sent back to the endpoint as JSON.
+Commands take and return wallet ids as identities; rows store the 32-byte
+key (see wallet_ids.py).
+"""
+import os
+import sqlite3
+from datetime import datetime, date
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import settlement
+from seasons import CURRENT_SEASON, archive, season_cleanup, start_season
+from snapshots import snapshot_scheduler
+from sql_profiler import PROFILE_ENABLED as SQL_PROFILE_ENABLED, profiler as sql_profiler
+from units import format_units, from_units, to_units
+from wallet_ids import wallet_id, wallet_key
+from write_behind import WriteBehindBuffer
+from writer import STATS_SOURCES, after_commit, background, before_reply, command
+
+# Fields of a user as returned by the API
+USER_FIELDS = ['walletid', 'amount', 'gameleft', 'lastplayed', 'paid', 'highest', 'col1', 'col2', 'col3',
+               'leaderboard_access']
+# Columns read for a user. games_day, amount_season and season are internal
+# and dropped by row_to_user; leaderboard_seq is only used by leaderboard_index.py.
+USER_COLUMNS = ', '.join(USER_FIELDS + ['games_day', 'amount_season', f'{CURRENT_SEASON} AS season'])
+TRANSACTION_COLUMNS = 'id, walletid, hash, paid, col1, col2'
+
+# Numeric user columns: API value -> stored value
+NUMERIC_USER_FIELDS: Dict[str, Callable[[Any], Any]] = {
+    'amount': to_units,
+    'paid': to_units,
+    'highest': float,
+    'gameleft': lambda value: int(float(value)),
+}
+
+# Stored type of each numeric column (RETURNING skips REAL affinity conversion)
+STORED_TYPES: Dict[str, Callable[[Any], Any]] = {
+    'amount': int,
+    'paid': int,
+    'highest': float,
+    'gameleft': int,
+}
+
+DAILY_SCORE_UPSERT = '''
+    INSERT INTO daily_scores (walletid, score_date, score)
+    VALUES (?, ?, ?)
+    ON CONFLICT(walletid, score_date)
+    DO UPDATE SET score = CASE
+        WHEN excluded.score > daily_scores.score THEN excluded.score
+        ELSE daily_scores.score
+    END
+'''
+
+# Acknowledge scores before daily_scores is written (see write_behind.py)
+DAILY_WRITE_BEHIND = os.environ.get('QXMR_DAILY_WRITE_BEHIND', '0') == '1'
+daily_scores_buffer = (WriteBehindBuffer('daily_scores', DAILY_SCORE_UPSERT, key=wallet_key)
+                       if DAILY_WRITE_BEHIND else None)
+
+if daily_scores_buffer is not None:
+    background(daily_scores_buffer.run)
+    before_reply(daily_scores_buffer.sync)
+    STATS_SOURCES['daily_write_behind'] = daily_scores_buffer.stats
+
+background(season_cleanup.run)
+STATS_SOURCES['season_cleanup'] = season_cleanup.stats
+background(snapshot_scheduler.run)
+STATS_SOURCES['snapshots'] = snapshot_scheduler.stats
+if SQL_PROFILE_ENABLED:
+    STATS_SOURCES['sql_profile'] = sql_profiler.stats
+
+# Rows per query when loading many users at once (SQLite's variable limit)
+LOAD_CHUNK = 500
+
+DAILY_FREE_GAMES = 3  # Games granted at the start of every day
+LEADERBOARD_PRICE = 10000  # 10000 QXMR for leaderboard access
+GAME_PRICE = 500000  # Old game purchase price (deprecated but kept for compatibility)
+
+def format_number(value: Any) -> str:
+    """Render a numeric column the way the API has always returned it (as text)"""
+    if isinstance(value, float):
+        return '0' if value == 0 else str(value)
+    return str(value)
+
+def games_left(gameleft: Any, games_day: Any, today: Optional[str] = None) -> int:
+    """Games the player can still play today.
+
+    The stored gameleft only counts for `games_day`; on any other day the
+    player has the daily free games again. Deriving this at read time
+    replaces the old lazy reset that turned the first /get_user poll of
+    the day into a write.
+    """
+    if games_day != (today or date.today().isoformat()):
+        return DAILY_FREE_GAMES
+    return int(gameleft or 0)
+
+def row_to_user(row: Any) -> Dict[str, Any]:
+    """Convert a users row to the API representation (numeric columns as strings)"""
+    user = dict(row)
+    if 'walletid' in user:
+        user['walletid'] = wallet_id(user['walletid'])
+    if 'games_day' in user:
+        user['gameleft'] = games_left(user['gameleft'], user.pop('games_day'))
+    if 'amount_season' in user and user.pop('amount_season') != user.pop('season'):
+        # Amount of a past season (see seasons.py)
+        user['amount'] = 0
+    for field in ('amount', 'paid'):
+        if user.get(field) is not None:
+            user[field] = format_number(from_units(user[field]))
+    for field in ('highest', 'gameleft'):
+        if user.get(field) is not None:
+            user[field] = format_number(user[field])
+    return user
+
+def row_to_transaction(row: Any) -> Dict[str, Any]:
+    """Convert a transactions row to the API representation (paid as text)"""
+    transaction = dict(row)
+    transaction['walletid'] = wallet_id(transaction['walletid'])
+    transaction['paid'] = format_units(transaction['paid'])
+    return transaction
+
+USER_DEFAULTS = {
+    'amount': 0,
+    'gameleft': 0,
+    'lastplayed': '',
+    'paid': 0,
+    'highest': 0.0,
+    'col1': '',
+    'col2': '',
+    'col3': '',
+    'leaderboard_access': '0',
+    'games_day': '',
+}
+
+# Fields clients may set through /update_user
+UPDATABLE_FIELDS = ['amount', 'gameleft', 'lastplayed', 'paid', 'highest', 'col1', 'col2', 'col3', 'leaderboard_access']
+
+class UserRecord:
+    """Unit of work for one users row: loaded at most once, written at most once.
+
+    Fields hold stored values (base units for amount/paid, see units.py).
+    Assignments only mark a field dirty when its value changes; `add`
+    records a relative change that is applied in SQL (`paid = paid + ?`),
+    so it needs no prior read and cannot lose a concurrent update. `flush`
+    writes everything in one INSERT ... ON CONFLICT DO UPDATE ... RETURNING
+    and does nothing at all when the row exists and nothing changed.
+
+    `UserRecord.load` reads the row first; `UserRecord(walletid)` does not,
+    for commands that only set or add (assignments are then always dirty).
+    An amount of a past season loads as 0 and is archived in that season's
+    standings when the record overwrites it (see seasons.py).
+    """
+
+    def __init__(self, walletid: str, values: Optional[Dict[str, Any]] = None, exists: Optional[bool] = None):
+        self.walletid = walletid
+        self.values = dict(values if values is not None else USER_DEFAULTS)
+        # None: not loaded, so we do not know whether the row exists
+        self.exists = exists
+        self.dirty = set()
+        self.increments: Dict[str, Any] = {}
+        # (season, amount) of a past season still stored in the row
+        self.expired: Optional[Tuple[int, int]] = None
+
+    @classmethod
+    def from_row(cls, row: sqlite3.Row, walletid: Optional[str] = None) -> 'UserRecord':
+        record = cls(walletid or wallet_id(row['walletid']), {field: row[field] for field in USER_DEFAULTS}, True)
+        record.expire(row)
+        return record
+
+    def expire(self, row: sqlite3.Row):
+        """Count the amount as 0 if `row` stores it for a past season"""
+        if row['amount_season'] != row['season']:
+            if self.values['amount']:
+                self.expired = (row['amount_season'], self.values['amount'])
+            self.values['amount'] = 0
+
+    @classmethod
+    def load(cls, conn: sqlite3.Connection, walletid: str) -> 'UserRecord':
+        row = conn.execute(f'SELECT {USER_COLUMNS} FROM users WHERE walletid = ?', (wallet_key(walletid),)).fetchone()
+        if row:
+            return cls.from_row(row, walletid)
+        return cls(walletid, USER_DEFAULTS, False)
+
+    @classmethod
+    def load_many(cls, conn: sqlite3.Connection, walletids: Iterable[str]) -> Dict[str, 'UserRecord']:
+        """Load several rows with one query per LOAD_CHUNK wallets"""
+        keys = {wallet_key(walletid): walletid for walletid in walletids}
+        stored = list(keys)
+        records = {}
+        for start in range(0, len(stored), LOAD_CHUNK):
+            chunk = stored[start:start + LOAD_CHUNK]
+            rows = conn.execute(
+                f'SELECT {USER_COLUMNS} FROM users WHERE walletid IN ({", ".join("?" * len(chunk))})', chunk
+            )
+            for row in rows:
+                walletid = keys[row['walletid']]
+                records[walletid] = cls.from_row(row, walletid)
+        for walletid in keys.values():
+            if walletid not in records:
+                records[walletid] = cls(walletid, USER_DEFAULTS, False)
+        return records
+
+    def __getitem__(self, field: str) -> Any:
+        return self.values[field]
+
+    def __setitem__(self, field: str, value: Any):
+        if field in NUMERIC_USER_FIELDS:
+            value = NUMERIC_USER_FIELDS[field](value or 0)
+        else:
+            value = str(value)
+        if self.exists is None or self.values.get(field) != value:
+            self.values[field] = value
+            self.increments.pop(field, None)
+            self.dirty.add(field)
+
+    def add(self, field: str, delta: Any):
+        """Increment a numeric field by `delta` (stored units)"""
+        if not delta:
+            return
+        self.values[field] += delta
+        if field in self.dirty:
+            return
+        self.increments[field] = self.increments.get(field, 0) + delta
+
+    def update(self, data: Dict[str, Any]):
+        for field in UPDATABLE_FIELDS:
+            if field in data:
+                self[field] = data[field]
+        if 'gameleft' in data:
+            # An explicit gameleft is today's count
+            self['games_day'] = date.today().isoformat()
+
+    def to_user(self) -> Dict[str, Any]:
+        return row_to_user(dict(self.values, walletid=self.walletid))
+
+    def archive_expired(self, conn: sqlite3.Connection, written: Iterable[str]):
+        """Archive the past season's amount if the `written` fields overwrite it"""
+        if self.expired and 'amount' in written and self.values['leaderboard_access'] == '1':
+            archive(conn, [self.expired + (wallet_key(self.walletid),)])
+        self.expired = None
+
+    def flush(self, conn: sqlite3.Connection) -> Dict[str, Any]:
+        """Persist the changes (the whole row if new), return the API representation"""
+        if self.exists and not self.dirty and not self.increments:
+            return self.to_user()
+        self.archive_expired(conn, self.dirty)
+        fields = list(USER_DEFAULTS)
+        assignments = [f'{field} = excluded.{field}' for field in sorted(self.dirty)]
+        if 'amount' in self.dirty:
+            assignments.append('amount_season = excluded.amount_season')
+        assignments += [f'{field} = {field} + ?' for field in self.increments]
+        on_conflict = f'DO UPDATE SET {", ".join(assignments)}' if assignments else 'DO NOTHING'
+        row = conn.execute(
+            f'INSERT INTO users (walletid, {", ".join(fields)}, amount_season) '
+            f'VALUES ({", ".join("?" * (len(fields) + 1))}, {CURRENT_SEASON}) '
+            f'ON CONFLICT(walletid) {on_conflict} RETURNING {USER_COLUMNS}',
+            [wallet_key(self.walletid)] + [self.values[field] for field in fields] + list(self.increments.values()),
+        ).fetchone()
+        self.exists = True
+        self.dirty.clear()
+        self.increments.clear()
+        if row is None:
+            # Created meanwhile by another connection, nothing of ours to apply
+            return UserRecord.load(conn, self.walletid).to_user()
+        self.values = {
+            field: STORED_TYPES[field](row[field]) if field in STORED_TYPES else row[field]
+            for field in USER_DEFAULTS
+        }
+        self.expire(row)
+        return self.to_user()
+
+def flush_many(conn: sqlite3.Connection, records: Iterable[UserRecord]):
+    """Persist loaded records with one executemany (unlike `flush`, nothing is returned).
+
+    Every row gets the same SET list, the union of the dirty fields: for a
+    record where one of them did not change, it rewrites the loaded value.
+    """
+    pending = [record for record in records if not record.exists or record.dirty or record.increments]
+    if not pending:
+        return
+    if any(record.exists is None or record.increments for record in pending):
+        raise ValueError('flush_many needs loaded records without increments')
+    fields = list(USER_DEFAULTS)
+    dirty = sorted(set().union(*(record.dirty for record in pending)))
+    for record in pending:
+        record.archive_expired(conn, dirty)
+    assignments = ', '.join(f'{field} = excluded.{field}' for field in dirty)
+    if 'amount' in dirty:
+        assignments += ', amount_season = excluded.amount_season'
+    conn.executemany(
+        f'INSERT INTO users (walletid, {", ".join(fields)}, amount_season) '
+        f'VALUES ({", ".join("?" * (len(fields) + 1))}, {CURRENT_SEASON}) '
+        f'ON CONFLICT(walletid) {f"DO UPDATE SET {assignments}" if dirty else "DO NOTHING"}',
+        [[wallet_key(record.walletid)] + [record.values[field] for field in fields] for record in pending],
+    )
+    for record in pending:
+        record.exists = True
+        record.dirty.clear()
+
+@command
+def create_user(conn: sqlite3.Connection, walletid: str) -> Dict[str, Any]:
+    """Create a new user with default values (free play enabled, no leaderboard access)"""
+    return UserRecord.load(conn, walletid).flush(conn)
+
+@command
+def update_user(conn: sqlite3.Connection, walletid: str, data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Update user data (only the fields that change); None if the user does not exist"""
+    user = UserRecord.load(conn, walletid)
+    if not user.exists:
+        return None
+    user.update(data)
+    updated = user.flush(conn)
+    # Echo the updated fields as they were sent, as the API always has
+    updated.update({field: str(data[field]) for field in UPDATABLE_FIELDS if field in data})
+    return updated
+
+def add_games(user: UserRecord, games: int):
+    """Add purchased games on top of what the player has left today"""
+    today = date.today().isoformat()
+    user['gameleft'] = games_left(user['gameleft'], user['games_day'], today) + games
+    user['games_day'] = today
+
+@command
+def save_transaction(conn: sqlite3.Connection, walletid: str, tx_hash: str, paid_amount: str,
+                     col1: str, col2: str) -> Dict[str, Any]:
+    """Save transaction. Handle leaderboard payment (10000 QXMR) or game purchases.
+
+    The hash is unique: a transaction already recorded (a client retrying)
+    credits nothing again, see `replayed_transaction`.
+    """
+    # Exact: to_units refuses anything that is not a whole amount
+    paid_units = to_units(paid_amount)
+    inserted = conn.execute('''
+        INSERT INTO transactions (walletid, hash, paid, col1, col2)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(hash) DO NOTHING
+        RETURNING id
+    ''', (wallet_key(walletid), tx_hash, paid_units, col1, col2)).fetchone()
+    if inserted is None:
+        return replayed_transaction(conn, walletid, tx_hash)
+
+    user = UserRecord.load(conn, walletid)
+    leaderboard_access_granted = False
+
+    # Check if this is a leaderboard payment
+    if col1 == 'leaderboard_payment' and paid_units >= to_units(LEADERBOARD_PRICE):
+        # Grant leaderboard access
+        user['leaderboard_access'] = '1'
+        leaderboard_access_granted = True
+    # Legacy: Check if this is a game purchase (deprecated - games are now free)
+    elif col1 == 'game_purchase' and paid_units >= to_units(GAME_PRICE):
+        add_games(user, paid_units // to_units(GAME_PRICE))
+    # Every payment increments the paid amount
+    user.add('paid', paid_units)
+
+    updated_user = user.flush(conn)
+    return {
+        'user': updated_user,
+        'leaderboard_access_granted': leaderboard_access_granted,
+        'user_paid_updated': updated_user['paid'],
+        'duplicate': False,
+    }
+
+def replayed_transaction(conn: sqlite3.Connection, walletid: str, tx_hash: str) -> Dict[str, Any]:
+    """`save_transaction` result for a hash that is already recorded, without crediting again.
+
+    `conflict` is set when the hash was recorded for another wallet.
+    """
+    transaction = row_to_transaction(conn.execute(
+        f'SELECT {TRANSACTION_COLUMNS} FROM transactions WHERE hash = ?', (tx_hash,)
+    ).fetchone())
+    if transaction['walletid'] != walletid:
+        return {'duplicate': True, 'conflict': True, 'transaction': transaction}
+    user = UserRecord.load(conn, walletid).to_user()
+    return {
+        'user': user,
+        'leaderboard_access_granted': transaction['col1'] == 'leaderboard_payment' and user['leaderboard_access'] == '1',
+        'user_paid_updated': user['paid'],
+        'duplicate': True,
+        'transaction': transaction,
+    }
+
+def record_daily_scores(conn: sqlite3.Connection, entries: List[Tuple[str, str, float]]):
+    """Upsert (walletid, score_date, score) rows, or buffer them once the command commits"""
+    if daily_scores_buffer is not None:
+        after_commit(lambda: daily_scores_buffer.add_many(entries))
+    elif entries:
+        conn.executemany(DAILY_SCORE_UPSERT, [(wallet_key(walletid), day, score) for walletid, day, score in entries])
+
+def apply_score(user: UserRecord, score: float, today: str) -> Tuple[bool, bool]:
+    """Apply one finished game to `user`.
+
+    Returns (has_access, counted): counted games used up one of today's
+    games and belong in daily_scores.
+    """
+    # Check if user has leaderboard access
+    has_access = (user['leaderboard_access'] or '0') == '1'
+
+    # Always update highest score locally (a no-op unless it is a new record)
+    user['highest'] = max(user['highest'], score)
+
+    # Only update amount (leaderboard score) if user has paid for access
+    remaining = games_left(user['gameleft'], user['games_day'], today)
+    if has_access and remaining:
+        # Update lastplayed timestamp
+        user['lastplayed'] = datetime.now().isoformat()
+        # Scores are whole numbers (checked by the endpoints), like amounts
+        user['amount'] = max(user['amount'], to_units(score))
+        user['gameleft'] = remaining - 1
+        user['games_day'] = today
+        return has_access, True
+    return has_access, False
+
+@command
+def update_game_score(conn: sqlite3.Connection, walletid: str, score: float) -> Dict[str, Any]:
+    """Update user's score. Only update leaderboard if user has paid for access."""
+    user = UserRecord.load(conn, walletid)
+    today = date.today().isoformat()
+    has_access, counted = apply_score(user, float(score), today)
+    if counted:
+        # Also save to daily_scores for daily prize calculation
+        record_daily_scores(conn, [(walletid, today, float(score))])
+
+    return {
+        'user': user.flush(conn),
+        'leaderboard_updated': has_access,
+    }
+
+@command
+def update_game_scores(conn: sqlite3.Connection, items: List[Tuple[str, float]]) -> List[Dict[str, Any]]:
+    """`update_game_score` for many (walletid, score) pairs, in order.
+
+    Users are loaded with one query and written with one executemany, and
+    daily_scores gets one upsert per wallet with its best counted score.
+    """
+    today = date.today().isoformat()
+    users = UserRecord.load_many(conn, (walletid for walletid, _ in items))
+    daily: Dict[str, float] = {}
+    results = []
+    for walletid, score in items:
+        user = users[walletid]
+        has_access, counted = apply_score(user, float(score), today)
+        if counted:
+            daily[walletid] = max(daily.get(walletid, float(score)), float(score))
+        results.append({
+            'walletid': walletid,
+            'user': user.to_user(),
+            'leaderboard_updated': has_access,
+        })
+    flush_many(conn, users.values())
+    record_daily_scores(conn, [(walletid, today, score) for walletid, score in daily.items()])
+    return results
+
+@command
+def buy_games(conn: sqlite3.Connection, walletid: str, games_to_buy: int, total_paid: float) -> Dict[str, Any]:
+    """Buy games - increment gameleft and paid amount"""
+    user = UserRecord.load(conn, walletid)
+    add_games(user, games_to_buy)
+    user.add('paid', to_units(total_paid))
+    updated_user = user.flush(conn)
+    return {
+        'user': updated_user,
+        'games_remaining': int(updated_user['gameleft']),
+    }
+
+@command
+def settle_prizes(conn: sqlite3.Connection, through: Optional[str] = None, dry_run: bool = False) -> Dict[str, Any]:
+    """Pay out every pending daily prize (see settlement.py)"""
+    result = settlement.settle(conn, through, dry_run)
+    if result['manifest']:
+        after_commit(lambda: settlement.publish_manifest(result['manifest']))
+    return result
+
+@command
+def reset_balances(conn: sqlite3.Connection) -> Dict[str, int]:
+    """Start a new season, so every balance counts as 0 (see seasons.py)"""
+    return {'season': start_season(conn)}
@@ -0,0 +1,150 @@
+"""
+Request tracing: where the time of one request went.
+
+With QXMR_TRACING=1 every request gets a trace, and spans are added to it
+for:
+- each SQLite execute/fetch call on a pooled connection, as
+  `sql.<database file>` (through metrics.TimedCursor);
+- the wait for a writer command, as `writer.<command>`. This covers
+  queueing and the commit, since the command itself runs on the writer
+  thread or sidecar;
+- JSON parsing of the request body (`parse`) and serialization of the
+  response (`serialize`).
+
+The response gets a Server-Timing header with the total (`app`) and the
+spans added up by name, which browser devtools show under Timing. With
+QXMR_TRACE_FILE set, every finished trace is appended to that file as one
+JSON line, spans included. Spans of a streamed body are only in the file.
+"""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from flask.json.provider import DefaultJSONProvider
+
+TRACING_ENABLED = os.environ.get('QXMR_TRACING', '0') == '1'
+TRACE_FILE = os.environ.get('QXMR_TRACE_FILE', '')
+# Spans kept per trace (a long stream would otherwise grow without bound)
+MAX_SPANS = 1000
+
+# Per request: greenlet-local under gunicorn's gevent workers
+_local = threading.local()
+
+
+class Trace:
+    """Spans of one request, as (name, start, end) in perf_counter seconds"""
+
+    def __init__(self, name: str):
+        self.id = os.urandom(8).hex()
+        self.name = name
+        self.started = datetime.now()
+        self.start = time.perf_counter()
+        self.spans: List[Tuple[str, float, float]] = []
+        self.dropped = 0
+        self.status: Optional[int] = None
+
+    def add(self, name: str, start: float, end: float):
+        if len(self.spans) < MAX_SPANS:
+            self.spans.append((name, start, end))
+        else:
+            self.dropped += 1
+
+    def totals(self) -> Dict[str, Tuple[float, int]]:
+        """name -> (seconds, spans)"""
+        totals: Dict[str, Tuple[float, int]] = {}
+        for name, start, end in self.spans:
+            seconds, count = totals.get(name, (0.0, 0))
+            totals[name] = (seconds + end - start, count + 1)
+        return totals
+
+    def server_timing(self) -> str:
+        entries = [f'app;dur={(time.perf_counter() - self.start) * 1000:.3f}']
+        for name, (seconds, count) in self.totals().items():
+            entry = f'{name};dur={seconds * 1000:.3f}'
+            entries.append(entry + f';desc="{count} calls"' if count > 1 else entry)
+        entries.append(f'trace;desc="{self.id}"')
+        return ', '.join(entries)
+
+    def to_dict(self, **fields: Any) -> Dict[str, Any]:
+        return dict(
+            fields, trace_id=self.id, name=self.name, status=self.status, pid=os.getpid(),
+            start=self.started.isoformat(),
+            duration_ms=round((time.perf_counter() - self.start) * 1000, 3), dropped_spans=self.dropped,
+            spans=[{'name': name, 'start_ms': round((start - self.start) * 1000, 3),
+                    'duration_ms': round((end - start) * 1000, 3)} for name, start, end in self.spans],
+        )
+
+
+def begin(name: str) -> Optional[Trace]:
+    """Start the trace of the current request (None when tracing is off)"""
+    if not TRACING_ENABLED:
+        return None
+    trace = _local.trace = Trace(name)
+    return trace
+
+
+def current() -> Optional[Trace]:
+    return getattr(_local, 'trace', None)
+
+
+def add(name: str, start: float, end: float):
+    """Add a span to the current request's trace, if any"""
+    trace = getattr(_local, 'trace', None)
+    if trace is not None:
+        trace.add(name, start, end)
+
+
+@contextmanager
+def span(name: str):
+    if not TRACING_ENABLED:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add(name, start, time.perf_counter())
+
+
+class TracedJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider adding `parse` and `serialize` spans"""
+
+    def loads(self, s, **kwargs: Any) -> Any:
+        with span('parse'):
+            return super().loads(s, **kwargs)
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        with span('serialize'):
+            return super().dumps(obj, **kwargs)
+
+
+class TraceFile:
+    """JSONL export of finished traces, appended by every worker"""
+
+    def __init__(self, path: str = TRACE_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def write(self, record: Dict[str, Any]):
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        with self._lock:
+            # One write() per line in append mode: lines of several workers do not interleave
+            with open(self.path, 'a') as f:
+                f.write(line)
+
+
+trace_file = TraceFile() if TRACE_FILE else None
+
+
+def finish(**fields: Any):
+    """End the current request's trace and export it"""
+    trace = getattr(_local, 'trace', None)
+    if trace is None:
+        return
+    _local.trace = None
+    if trace_file is not None:
+        trace_file.write(trace.to_dict(**fields))
@@ -0,0 +1,44 @@
+"""
+Fixed-point QXMR amounts.
+
+QXMR is an indivisible Qubic asset, so one base unit is one QXMR and
+`UNITS_PER_QXMR` is 1. Balances, payments and leaderboard amounts are
+stored as INTEGER base units so SUM() and comparisons run natively in
+SQLite; conversion to and from API values happens only at the edges.
+
+Amounts are never rounded: `to_units` rejects a value that is not a whole
+number of base units (the endpoints answer 400), so a price check sees
+exactly what was paid.
+"""
+from decimal import Decimal, InvalidOperation
+from typing import Any
+
+UNITS_PER_QXMR = 1
+
+
+def to_units(value: Any) -> int:
+    """API value (number or numeric string) to integer base units; ValueError
+    if it is not a number or not a whole number of base units"""
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value * UNITS_PER_QXMR
+    try:
+        units = Decimal(str(value or 0)) * UNITS_PER_QXMR
+        whole = units.is_finite() and units == units.to_integral_value()
+    except (InvalidOperation, TypeError):
+        whole = False
+    if not whole:
+        raise ValueError(f'{value!r} is not a whole number of QXMR')
+    return int(units)
+
+
+def from_units(units: Any) -> float:
+    """Integer base units to a QXMR amount"""
+    return (units or 0) / UNITS_PER_QXMR
+
+
+def format_units(units: Any) -> str:
+    """Integer base units as text, without a fractional part when whole"""
+    units = int(units or 0)
+    if units % UNITS_PER_QXMR == 0:
+        return str(units // UNITS_PER_QXMR)
+    return str(units / UNITS_PER_QXMR)
@@ -0,0 +1,151 @@
+"""
+Qubic wallet ids.
+
+A Qubic identity is 60 uppercase letters: the 32-byte public key as four
+little-endian 64-bit words of 14 base-26 digits each, then 4 letters of
+checksum (the low 18 bits of KangarooTwelve of the key). Endpoints check
+the checksum once with `parse_walletid`; the databases store the 32-byte
+key (`wallet_key`) and responses turn it back into the identity
+(`wallet_id`, cached, since it hashes).
+
+Rows migrated from before ids were checked may hold something that is
+not an identity; those are stored as the UTF-8 bytes of the text, which
+`wallet_id` returns as text again unless it is exactly 32 bytes long.
+
+The checksum uses pycryptodome's KangarooTwelve when it is installed and
+the pure-Python version below otherwise (about 0.5 ms per identity).
+"""
+from functools import lru_cache
+
+try:
+    from Crypto.Hash import KangarooTwelve as _K12
+except ImportError:
+    _K12 = None
+
+IDENTITY_LENGTH = 60
+KEY_SIZE = 32
+# Checksums remembered per worker
+ID_CACHE_SIZE = 65536
+
+_A = ord('A')
+
+# KangarooTwelve, only what identities need: inputs under 8 KiB, which
+# K12 hashes as TurboSHAKE128 (Keccak-p[1600] with 12 rounds) with domain
+# byte 0x07 after the empty customization string's length encoding.
+_ROUND_CONSTANTS = [
+    0x000000008000808B, 0x800000000000008B, 0x8000000000008089, 0x8000000000008003,
+    0x8000000000008002, 0x8000000000000080, 0x000000000000800A, 0x800000008000000A,
+    0x8000000080008081, 0x8000000000008080, 0x0000000080000001, 0x8000000080008008,
+]
+_ROTATIONS = [
+    0, 1, 62, 28, 27,
+    36, 44, 6, 55, 20,
+    3, 10, 43, 25, 39,
+    41, 45, 15, 21, 8,
+    18, 2, 61, 56, 14,
+]
+_MASK = (1 << 64) - 1
+_RATE = 168
+
+
+def _rotate(lane: int, shift: int) -> int:
+    return ((lane << shift) | (lane >> (64 - shift))) & _MASK if shift else lane
+
+
+def _keccak_p12(state: list):
+    """Keccak-p[1600, 12] on 25 lanes, state[x + 5 * y]"""
+    for constant in _ROUND_CONSTANTS:
+        columns = [state[x] ^ state[x + 5] ^ state[x + 10] ^ state[x + 15] ^ state[x + 20] for x in range(5)]
+        for x in range(5):
+            d = columns[(x - 1) % 5] ^ _rotate(columns[(x + 1) % 5], 1)
+            for y in range(0, 25, 5):
+                state[x + y] ^= d
+        moved = [0] * 25
+        for x in range(5):
+            for y in range(5):
+                moved[y + 5 * ((2 * x + 3 * y) % 5)] = _rotate(state[x + 5 * y], _ROTATIONS[x + 5 * y])
+        for y in range(0, 25, 5):
+            row = moved[y:y + 5]
+            for x in range(5):
+                state[x + y] = row[x] ^ (~row[(x + 1) % 5] & row[(x + 2) % 5])
+        state[0] ^= constant
+
+
+def kangaroo_twelve(message: bytes, length: int) -> bytes:
+    """KangarooTwelve of `message` (< 8 KiB, no customization string)"""
+    padded = bytearray(message + b'\x00\x07')
+    padded += b'\x00' * (-len(padded) % _RATE)
+    padded[-1] |= 0x80
+    state = [0] * 25
+    for start in range(0, len(padded), _RATE):
+        for i in range(_RATE // 8):
+            state[i] ^= int.from_bytes(padded[start + 8 * i:start + 8 * i + 8], 'little')
+        _keccak_p12(state)
+    output = b''
+    while len(output) < length:
+        output += b''.join(lane.to_bytes(8, 'little') for lane in state[:_RATE // 8])
+        if len(output) < length:
+            _keccak_p12(state)
+    return output[:length]
+
+
+@lru_cache(maxsize=ID_CACHE_SIZE)
+def _checksum(key: bytes) -> str:
+    digest = _K12.new(data=key).read(3) if _K12 is not None else kangaroo_twelve(key, 3)
+    value = int.from_bytes(digest, 'little') & 0x3FFFF
+    letters = []
+    for _ in range(4):
+        value, digit = divmod(value, 26)
+        letters.append(chr(_A + digit))
+    return ''.join(letters)
+
+
+def _decode(identity: str) -> bytes:
+    """The 32-byte key of a well-formed identity (checksum not checked); ValueError otherwise"""
+    if len(identity) != IDENTITY_LENGTH or not identity.isascii() or not identity.isupper() or not identity.isalpha():
+        raise ValueError('walletid must be a 60-letter Qubic identity')
+    words = []
+    for start in range(0, 56, 14):
+        value = 0
+        for letter in reversed(identity[start:start + 14]):
+            value = value * 26 + ord(letter) - _A
+        if value >> 64:
+            raise ValueError('walletid is not a valid Qubic identity')
+        words.append(value.to_bytes(8, 'little'))
+    return b''.join(words)
+
+
+def _encode(key: bytes) -> str:
+    letters = []
+    for start in range(0, KEY_SIZE, 8):
+        value = int.from_bytes(key[start:start + 8], 'little')
+        for _ in range(14):
+            value, digit = divmod(value, 26)
+            letters.append(chr(_A + digit))
+    return ''.join(letters) + _checksum(key)
+
+
+def parse_walletid(value) -> str:
+    """Validate an identity from a request (format and checksum); ValueError if it is not one"""
+    if not isinstance(value, str):
+        raise ValueError('walletid must be a 60-letter Qubic identity')
+    if _checksum(_decode(value)) != value[56:]:
+        raise ValueError('walletid checksum does not match')
+    return value
+
+
+def wallet_key(walletid: str) -> bytes:
+    """Stored form of a wallet id: the 32-byte key of an identity (see module docstring)"""
+    try:
+        return _decode(walletid)
+    except ValueError:
+        return walletid.encode()
+
+
+def wallet_id(stored) -> str:
+    """Wallet id for responses from its stored form"""
+    if isinstance(stored, str):
+        return stored
+    if len(stored) == KEY_SIZE:
+        return _encode(bytes(stored))
+    return bytes(stored).decode()
@@ -0,0 +1,238 @@
+"""
+Write-behind buffer for upserts that keep the maximum per key.
+
+Used for daily_scores when QXMR_DAILY_WRITE_BEHIND=1 (see store.py): score
+commands then acknowledge without touching daily_scores. The buffer lives
+on the writer thread. It appends every entry to a small journal file,
+keeps only the best score per (walletid, score_date) in memory and
+upserts the pending rows with one executemany once FLUSH_SIZE keys are
+waiting or the oldest has waited FLUSH_INTERVAL seconds, and when the
+writer stops.
+
+Entries are journaled when their command commits, and the journal is
+fsynced once per writer batch, before any of its commands is answered
+(`sync`, a writer before_reply hook): an acknowledged score survives a
+crash even though daily_scores has not been written yet.
+
+Entries and the journal hold wallet ids as text; `key` turns them into
+their stored form when the rows are written.
+
+The journal is truncated after each flush. One left behind by a process
+that died is replayed on the next start; replaying is harmless because
+the upsert keeps the larger score.
+"""
+import glob
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+JOURNAL_DIR = os.environ.get('QXMR_JOURNAL_DIR', '.')
+# Pending keys that trigger a flush
+FLUSH_SIZE = 1000
+# Seconds the oldest pending entry may wait for a flush
+FLUSH_INTERVAL = 1.0
+
+Key = Tuple[str, str]
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class WriteBehindBuffer:
+    """Coalesces (walletid, date, score) entries to their max until flushed with `upsert_sql`"""
+
+    def __init__(self, name: str, upsert_sql: str, journal_dir: str = JOURNAL_DIR,
+                 flush_size: int = FLUSH_SIZE, flush_interval: float = FLUSH_INTERVAL,
+                 key: Optional[Callable[[str], Any]] = None):
+        self.name = name
+        self.upsert_sql = upsert_sql
+        self.key = key or (lambda walletid: walletid)
+        self.journal_dir = journal_dir
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._pid = None
+        self._reset()
+
+    def _reset(self):
+        self._pending: Dict[Key, float] = {}
+        self._oldest: Optional[float] = None
+        self._journal = None
+        # Journaled entries not yet fsynced
+        self._unsynced = False
+        self._pending_adds = 0
+        self._stats = {
+            'added': 0,
+            'fsyncs': 0,
+            'coalesced': 0,
+            'flushes': 0,
+            'rows_flushed': 0,
+            'adds_flushed': 0,
+            'failed_flushes': 0,
+            'recovered_rows': 0,
+            'last_flush_ms': 0.0,
+            'max_flush_ms': 0.0,
+            'max_wait_ms': 0.0,
+        }
+
+    def _journal_path(self, pid: int) -> str:
+        return os.path.join(self.journal_dir, f'{self.name}.{pid}.journal')
+
+    def _check_pid(self):
+        # A forked child starts empty; the parent's journal stays the parent's
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._reset()
+
+    def add_many(self, entries: Iterable[Tuple[str, str, float]]):
+        """Journal and buffer entries (called after the command is committed; `sync` makes them durable)"""
+        self._check_pid()
+        entries = list(entries)
+        if not entries:
+            return
+        if self._journal is None:
+            self._journal = open(self._journal_path(self._pid), 'a', encoding='utf-8')
+        self._journal.write(''.join(json.dumps(entry, separators=(',', ':')) + '\n' for entry in entries))
+        self._journal.flush()
+        self._unsynced = True
+        with self._lock:
+            for walletid, score_date, score in entries:
+                key = (walletid, score_date)
+                current = self._pending.get(key)
+                if current is None:
+                    self._pending[key] = score
+                else:
+                    self._pending[key] = max(current, score)
+                    self._stats['coalesced'] += 1
+            self._stats['added'] += len(entries)
+            self._pending_adds += len(entries)
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+
+    def add(self, walletid: str, score_date: str, score: float):
+        self.add_many([(walletid, score_date, score)])
+        self.sync()
+
+    def sync(self):
+        """fsync the entries journaled since the last call, once for all of them"""
+        if not self._unsynced or self._journal is None or self._pid != os.getpid():
+            return
+        os.fsync(self._journal.fileno())
+        self._unsynced = False
+        with self._lock:
+            self._stats['fsyncs'] += 1
+
+    def _rows(self, best: Dict[Key, float]) -> List[Tuple[Any, str, float]]:
+        return [(self.key(walletid), day, score) for (walletid, day), score in best.items()]
+
+    def due(self) -> bool:
+        if not self._pending:
+            return False
+        return len(self._pending) >= self.flush_size or time.monotonic() - self._oldest >= self.flush_interval
+
+    def flush(self, conn: sqlite3.Connection, force: bool = False):
+        """Upsert the pending rows in one transaction if due (or `force`), then truncate the journal"""
+        self._check_pid()
+        if not (self.due() or (force and self._pending)):
+            return
+        with self._lock:
+            pending, adds, oldest = self._pending, self._pending_adds, self._oldest
+        start = time.perf_counter()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.executemany(self.upsert_sql, self._rows(pending))
+            conn.execute('COMMIT')
+        except Exception:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            with self._lock:
+                self._stats['failed_flushes'] += 1
+            raise
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        if self._journal is not None:
+            self._journal.seek(0)
+            self._journal.truncate()
+        with self._lock:
+            self._pending, self._pending_adds, self._oldest = {}, 0, None
+            stats = self._stats
+            stats['flushes'] += 1
+            stats['rows_flushed'] += len(pending)
+            stats['adds_flushed'] += adds
+            stats['last_flush_ms'] = elapsed_ms
+            stats['max_flush_ms'] = max(stats['max_flush_ms'], elapsed_ms)
+            stats['max_wait_ms'] = max(stats['max_wait_ms'], (time.monotonic() - oldest) * 1000)
+
+    def recover(self, conn: sqlite3.Connection):
+        """Replay and remove journals left by processes that are gone"""
+        self._check_pid()
+        for path in glob.glob(self._journal_path('*')):
+            try:
+                pid = int(path.rsplit('.', 2)[-2])
+            except ValueError:
+                continue
+            if pid != self._pid and _pid_alive(pid):
+                continue
+            best: Dict[Key, float] = {}
+            with open(path, encoding='utf-8') as journal:
+                for line in journal:
+                    try:
+                        walletid, score_date, score = json.loads(line)
+                    except ValueError:
+                        continue  # Torn last line
+                    key = (walletid, score_date)
+                    best[key] = max(best.get(key, score), score)
+            if best:
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    conn.executemany(self.upsert_sql, self._rows(best))
+                    conn.execute('COMMIT')
+                except Exception:
+                    conn.execute('ROLLBACK')
+                    raise
+            if path == self._journal_path(self._pid):
+                # Our own pid reused: reopen it empty
+                if self._journal is not None:
+                    self._journal.close()
+                    self._journal = None
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass  # Another worker recovered it first
+            with self._lock:
+                self._stats['recovered_rows'] += len(best)
+
+    def run(self, conn: sqlite3.Connection, phase: str):
+        """Writer background hook: recover on start, flush when due, drain on stop"""
+        if phase == 'start':
+            self.recover(conn)
+        elif phase == 'idle':
+            self.flush(conn)
+        else:
+            self.flush(conn, force=True)
+            self.close()
+
+    def close(self):
+        """Remove the (flushed, so empty) journal"""
+        if self._journal is not None and not self._pending:
+            self._journal.close()
+            self._journal = None
+            os.remove(self._journal_path(self._pid))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['pending'] = len(self._pending)
+        stats['coalescing_ratio'] = round(stats['adds_flushed'] / stats['rows_flushed'], 2) if stats['rows_flushed'] else 0
+        for key in ('last_flush_ms', 'max_flush_ms', 'max_wait_ms'):
+            stats[key] = round(stats[key], 2)
+        return stats
@@ -0,0 +1,408 @@
+"""
+Single writer with group commit for all backend mutations.
+
+Endpoints never write to SQLite themselves. They submit a named command
+(registered with @command, see store.py) and block until the writer has
+committed it. The writer owns one connection to users.db with
+transactions.db and daily_scores.db attached, drains whatever commands are
+queued, runs each inside its own SAVEPOINT and commits the whole batch at
+once, so N concurrent writes cost one commit instead of N and never fight
+over the write lock.
+
+Under gunicorn the writer is a sidecar: gunicorn_config.py starts
+`python writer.py` listening on the Unix socket QXMR_WRITER_SOCKET and
+every worker sends its commands there, so there is exactly one writer.
+Without QXMR_WRITER_SOCKET (the Flask dev server, scripts, a single
+worker) the writer is a thread inside the process. That is one writer per
+process, so thread mode is only for single-process runs.
+"""
+import argparse
+import json
+import os
+import queue
+import signal
+import socket
+import socketserver
+import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import metrics
+import sql_profiler
+import tracing
+from db import BUSY_TIMEOUT, DAILY_SCORES_DB, TRANSACTIONS_DB, USERS_DB
+
+WRITER_SOCKET = os.environ.get('QXMR_WRITER_SOCKET', '')
+# Largest number of commands committed in one transaction
+MAX_BATCH = 256
+# Seconds to linger for more commands after the first (0: batch what is queued)
+MAX_WAIT = 0.0
+# Idle sockets a worker keeps open to the sidecar writer
+REMOTE_POOL_SIZE = 16
+# Seconds between background runs while no commands arrive
+BACKGROUND_INTERVAL = 0.25
+
+COMMANDS: Dict[str, Callable[..., Any]] = {}
+# fn(conn, phase) run by the writer thread with phase 'start', 'idle' (after
+# each batch and every BACKGROUND_INTERVAL) or 'stop', outside any transaction
+BACKGROUND: List[Callable[[sqlite3.Connection, str], None]] = []
+# fn() run once per committed batch, after its after_commit callbacks and
+# before any of its commands is answered (e.g. to fsync what they journaled)
+BEFORE_REPLY: List[Callable[[], None]] = []
+# Extra sections of Writer.stats()
+STATS_SOURCES: Dict[str, Callable[[], Dict[str, Any]]] = {}
+
+_command_state = threading.local()
+
+
+def command(fn: Callable[..., Any]) -> Callable[..., Any]:
+    """Register `fn(conn, *args)` as a writer command under its own name"""
+    COMMANDS[fn.__name__] = fn
+    return fn
+
+
+def background(fn: Callable[[sqlite3.Connection, str], None]) -> Callable[[sqlite3.Connection, str], None]:
+    """Register `fn(conn, phase)` to run on the writer thread (see BACKGROUND)"""
+    BACKGROUND.append(fn)
+    return fn
+
+
+def before_reply(fn: Callable[[], None]) -> Callable[[], None]:
+    """Register `fn()` to run before the commands of each batch are answered (see BEFORE_REPLY)"""
+    BEFORE_REPLY.append(fn)
+    return fn
+
+
+def after_commit(callback: Callable[[], None]):
+    """Call `callback()` once the running command is committed, before its caller
+    is answered; it is dropped if the command or its batch rolls back"""
+    callbacks = getattr(_command_state, 'callbacks', None)
+    if callbacks is None:
+        raise WriterError('after_commit() outside a writer command')
+    callbacks.append(callback)
+
+
+class WriterError(Exception):
+    """A command failed in the writer (or the writer is unreachable)"""
+
+
+class Writer:
+    """Applies queued commands in batched transactions on a dedicated thread"""
+
+    def __init__(self, max_batch: int = MAX_BATCH, max_wait: float = MAX_WAIT):
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+        self._queue: 'queue.Queue[Optional[Tuple[str, tuple, Future]]]' = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._pid = None
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self._stats = {
+            'batches': 0,
+            'commands': 0,
+            'failed_commands': 0,
+            'failed_commits': 0,
+            'last_batch_size': 0,
+            'max_batch_size': 0,
+            'max_queue_depth': 0,
+            'commit_ms_total': 0.0,
+            'background_errors': 0,
+        }
+
+    def _connect(self) -> sqlite3.Connection:
+        # One connection for all three files: timed as 'writer'
+        conn = metrics.connect(USERS_DB, 'writer', sql_profiler.CURSOR_CLASS, isolation_level=None,
+                               timeout=BUSY_TIMEOUT)
+        conn.row_factory = sqlite3.Row
+        conn.execute('ATTACH DATABASE ? AS transactions_db', (TRANSACTIONS_DB,))
+        conn.execute('ATTACH DATABASE ? AS daily_scores_db', (DAILY_SCORES_DB,))
+        return conn
+
+    def start(self):
+        """Start the writer thread for this process (again after a fork)"""
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._queue = queue.Queue()
+            self._pid = os.getpid()
+            self._reset_stats()
+            self._thread = threading.Thread(target=self._run, name='qxmr-writer', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float = 10.0):
+        """Apply everything already queued, then stop the thread"""
+        if self._thread is None or self._pid != os.getpid():
+            return
+        self._queue.put(None)
+        self._thread.join(timeout)
+        self._thread = None
+
+    def submit(self, name: str, *args: Any) -> Any:
+        """Queue a command and wait until it is committed; returns its result"""
+        if name not in COMMANDS:
+            raise WriterError(f'Unknown command: {name}')
+        self.start()
+        future: Future = Future()
+        with tracing.span(f'writer.{name}'):
+            self._queue.put((name, args, future))
+            return future.result()
+
+    def _next_batch(self) -> Tuple[List[Tuple[str, tuple, Future]], bool]:
+        try:
+            item = self._queue.get(timeout=BACKGROUND_INTERVAL) if BACKGROUND else self._queue.get()
+        except queue.Empty:
+            return [], False
+        if item is None:
+            return [], True
+        batch = [item]
+        depth = self._queue.qsize() + 1
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            try:
+                remaining = deadline - time.monotonic()
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        with self._lock:
+            self._stats['max_queue_depth'] = max(self._stats['max_queue_depth'], depth)
+        return batch, False
+
+    def _run(self):
+        conn = self._connect()
+        self._background(conn, 'start')
+        stopping = False
+        while not stopping:
+            batch, stopping = self._next_batch()
+            if batch:
+                self._apply(conn, batch)
+            self._background(conn, 'idle')
+        self._background(conn, 'stop')
+        conn.close()
+
+    def _background(self, conn: sqlite3.Connection, phase: str):
+        for fn in BACKGROUND:
+            try:
+                fn(conn, phase)
+            except Exception:
+                if conn.in_transaction:
+                    conn.execute('ROLLBACK')
+                with self._lock:
+                    self._stats['background_errors'] += 1
+
+    def _apply(self, conn: sqlite3.Connection, batch: List[Tuple[str, tuple, Future]]):
+        outcomes = []
+        committed: List[Callable[[], None]] = []
+        failed = 0
+        start = time.perf_counter()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            for name, args, future in batch:
+                conn.execute('SAVEPOINT command')
+                _command_state.callbacks = callbacks = []
+                try:
+                    outcomes.append((future, COMMANDS[name](conn, *args), None))
+                    conn.execute('RELEASE command')
+                    committed.extend(callbacks)
+                except Exception as e:
+                    conn.execute('ROLLBACK TO command')
+                    conn.execute('RELEASE command')
+                    outcomes.append((future, None, e))
+                    failed += 1
+                finally:
+                    _command_state.callbacks = None
+            conn.execute('COMMIT')
+        except Exception as e:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            with self._lock:
+                self._stats['failed_commits'] += 1
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        with self._lock:
+            stats = self._stats
+            stats['batches'] += 1
+            stats['commands'] += len(batch)
+            stats['failed_commands'] += failed
+            stats['last_batch_size'] = len(batch)
+            stats['max_batch_size'] = max(stats['max_batch_size'], len(batch))
+            stats['commit_ms_total'] += elapsed_ms
+        for callback in committed + BEFORE_REPLY:
+            try:
+                callback()
+            except Exception:
+                with self._lock:
+                    self._stats['background_errors'] += 1
+        for future, result, error in outcomes:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+        stats['pid'] = self._pid
+        stats['mode'] = 'thread'
+        stats['queue_depth'] = self._queue.qsize()
+        stats['avg_batch_size'] = round(stats['commands'] / stats['batches'], 2) if stats['batches'] else 0
+        stats['commit_ms_total'] = round(stats['commit_ms_total'], 2)
+        for name, source in STATS_SOURCES.items():
+            stats[name] = source()
+        return stats
+
+
+class RemoteWriter:
+    """Client for the sidecar writer over a small pool of sockets, reopened after fork.
+
+    A socket carries one command at a time, so it is taken from the pool for
+    the round trip and put back afterwards. Under gevent several greenlets
+    share an OS thread, hence a shared pool rather than a socket per thread.
+    """
+
+    def __init__(self, path: str, pool_size: int = REMOTE_POOL_SIZE):
+        self.path = path
+        self.pool_size = pool_size
+        self._idle: List[Tuple[socket.socket, Any]] = []
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def _acquire(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                # The parent's sockets belong to the parent
+                self._idle = []
+                self._pid = os.getpid()
+            if self._idle:
+                return self._idle.pop()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+        except OSError:
+            sock.close()
+            raise
+        return sock, sock.makefile('rb')
+
+    def _release(self, conn):
+        with self._lock:
+            if self._pid == os.getpid() and len(self._idle) < self.pool_size:
+                self._idle.append(conn)
+                return
+        self._close(conn)
+
+    @staticmethod
+    def _close(conn):
+        conn[1].close()
+        conn[0].close()
+
+    def submit(self, name: str, *args: Any) -> Any:
+        message = (json.dumps({'command': name, 'args': args}) + '\n').encode()
+        with tracing.span(f'writer.{name}'):
+            try:
+                conn = self._acquire()
+            except OSError as e:
+                raise WriterError(f'Writer unavailable: {e}')
+            try:
+                conn[0].sendall(message)
+                line = conn[1].readline()
+            except OSError as e:
+                self._close(conn)
+                raise WriterError(f'Writer unavailable: {e}')
+            if not line:
+                self._close(conn)
+                raise WriterError('Writer closed the connection')
+            self._release(conn)
+        reply = json.loads(line)
+        if 'error' in reply:
+            raise WriterError(reply['error'])
+        return reply['result']
+
+    def start(self):
+        pass
+
+    def stop(self, timeout: float = 10.0):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            self._close(conn)
+
+    def stats(self) -> Dict[str, Any]:
+        return self.submit('__stats__')
+
+
+class _CommandHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        local = self.server.writer
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                if request['command'] == '__stats__':
+                    reply = {'result': dict(local.stats(), mode='sidecar')}
+                else:
+                    reply = {'result': local.submit(request['command'], *request.get('args', []))}
+            except Exception as e:
+                reply = {'error': str(e)}
+            self.wfile.write((json.dumps(reply) + '\n').encode())
+            self.wfile.flush()
+
+
+class _SidecarServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(path: str):
+    """Run the sidecar writer on a Unix socket until interrupted"""
+    import store
+
+    # store.py's @command functions register on import: check they went into
+    # this module's COMMANDS (not those of a second copy run as __main__)
+    if store.command is not command or not COMMANDS:
+        raise RuntimeError('The store commands are not registered with this writer')
+    # Create and migrate the databases before connecting: a connection that
+    # loaded a schema in the middle of the workers' migrations could keep
+    # it, since a statement that fails to prepare never makes SQLite reload it
+    from app import init_databases
+    init_databases()
+    local = Writer()
+    local.start()
+    if os.path.exists(path):
+        os.unlink(path)
+    server = _SidecarServer(path, _CommandHandler)
+    server.writer = local
+    # gunicorn stops the sidecar with SIGTERM: flush the queue on the way out
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print(f'Writer listening on {path}', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        local.stop()
+        if os.path.exists(path):
+            os.unlink(path)
+
+
+def create_writer():
+    """The writer endpoints should submit to in this process: the sidecar when
+    QXMR_WRITER_SOCKET is set, otherwise a writer thread (single process only)"""
+    if WRITER_SOCKET:
+        return RemoteWriter(WRITER_SOCKET)
+    return Writer()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='QXMR single-writer sidecar')
+    parser.add_argument('--socket', default=WRITER_SOCKET or '/tmp/qxmr-writer.sock')
+    # Run from the importable module so store.py registers into the same COMMANDS
+    import writer
+    writer.serve(parser.parse_args().socket)
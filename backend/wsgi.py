@@ -1,12 +1,15 @@
 """
 WSGI entry point for the Flask application
 """
-from app import app, init_databases
+from app import app, init_databases, warm_up
 
 # Initialize databases on startup
 init_databases()
 print("Databases initialized successfully!")
 
+# Build in-memory structures before the first request
+warm_up()
+
 # Export app for Gunicorn
 application = app
 
@@ -64,7 +64,7 @@ export const getAllTransactions = async (): Promise<AdminTransaction[]> => {
 /**
  * Reset all user balances to 0
  */
-export const resetAllBalances = async (): Promise<{ success: boolean; message: string; affected_rows: number }> => {
+export const resetAllBalances = async (): Promise<{ success: boolean; message: string; season: number }> => {
   const response = await fetch(`${BACKEND_URL}/admin/reset-balances`, {
     method: 'POST',
     headers: {